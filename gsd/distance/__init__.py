@@ -1,5 +1,7 @@
 import os
+import threading
 import time
+from contextlib import contextmanager
 
 import jsonpickle
 import numpy as np
@@ -9,8 +11,8 @@ from typing import List, TypeVar, Iterable, Callable, Tuple
 from anytree import Node, PostOrderIter
 from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import shortest_path
-from tqdm import tqdm
 
+from gsd.distance.progress import Progress
 from gsd.gene_sets import GeneSet
 
 
@@ -54,34 +56,92 @@ def calc_n_comparisons(gene_sets: List[T]) -> int:
     return int(n * (n + 1) / 2)
 
 
+class _CondensedRange(threading.local):
+    def __init__(self):
+        self.range = None
+
+
+_condensed_range = _CondensedRange()
+
+
+@contextmanager
+def condensed_range(begin: int, end: int):
+    """
+    Restricts the pairwise calculations of this thread within the block to the condensed indices [begin, end),
+    the remaining distances are NaN. Used by sharded evaluations, see gsd.distance.sharding.
+    """
+    previous = _condensed_range.range
+    _condensed_range.range = (begin, end)
+    try:
+        yield
+    finally:
+        _condensed_range.range = previous
+
+
+def active_condensed_range(n_comparisons: int) -> Tuple[int, int]:
+    if _condensed_range.range is None:
+        return 0, n_comparisons
+    begin, end = _condensed_range.range
+    return max(begin, 0), min(end, n_comparisons)
+
+
 def execute_and_persist_evaluation(
         metric: DistanceMetric,
         gene_sets: List[GeneSet],
-        out_file: str):
-    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        out_file: str,
+        shard_dir: str = None,
+        **shard_options):
+    """
+    With `shard_dir` the evaluation is split into shards that workers on several nodes claim through this
+    (shared) directory, see gsd.distance.sharding.run_sharded_evaluation for the options
+    """
+    if shard_dir is not None:
+        from gsd.distance.sharding import run_sharded_evaluation
+        run_sharded_evaluation(metric, gene_sets, out_file, shard_dir, **shard_options)
+        return
 
     time_begin = time.time()
     d = metric.calc(gene_sets)
     time_end = time.time()
 
+    persist_evaluation(metric.display_name, time_end - time_begin, d, gene_sets, out_file)
+
+
+def persist_evaluation(name: str,
+                       exec_time: float,
+                       d: np.ndarray,
+                       gene_sets: List[GeneSet],
+                       out_file: str):
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+
     comparison_labels = []
     for i in range(0, len(gene_sets) - 1):
         for j in range(i + 1, len(gene_sets)):
             comparison_labels.append((gene_sets[i].general_info.name, gene_sets[j].general_info.name))
 
-    result = EvaluationResult(metric.display_name, time_end - time_begin, d.tolist(), comparison_labels)
+    result = EvaluationResult(name, exec_time, d.tolist(), comparison_labels)
     with open(out_file, "w") as gene_set_file:
         gene_set_file.write(jsonpickle.encode(result))
 
 
-def calc_pairwise_distances(obj_list: List[T], dist_fun: Callable[[T, T], float]) -> np.ndarray:
-    result = np.ndarray(shape=(calc_n_comparisons(obj_list),), dtype=float)
-    idx = 0
-
-    for i in tqdm(range(0, len(obj_list) - 1), desc='Outer loop', position=0):
-        for j in tqdm(range(i + 1, len(obj_list)), desc='Inner loop', position=1):
-            result[idx] = dist_fun(obj_list[i], obj_list[j])
-            idx += 1
+def calc_pairwise_distances(obj_list: List[T],
+                            dist_fun: Callable[[T, T], float],
+                            phase: str = "Pairwise distances") -> np.ndarray:
+    n = len(obj_list)
+    result = np.full(calc_n_comparisons(obj_list), np.nan)
+    begin, end = active_condensed_range(len(result))
+    row_begin = 0
+
+    # every row of the condensed matrix is one tile, rows outside the active range are skipped
+    with Progress(phase, max(end - begin, 0)) as progress:
+        for i in range(0, n - 1):
+            row_end = row_begin + n - i - 1
+            if row_end > begin and row_begin < end:
+                progress.tile_started(i)
+                for idx in range(max(begin, row_begin), min(end, row_end)):
+                    result[idx] = dist_fun(obj_list[i], obj_list[i + 1 + idx - row_begin])
+                progress.tile_finished(i, min(end, row_end) - max(begin, row_begin))
+            row_begin = row_end
     return result
 
 
@@ -0,0 +1,288 @@
+import heapq
+import json
+import os
+import time
+from typing import List, Tuple, Dict
+
+import numpy as np
+
+
+# Approximate cosine nearest neighbour search over gene set embeddings with a forest of random projection
+# trees (as in Annoy). Vectors are stored unit-normalized, so the cosine distance is 1 - dot product.
+# Node i splits on normals[i] . v > offsets[i]; children[i] holds (left, right), where negative values
+# -(leaf + 1) refer to leaves. All arrays can be saved to a directory and memory-mapped read-only;
+# the first insert after loading copies the parts it has to modify.
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1)
+    return vectors / np.where(norms > 0, norms, 1)[:, np.newaxis]
+
+
+def _reserve(array: np.ndarray, size: int) -> np.ndarray:
+    if len(array) >= size and array.flags.writeable:
+        return array
+    reserved = np.zeros((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    reserved[:len(array)] = array
+    return reserved
+
+
+def _leaf_ref(leaf: int) -> int:
+    return -leaf - 1
+
+
+class CosineANNIndex:
+    def __init__(self, dim: int, n_trees: int = 10, leaf_size: int = 32, seed: int = 0):
+        self.dim = dim
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.seed = seed
+        self.random = np.random.RandomState(seed)
+
+        self.n_items = 0
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.labels = []
+
+        self.n_nodes = 0
+        self.normals = np.zeros((0, dim), dtype=np.float32)
+        self.offsets = np.zeros(0, dtype=np.float32)
+        self.children = np.zeros((0, 2), dtype=np.int64)
+        self.roots = np.zeros(0, dtype=np.int64)
+
+        # leaves are a CSR list of item ids plus the leaves that were created or changed since
+        self.leaf_offsets = np.zeros(1, dtype=np.int64)
+        self.leaf_items = np.zeros(0, dtype=np.int64)
+        self.changed_leaves = {}
+
+    def __len__(self):
+        return self.n_items
+
+    @property
+    def n_leaves(self) -> int:
+        return max(len(self.leaf_offsets) - 1, max(self.changed_leaves, default=-1) + 1)
+
+    def _leaf(self, leaf: int) -> np.ndarray:
+        if leaf in self.changed_leaves:
+            return self.changed_leaves[leaf]
+        return self.leaf_items[self.leaf_offsets[leaf]:self.leaf_offsets[leaf + 1]]
+
+    def _new_leaf(self, items: np.ndarray) -> int:
+        leaf = self.n_leaves
+        self.changed_leaves[leaf] = items
+        return _leaf_ref(leaf)
+
+    def _new_node(self, normal: np.ndarray, offset: float) -> int:
+        self.normals = _reserve(self.normals, self.n_nodes + 1)
+        self.offsets = _reserve(self.offsets, self.n_nodes + 1)
+        self.children = _reserve(self.children, self.n_nodes + 1)
+        self.normals[self.n_nodes] = normal
+        self.offsets[self.n_nodes] = offset
+        self.n_nodes += 1
+        return self.n_nodes - 1
+
+    def _split(self, items: np.ndarray) -> Tuple[np.ndarray, float, np.ndarray]:
+        a, b = self.random.choice(items, 2, replace=False)
+        normal = self.vectors[a] - self.vectors[b]
+        offset = float(np.dot(normal, (self.vectors[a] + self.vectors[b]) / 2))
+        right = self.vectors[items] @ normal > offset
+        if right.all() or not right.any():
+            # identical vectors cannot be separated by a hyperplane, halve them at random instead
+            right = np.zeros(len(items), dtype=bool)
+            right[self.random.permutation(len(items))[:len(items) // 2]] = True
+        return normal, offset, right
+
+    def _build_sub_tree(self, items: np.ndarray) -> int:
+        if len(items) <= self.leaf_size:
+            return self._new_leaf(items)
+
+        root = None
+        stack = [(items, None, None)]
+        while stack:
+            node_items, parent, side = stack.pop()
+            if len(node_items) <= self.leaf_size:
+                ref = self._new_leaf(node_items)
+            else:
+                normal, offset, right = self._split(node_items)
+                ref = self._new_node(normal, offset)
+                stack.append((node_items[~right], ref, 0))
+                stack.append((node_items[right], ref, 1))
+            if parent is None:
+                root = ref
+            else:
+                self.children[parent, side] = ref
+        return root
+
+    def _descend(self, ref: int, vector: np.ndarray) -> Tuple[int, int, int]:
+        parent, side = None, None
+        while ref >= 0:
+            parent, side = ref, int(np.dot(self.normals[ref], vector) > self.offsets[ref])
+            ref = self.children[ref, side]
+        return ref, parent, side
+
+    def add(self, vectors: np.ndarray, labels: List = None) -> np.ndarray:
+        """Inserts vectors into every tree, splitting leaves that grow beyond twice the leaf size"""
+        vectors = _normalize(vectors)
+        ids = np.arange(self.n_items, self.n_items + len(vectors))
+        self.vectors = _reserve(self.vectors, self.n_items + len(vectors))
+        self.vectors[ids] = vectors
+        self.n_items += len(vectors)
+        self.labels.extend(labels if labels is not None else ids.tolist())
+
+        if len(self.roots) < self.n_trees:
+            self.roots = np.array([self._build_sub_tree(np.arange(self.n_items)) for _ in range(self.n_trees)],
+                                  dtype=np.int64)
+            return ids
+
+        if not self.children.flags.writeable:
+            self.children = np.array(self.children)
+        if not self.roots.flags.writeable:
+            self.roots = np.array(self.roots)
+
+        for item, vector in zip(ids, vectors):
+            for tree in range(self.n_trees):
+                ref, parent, side = self._descend(self.roots[tree], vector)
+                leaf = _leaf_ref(ref)
+                items = np.append(self._leaf(leaf), item)
+                if len(items) <= 2 * self.leaf_size:
+                    self.changed_leaves[leaf] = items
+                    continue
+
+                self.changed_leaves[leaf] = np.zeros(0, dtype=np.int64)
+                sub_tree = self._build_sub_tree(items)
+                if parent is None:
+                    self.roots[tree] = sub_tree
+                else:
+                    self.children[parent, side] = sub_tree
+        return ids
+
+    def _candidates(self, vector: np.ndarray, search_k: int) -> np.ndarray:
+        # best-first search over all trees, a node's priority is the smallest margin on the way to it
+        heap = [(-np.inf, int(root)) for root in self.roots]
+        candidates = []
+        n_candidates = 0
+        while heap and n_candidates < search_k:
+            negative_priority, ref = heapq.heappop(heap)
+            if ref < 0:
+                items = self._leaf(_leaf_ref(ref))
+                candidates.append(items)
+                n_candidates += len(items)
+                continue
+            priority = -negative_priority
+            margin = float(np.dot(self.normals[ref], vector) - self.offsets[ref])
+            heapq.heappush(heap, (-min(priority, -margin), int(self.children[ref, 0])))
+            heapq.heappush(heap, (-min(priority, margin), int(self.children[ref, 1])))
+        return np.unique(np.concatenate(candidates)) if candidates else np.zeros(0, dtype=np.int64)
+
+    def query(self, vector: np.ndarray, k: int = 10, search_k: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns ids and cosine distances of the approximately k nearest items. `search_k` bounds the
+        number of candidates taken from the trees (default: k * n_trees); larger values raise the recall.
+        """
+        vector = _normalize(vector)[0]
+        candidates = self._candidates(vector, search_k or k * self.n_trees)
+        distances = 1.0 - self.vectors[candidates] @ vector
+        distances[np.linalg.norm(self.vectors[candidates], axis=1) == 0] = np.nan
+        order = np.argsort(distances, kind='stable')[:k]
+        return candidates[order], distances[order]
+
+    def query_labels(self, vector: np.ndarray, k: int = 10, search_k: int = None) -> List[Tuple[str, float]]:
+        ids, distances = self.query(vector, k, search_k)
+        return [(self.labels[idx], float(distance)) for idx, distance in zip(ids, distances)]
+
+    def exact_query(self, vector: np.ndarray, k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        vector = _normalize(vector)[0]
+        vectors = self.vectors[:self.n_items]
+        distances = 1.0 - vectors @ vector
+        distances[np.linalg.norm(vectors, axis=1) == 0] = np.nan
+        order = np.argsort(distances, kind='stable')[:k]
+        return order, distances[order]
+
+    def save(self, index_dir: str):
+        os.makedirs(index_dir, exist_ok=True)
+        leaves = [self._leaf(leaf) for leaf in range(self.n_leaves)]
+        leaf_offsets = np.zeros(len(leaves) + 1, dtype=np.int64)
+        np.cumsum([len(items) for items in leaves], out=leaf_offsets[1:])
+
+        arrays = {'vectors': self.vectors[:self.n_items],
+                  'normals': self.normals[:self.n_nodes],
+                  'offsets': self.offsets[:self.n_nodes],
+                  'children': self.children[:self.n_nodes],
+                  'roots': self.roots,
+                  'leaf_offsets': leaf_offsets,
+                  'leaf_items': np.concatenate(leaves).astype(np.int64) if leaves else np.zeros(0, dtype=np.int64)}
+        for name, array in arrays.items():
+            np.save(os.path.join(index_dir, name + ".npy"), array)
+        with open(os.path.join(index_dir, "index.json"), "w") as f:
+            json.dump({'dim': self.dim, 'n_trees': self.n_trees, 'leaf_size': self.leaf_size, 'seed': self.seed,
+                       'labels': self.labels}, f)
+
+
+def build_ann_index(vectors: np.ndarray,
+                    labels: List = None,
+                    n_trees: int = 10,
+                    leaf_size: int = 32,
+                    seed: int = 0) -> CosineANNIndex:
+    index = CosineANNIndex(np.shape(vectors)[1], n_trees, leaf_size, seed)
+    index.add(vectors, labels)
+    return index
+
+
+def build_gene_set_index(metric, gene_sets: List, n_trees: int = 10, leaf_size: int = 32) -> CosineANNIndex:
+    """Index over the gene set embeddings of a cosine NLP metric (anything with an `embed(gene_sets)` method)"""
+    return build_ann_index(metric.embed(gene_sets), [gene_set.general_info.name for gene_set in gene_sets],
+                           n_trees, leaf_size)
+
+
+def load_ann_index(index_dir: str, mmap: bool = True) -> CosineANNIndex:
+    with open(os.path.join(index_dir, "index.json")) as f:
+        params = json.load(f)
+    index = CosineANNIndex(params['dim'], params['n_trees'], params['leaf_size'], params['seed'])
+    mmap_mode = 'r' if mmap else None
+
+    def load(name: str) -> np.ndarray:
+        return np.load(os.path.join(index_dir, name + ".npy"), mmap_mode=mmap_mode)
+
+    index.vectors = load('vectors')
+    index.n_items = len(index.vectors)
+    index.labels = params['labels']
+    index.normals = load('normals')
+    index.offsets = load('offsets')
+    index.children = load('children')
+    index.n_nodes = len(index.children)
+    index.roots = load('roots')
+    index.leaf_offsets = load('leaf_offsets')
+    index.leaf_items = load('leaf_items')
+    return index
+
+
+def recall_report(index: CosineANNIndex,
+                  queries: np.ndarray,
+                  k: int = 10,
+                  search_ks: List[int] = None) -> List[Dict[str, float]]:
+    """Recall@k and mean query latency for several search_k values, measured against exact cosine search"""
+    exact = []
+    time_begin = time.time()
+    for query in queries:
+        exact.append(set(index.exact_query(query, k)[0].tolist()))
+    exact_latency = (time.time() - time_begin) / len(queries)
+
+    report = []
+    for search_k in search_ks or [k * index.n_trees // 4, k * index.n_trees, 4 * k * index.n_trees]:
+        found = 0
+        time_begin = time.time()
+        for query, expected in zip(queries, exact):
+            found += len(expected & set(index.query(query, k, search_k)[0].tolist()))
+        latency = (time.time() - time_begin) / len(queries)
+        report.append({'search_k': search_k,
+                       'recall': found / float(sum(len(expected) for expected in exact)),
+                       'latency_ms': latency * 1000,
+                       'exact_latency_ms': exact_latency * 1000})
+    return report
+
+
+def format_recall_report(report: List[Dict[str, float]]) -> str:
+    lines = ["%10s %8s %12s %12s" % ("search_k", "recall", "latency_ms", "exact_ms")]
+    for row in report:
+        lines.append("%10d %8.3f %12.3f %12.3f" % (row['search_k'], row['recall'], row['latency_ms'],
+                                                   row['exact_latency_ms']))
+    return "\n".join(lines)
@@ -1,18 +1,20 @@
 from typing import List
 import numpy as np
 
-from gsd.distance import DistanceMetric, calc_pairwise_distances
+from gsd.distance import DistanceMetric, calc_n_comparisons
 from gsd.gene_sets import GeneSet
-import random
 
 
 class RandomDistanceMetric(DistanceMetric):
+    def __init__(self, seed: int = None):
+        self.random = np.random.RandomState(seed)
+
     @property
     def display_name(self) -> str:
         return "Random (uniform, (0,1))"
 
     def calc(self, gene_sets: List[GeneSet]) -> np.ndarray:
-        return calc_pairwise_distances(gene_sets, lambda a, b: random.uniform(0, 1))
+        return self.random.uniform(0, 1, calc_n_comparisons(gene_sets))
 
 
 def overlap_coefficient(list_a: List[bool], list_b: List[bool]) -> float:
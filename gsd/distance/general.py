@@ -1,6 +1,8 @@
+import math
 from typing import List, Dict, Set, Callable
 
 from Cython.Utils import OrderedSet
+from scipy.sparse import coo_matrix
 from scipy.spatial.distance import pdist
 import numpy as np
 from sklearn.metrics import cohen_kappa_score
@@ -57,6 +59,107 @@ def overlap_distance(data: np.array) -> np.array:
     return calc_pairwise_distances(np.array(data), lambda a, b: 1 - overlap_coefficient(a, b))
 
 
+def gene_matrix(gene_sets: List[GeneSet]) -> List[List]:
+    return to_binary_matrix(to_gene_id_map(gene_sets))
+
+
+def gene_trait_matrix(gene_sets: List[GeneSet]) -> List[List]:
+    return to_binary_matrix(to_gene_trait_map(gene_sets))
+
+
+def gene_trait_freq_matrix(gene_sets: List[GeneSet]) -> List[List]:
+    return to_freq_matrix(to_gene_trait_freq(gene_sets))
+
+
+def _min_overlap(threshold: float, size: int) -> int:
+    return max(1, math.ceil(threshold * size - 1e-9))
+
+
+def similarity_join(id_sets: List[Set], threshold: float, measure: str = 'jaccard') -> coo_matrix:
+    """
+    Distances (1 - similarity) of all pairs i < j whose Jaccard similarity or overlap coefficient is at least
+    `threshold`, as a sparse upper triangular matrix. Pairs below the threshold are not stored, identical
+    sets are stored as explicit zeros.
+
+    Ids are ordered by ascending frequency and sets are visited by ascending size. Only the prefix of every
+    set (its rarest ids) is indexed, two sets can only reach the threshold if their prefixes share an id, and
+    for Jaccard the smaller set must have at least `threshold` × the size of the larger one. Candidates are
+    dropped as soon as the ids left after a shared one cannot make up the required overlap, the remaining
+    ones are verified exactly, so the work scales with the number of similar pairs.
+    """
+    if not 0 < threshold <= 1:
+        raise ValueError("Threshold must be in (0, 1], got %f" % threshold)
+    if measure not in ('jaccard', 'overlap'):
+        raise ValueError("Unknown measure %s, expected jaccard or overlap" % measure)
+
+    frequency = {}
+    for id_set in id_sets:
+        for key in id_set:
+            frequency[key] = frequency.get(key, 0) + 1
+    rank = {key: idx for idx, key in enumerate(sorted(frequency, key=lambda key: (frequency[key], str(key))))}
+    ordered = [sorted(rank[key] for key in id_set) for id_set in id_sets]
+
+    sizes = [len(ids) for ids in ordered]
+    rows, cols, distances = [], [], []
+    postings = {}
+    for x in sorted(range(len(id_sets)), key=lambda idx: sizes[idx]):
+        size_x = sizes[x]
+        if size_x == 0:
+            continue
+        prefix_x = size_x - _min_overlap(threshold, size_x) + 1
+        # partners of x were visited before, i.e. are at most as large
+        if measure == 'jaccard':
+            probe = ordered[x][:prefix_x]
+            min_size = threshold * size_x - 1e-9
+        else:
+            probe = ordered[x]
+            min_size = 0
+        # shared ids seen so far per candidate, candidates which can no longer reach the threshold are dropped
+        overlaps = {}
+        for i, token in enumerate(probe):
+            remaining_x = size_x - i - 1
+            for y, j in postings.get(token, ()):
+                overlap = overlaps.get(y, 0)
+                size_y = sizes[y]
+                if overlap < 0 or size_y < min_size:
+                    continue
+                if measure == 'jaccard':
+                    required = math.ceil(threshold / (1 + threshold) * (size_x + size_y) - 1e-9)
+                else:
+                    required = math.ceil(threshold * size_y - 1e-9)
+                overlaps[y] = overlap + 1 if overlap + 1 + min(remaining_x, size_y - j - 1) >= required else -1
+
+        for y, overlap in overlaps.items():
+            if overlap < 0:
+                continue
+            intersection = len(id_sets[x] & id_sets[y])
+            if measure == 'jaccard':
+                similarity = intersection / (size_x + sizes[y] - intersection)
+            else:
+                similarity = intersection / min(size_x, sizes[y])
+            if similarity >= threshold - 1e-12:
+                rows.append(min(x, y))
+                cols.append(max(x, y))
+                distances.append(1 - similarity)
+
+        # later partners are at least as large, which bounds the overlap needed with x from below
+        index_overlap = _min_overlap(2 * threshold / (1 + threshold), size_x) if measure == 'jaccard' \
+            else _min_overlap(threshold, size_x)
+        for j, token in enumerate(ordered[x][:size_x - index_overlap + 1]):
+            postings.setdefault(token, []).append((x, j))
+
+    order = np.lexsort((cols, rows))
+    return coo_matrix((np.array(distances, dtype=float)[order],
+                       (np.array(rows, dtype=np.int64)[order], np.array(cols, dtype=np.int64)[order])),
+                      shape=(len(id_sets), len(id_sets)))
+
+
+def gene_similarity_join(gene_sets: List[GeneSet], threshold: float, measure: str = 'jaccard') -> coo_matrix:
+    """Gene set pairs sharing at least `threshold` of their genes, see `similarity_join`"""
+    return similarity_join([set(gene_set.general_info.entrez_gene_ids) for gene_set in gene_sets],
+                           threshold, measure)
+
+
 class MatrixBasedDistanceMetric(DistanceMetric):
     def __init__(self,
                  name: str,
@@ -76,45 +179,45 @@ class MatrixBasedDistanceMetric(DistanceMetric):
 
 _GENERAL_DISTS = [
     MatrixBasedDistanceMetric("Minkowski distance (p=1) over genes",
-                              lambda x: to_binary_matrix(to_gene_id_map(x)),
+                              gene_matrix,
                               lambda y: pdist(y, 'minkowski', 1)),
     MatrixBasedDistanceMetric("Minkowski distance (p=2) over genes",
-                              lambda x: to_binary_matrix(to_gene_id_map(x)),
+                              gene_matrix,
                               lambda y: pdist(y, 'minkowski', 2)),
     MatrixBasedDistanceMetric("Jaccard distance over genes",
-                              lambda x: to_binary_matrix(to_gene_id_map(x)),
+                              gene_matrix,
                               lambda y: pdist(y, 'jaccard')),
     MatrixBasedDistanceMetric("Kappa distance over genes",
-                              lambda x: to_binary_matrix(to_gene_id_map(x)),
+                              gene_matrix,
                               kappa_distance),
     MatrixBasedDistanceMetric("Overlap distance over genes",
-                              lambda x: to_binary_matrix(to_gene_id_map(x)),
+                              gene_matrix,
                               overlap_distance),
 
     MatrixBasedDistanceMetric("Minkowski distance (p=1) over gene traits",
-                              lambda x: to_binary_matrix(to_gene_trait_map(x)),
+                              gene_trait_matrix,
                               lambda y: pdist(y, 'minkowski', 1)),
     MatrixBasedDistanceMetric("Minkowski distance (p=2) over gene traits",
-                              lambda x: to_binary_matrix(to_gene_trait_map(x)),
+                              gene_trait_matrix,
                               lambda y: pdist(y, 'minkowski', 2)),
     MatrixBasedDistanceMetric("Jaccard distance over gene traits",
-                              lambda x: to_binary_matrix(to_gene_trait_map(x)),
+                              gene_trait_matrix,
                               lambda y: pdist(y, 'jaccard')),
     MatrixBasedDistanceMetric("Kappa distance over gene traits",
-                              lambda x: to_binary_matrix(to_gene_trait_map(x)),
+                              gene_trait_matrix,
                               kappa_distance),
     MatrixBasedDistanceMetric("Overlap distance over gene traits",
-                              lambda x: to_binary_matrix(to_gene_trait_map(x)),
+                              gene_trait_matrix,
                               overlap_distance),
 
     MatrixBasedDistanceMetric("Minkowski distance (p=1) over gene trait frequency",
-                              lambda x: to_freq_matrix(to_gene_trait_freq(x)),
+                              gene_trait_freq_matrix,
                               lambda y: pdist(y, 'minkowski', 1)),
     MatrixBasedDistanceMetric("Minkowski distance (p=2) over gene trait frequency",
-                              lambda x: to_freq_matrix(to_gene_trait_freq(x)),
+                              gene_trait_freq_matrix,
                               lambda y: pdist(y, 'minkowski', 2)),
     MatrixBasedDistanceMetric("Cosine distance over gene trait frequency",
-                              lambda x: to_freq_matrix(to_gene_trait_freq(x)),
+                              gene_trait_freq_matrix,
                               lambda y: pdist(y, 'cosine')),
 ]
 
@@ -10,12 +10,25 @@ org_hs_en_db = importr("org.Hs.eg.db")
 go_sem_sim = importr("GOSemSim")
 
 
+class GOData:
+    """GOSemSim data of every ontology, prepared on first use"""
+
+    def __init__(self, org_db: str = 'org.Hs.eg.db'):
+        self.org_db = org_db
+        self.data = {}
+
+    def __getitem__(self, ont: str):
+        if ont not in self.data:
+            self.data[ont] = go_sem_sim.godata(self.org_db, ont=ont)
+        return self.data[ont]
+
+
 class GOSimDistanceMetric(DistanceMetric):
-    def __init__(self, go_type: GOType, measure="Wang", combine="BMA"):
+    def __init__(self, go_type: GOType, measure="Wang", combine="BMA", go_data: GOData = None):
         self.go_type = go_type
         self.measure = measure
         self.combine = combine
-        self.hs_go_data = go_sem_sim.godata('org.Hs.eg.db', ont=go_type.value)
+        self.hs_go_data = (go_data or GOData())[go_type.value]
 
     @property
     def display_name(self) -> str:
@@ -31,3 +44,10 @@ class GOSimDistanceMetric(DistanceMetric):
                                          combine=self.combine)[0]
 
         return calc_pairwise_distances(gene_sets, calc_dist)
+
+
+GO_DISTS = {
+    'GO_SIM_BP_Wang_BMA': lambda go_data=None: GOSimDistanceMetric(GOType.BIOLOGICAL_PROCESS, "Wang", "BMA", go_data),
+    'GO_SIM_CC_Wang_BMA': lambda go_data=None: GOSimDistanceMetric(GOType.CELLULAR_COMPONENT, "Wang", "BMA", go_data),
+    'GO_SIM_MF_Wang_BMA': lambda go_data=None: GOSimDistanceMetric(GOType.MOLECULAR_FUNCTION, "Wang", "BMA", go_data)
+}
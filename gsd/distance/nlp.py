@@ -1,19 +1,27 @@
+import os
 import re
-from functools import reduce
-from typing import List, Callable, Dict
+from functools import lru_cache
+from typing import List, Callable, Dict, FrozenSet, Set
 
 import numpy as np
 from gensim.models.keyedvectors import Word2VecKeyedVectors
+from scipy.sparse import csr_matrix
 from scipy.spatial.distance import cosine
 
 from gsd import flat_list
 from gsd.distance import DistanceMetric, calc_pairwise_distances
+from gsd.distance.wmd import WMDistance
 from gsd.gene_sets import GeneSet, GOType
 import nltk.corpus
 
 
+@lru_cache(maxsize=None)
+def _stop_words() -> FrozenSet[str]:
+    return frozenset(nltk.corpus.stopwords.words('english'))
+
+
 def _filter_stop_words(sentence: List[str]) -> List[str]:
-    stop_words = nltk.corpus.stopwords.words('english')
+    stop_words = _stop_words()
     return [w for w in sentence if w not in stop_words]
 
 
@@ -25,12 +33,6 @@ def _filter_by_vocabulary(words: List[str], w2v_model: Word2VecKeyedVectors) ->
     return [word for word in words if word in w2v_model.vocab]
 
 
-def _extract_and_filter_words_from_text(text: str, w2v_model: Word2VecKeyedVectors) -> List[str]:
-    raw_list = _extract_words_from_text(text)
-    list_without_stopwords = _filter_stop_words(raw_list)
-    return _filter_by_vocabulary(list_without_stopwords, w2v_model)
-
-
 def _extract_summary_from_ncbi_desc_elem(elem: Dict):
     ret = ""
     if 'name' in elem:
@@ -44,33 +46,87 @@ def _extract_summary_from_ncbi_desc_elem(elem: Dict):
 
 def _extract_summary_from_ncbi_descs(gene_set: GeneSet) -> str:
     descs = [_extract_summary_from_ncbi_desc_elem(elem) for key, elem in gene_set.ncbi_gene_desc.gene_infos.items()]
-    return reduce(lambda a, b: a + " " + b, descs, "")
+    return "".join(" " + desc for desc in descs)
+
+
+# Tokenization, independent of the w2v model. Every text field of a gene set has its own tokenizer
+# so that the tokens can be cached per field (see gsd.distance.token_cache).
+
+def _tokenize_text(text: str) -> List[str]:
+    if not isinstance(text, str):
+        return []
+    return _filter_stop_words(_extract_words_from_text(text))
+
+
+def go_field(go_type: GOType, field: str) -> str:
+    return "go_%s_%s" % (go_type.value.lower(), field)
+
+
+def _go_texts(go_type: GOType, field: str) -> Callable[[GeneSet], List[str]]:
+    return lambda gene_set: list(getattr(go_type.select_category(gene_set.go_info), field))
+
+
+def _ncbi_texts(gene_set: GeneSet) -> List[str]:
+    return [_extract_summary_from_ncbi_desc_elem(elem) for elem in gene_set.ncbi_gene_desc.gene_infos.values()]
+
+
+# Per field: the texts a gene set consists of and the tokenizer of a single text. The tokens of a field are
+# the concatenated tokens of its texts, so texts shared by many gene sets (GO terms, genes) are tokenised once.
+TEXT_SOURCES = {
+    'gene_symbols': (lambda gene_set: list(gene_set.general_info.gene_symbols), lambda text: [text.lower()]),
+    'summary': (lambda gene_set: [gene_set.general_info.summary], _tokenize_text),
+    'ncbi_summary': (_ncbi_texts, _tokenize_text),
+}
+for _go_type in GOType:
+    for _field in ['names', 'definitions']:
+        TEXT_SOURCES[go_field(_go_type, _field)] = (_go_texts(_go_type, _field), _tokenize_text)
+
+
+def _field_tokenizer(field: str) -> Callable[[GeneSet], List[str]]:
+    texts, tokenize = TEXT_SOURCES[field]
+    return lambda gene_set: flat_list([tokenize(text) for text in texts(gene_set)])
+
+
+TEXT_FIELDS = {field: _field_tokenizer(field) for field in TEXT_SOURCES}
+
+
+def has_text_field(gene_set: GeneSet, field: str) -> bool:
+    return field != 'ncbi_summary' or getattr(gene_set, 'ncbi_gene_desc', None) is not None
+
+
+# Texts that belong to single genes rather than to whole gene sets, keyed by gene symbol or Entrez ID
+
+GENE_TEXT_SOURCES = {
+    'gene_symbols': lambda gene_set: {gene_sym: [gene_sym.lower()] for gene_sym in gene_set.general_info.gene_symbols},
+    'ncbi_summary': lambda gene_set: {str(key): _tokenize_text(_extract_summary_from_ncbi_desc_elem(elem))
+                                      for key, elem in gene_set.ncbi_gene_desc.gene_infos.items()},
+}
 
 
 # Data Extraction
 
 def extract_gene_symbols(gene_set: GeneSet, w2v_model: Word2VecKeyedVectors) -> List[str]:
-    return _filter_by_vocabulary([gene_sym.lower() for gene_sym in gene_set.general_info.gene_symbols], w2v_model)
+    return _filter_by_vocabulary(TEXT_FIELDS['gene_symbols'](gene_set), w2v_model)
 
 
 def extract_words_from_gene_set_summary(gene_set: GeneSet, w2v_model: Word2VecKeyedVectors) -> List[str]:
-    return _extract_and_filter_words_from_text(gene_set.general_info.summary, w2v_model)
+    return _filter_by_vocabulary(TEXT_FIELDS['summary'](gene_set), w2v_model)
 
 
 def extract_words_from_go_descriptions(
         gene_set: GeneSet,
         w2v_model: Word2VecKeyedVectors,
         go_filters: List[GOType]) -> List[str]:
-    descriptions = flat_list([go_filter.select_category(gene_set.go_info).definitions for go_filter in go_filters])
-    return flat_list([_extract_and_filter_words_from_text(description, w2v_model) for description in descriptions])
+    return _filter_by_vocabulary(
+        flat_list([TEXT_FIELDS[go_field(go_filter, 'definitions')](gene_set) for go_filter in go_filters]), w2v_model)
 
 
 def extract_words_from_go_names(
         gene_set: GeneSet,
         w2v_model: Word2VecKeyedVectors,
         go_filters: List[GOType]) -> List[str]:
-    names = flat_list([go_filter.select_category(gene_set.go_info).names for go_filter in go_filters])
-    return flat_list([_extract_and_filter_words_from_text(name, w2v_model) for name in names])
+    return _filter_by_vocabulary(
+        flat_list([TEXT_FIELDS[go_field(go_filter, 'names')](gene_set) for go_filter in go_filters]), w2v_model)
 
 
 def extract_words_from_gene_symbols_and_summary_and_go_info(
@@ -85,19 +141,99 @@ def extract_words_from_gene_symbols_and_summary_and_go_info(
 
 def extract_summary_from_ncbi_descs(gene_set: GeneSet,
                                     w2v_model: Word2VecKeyedVectors) -> List[str]:
-    return _extract_and_filter_words_from_text(_extract_summary_from_ncbi_descs(gene_set), w2v_model)
+    return _filter_by_vocabulary(TEXT_FIELDS['ncbi_summary'](gene_set), w2v_model)
+
+
+class TextExtractor:
+    """Vocabulary-filtered words of the given text fields, taken from a token cache when one is given"""
+
+    def __init__(self, fields: List[str], w2v_model: Word2VecKeyedVectors, token_cache=None):
+        self.fields = fields
+        self.w2v_model = w2v_model
+        self.token_cache = token_cache
+
+    @property
+    def key(self):
+        """Extractors with equal keys return the same words"""
+        return 'text', tuple(self.fields), id(self.w2v_model), id(self.token_cache)
+
+    def __call__(self, gene_set: GeneSet) -> List[str]:
+        words = []
+        for field in self.fields:
+            if self.token_cache is not None and self.token_cache.has(gene_set, field):
+                words.extend(self.token_cache.words(gene_set, field, self.w2v_model))
+            else:
+                words.extend(_filter_by_vocabulary(TEXT_FIELDS[field](gene_set), self.w2v_model))
+        return words
+
+
+# Model preparation
+
+def text_vocabulary(gene_sets: List[GeneSet]) -> Set[str]:
+    """All words any of the extractors can ask the w2v model for"""
+    vocabulary = set()
+    for gene_set in gene_sets:
+        for field, tokenizer in TEXT_FIELDS.items():
+            if has_text_field(gene_set, field):
+                vocabulary.update(tokenizer(gene_set))
+    return vocabulary
+
+
+def prune_w2v_model(w2v_model: Word2VecKeyedVectors,
+                    gene_sets: List[GeneSet],
+                    out_file: str) -> Word2VecKeyedVectors:
+    """
+    Saves the vectors of all words used by the given gene sets in gensim's native format.
+    The vectors are stored as a separate .npy file so that `load_w2v_model` can memory-map them.
+    """
+    vocabulary = text_vocabulary(gene_sets)
+    words = [word for word in w2v_model.index2word if word in vocabulary]
+
+    pruned_model = Word2VecKeyedVectors(w2v_model.vector_size)
+    if len(words) > 0:
+        pruned_model.add(words, w2v_model[words])
+
+    os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+    pruned_model.save(out_file, separately=['vectors'])
+    return pruned_model
+
+
+def load_w2v_model(model_file: str) -> Word2VecKeyedVectors:
+    return Word2VecKeyedVectors.load(model_file, mmap='r')
 
 
 # Distance similarities
 
-def cosine_distance_of(words_a: List[str], words_b: List[str], w2v_model: Word2VecKeyedVectors) -> float:
-    vectors_a = [w2v_model[word] for word in words_a]
-    vectors_b = [w2v_model[word] for word in words_b]
+def summed_embedding_of(words: List[str], w2v_model: Word2VecKeyedVectors) -> np.ndarray:
+    if len(words) == 0:
+        return np.zeros(w2v_model.vector_size)
+    return np.sum(w2v_model[words], axis=0, dtype=np.float64)
 
-    if len(vectors_a) == 0 or len(vectors_b) == 0:
+
+def cosine_distance_of(words_a: List[str], words_b: List[str], w2v_model: Word2VecKeyedVectors) -> float:
+    if len(words_a) == 0 or len(words_b) == 0:
         return np.nan
 
-    return cosine(reduce(lambda x, y: x + y, vectors_a), reduce(lambda x, y: x + y, vectors_b))
+    return cosine(summed_embedding_of(words_a, w2v_model), summed_embedding_of(words_b, w2v_model))
+
+
+def condensed_cosine_distances(embeddings: np.ndarray) -> np.ndarray:
+    """Pairwise cosine distances of the rows in condensed (pdist) order; rows of zeros yield NaN"""
+    norms = np.linalg.norm(embeddings, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized = embeddings / norms[:, np.newaxis]
+    normalized[norms == 0] = np.nan
+    n = len(embeddings)
+    result = np.zeros(n * (n - 1) // 2)
+    # blocks of rows against all rows, so only block_rows × n similarities exist at a time
+    block_rows = max(1, 2 ** 22 // max(n, 1))
+    for begin in range(0, n - 1, block_rows):
+        end = min(begin + block_rows, n - 1)
+        similarities = normalized[begin:end] @ normalized.T
+        for row in range(begin, end):
+            offset = n * row - row * (row + 1) // 2
+            result[offset:offset + n - row - 1] = 1.0 - similarities[row - begin, row + 1:]
+    return result
 
 
 def wm_distance_of(words_a: List[str], words_b: List[str], w2v_model: Word2VecKeyedVectors) -> float:
@@ -124,56 +260,172 @@ class NLPDistance(DistanceMetric):
         return self.name
 
     def calc(self, gene_sets: List[GeneSet]) -> np.ndarray:
-        def calc_path_distance(gene_set_a: GeneSet, gene_set_b: GeneSet):
-            gene_syms_a = self.extractor(gene_set_a)
-            gene_syms_b = self.extractor(gene_set_b)
+        words = [self.extractor(gene_set) for gene_set in gene_sets]
+        return calc_pairwise_distances(words, self.comparator)
+
+
+class EmbeddingCosineDistance(DistanceMetric):
+    """Cosine distance between the summed word vectors of each gene set, computed for all pairs at once"""
+
+    def __init__(self,
+                 name: str,
+                 extractor: Callable[[GeneSet], List[str]],
+                 w2v_model: Word2VecKeyedVectors):
+        self.name = name
+        self.extractor = extractor
+        self.w2v_model = w2v_model
+
+    @property
+    def display_name(self) -> str:
+        return self.name
+
+    def embed(self, gene_sets: List[GeneSet]) -> np.ndarray:
+        embeddings = np.zeros((len(gene_sets), self.w2v_model.vector_size))
+        for idx, gene_set in enumerate(gene_sets):
+            embeddings[idx] = summed_embedding_of(self.extractor(gene_set), self.w2v_model)
+        return embeddings
+
+    def calc(self, gene_sets: List[GeneSet]) -> np.ndarray:
+        return condensed_cosine_distances(self.embed(gene_sets))
+
+
+class GeneEmbeddingTable:
+    """Summed word vector and token count of every gene's text, rows are appended for unseen genes"""
+
+    def __init__(self, vector_size: int, keys: List[str] = None, vectors: np.ndarray = None, counts: np.ndarray = None):
+        self.keys = list(keys) if keys is not None else []
+        self.index = {key: row for row, key in enumerate(self.keys)}
+        self.vectors = np.asarray(vectors, dtype=np.float64) if vectors is not None else np.zeros((0, vector_size))
+        self.counts = np.asarray(counts, dtype=np.int64) if counts is not None else np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self, gene_tokens: Dict[str, List[str]], w2v_model: Word2VecKeyedVectors):
+        new_keys = [key for key in gene_tokens if key not in self.index]
+        if len(new_keys) == 0:
+            return
+        words = [_filter_by_vocabulary(gene_tokens[key], w2v_model) for key in new_keys]
+        vectors = np.array([summed_embedding_of(gene_words, w2v_model) for gene_words in words])
+        for key in new_keys:
+            self.index[key] = len(self.keys)
+            self.keys.append(key)
+        self.vectors = np.vstack([self.vectors, vectors.reshape(len(new_keys), self.vectors.shape[1])])
+        self.counts = np.concatenate([self.counts, [len(gene_words) for gene_words in words]])
+
+    def membership_matrix(self, gene_keys: List[List[str]]) -> csr_matrix:
+        indptr = np.zeros(len(gene_keys) + 1, dtype=np.int64)
+        np.cumsum([len(keys) for keys in gene_keys], out=indptr[1:])
+        indices = np.array([self.index[key] for keys in gene_keys for key in keys], dtype=np.int64)
+        return csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(gene_keys), len(self)))
+
+
+def save_gene_embeddings(tables: Dict[str, GeneEmbeddingTable], out_file: str):
+    columns = {}
+    for source, table in tables.items():
+        columns[source + '_keys'] = np.array(table.keys, dtype=str)
+        columns[source + '_vectors'] = table.vectors
+        columns[source + '_counts'] = table.counts
+    os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+    with open(out_file, "wb") as f:
+        np.savez(f, **columns)
+
+
+def load_gene_embeddings(embedding_file: str) -> Dict[str, GeneEmbeddingTable]:
+    with np.load(embedding_file) as npz:
+        return {source: GeneEmbeddingTable(npz[source + '_vectors'].shape[1],
+                                           npz[source + '_keys'].tolist(),
+                                           npz[source + '_vectors'],
+                                           npz[source + '_counts'])
+                for source in GENE_TEXT_SOURCES if source + '_keys' in npz.files}
+
+
+def build_gene_embeddings(gene_sets: List[GeneSet],
+                          w2v_model: Word2VecKeyedVectors,
+                          tables: Dict[str, GeneEmbeddingTable] = None) -> Dict[str, GeneEmbeddingTable]:
+    """Adds the embeddings of all genes of the given gene sets that are not part of `tables` yet"""
+    tables = tables if tables is not None else {}
+    for source, gene_texts in GENE_TEXT_SOURCES.items():
+        if not all(has_text_field(gene_set, source) for gene_set in gene_sets):
+            continue
+        table = tables.setdefault(source, GeneEmbeddingTable(w2v_model.vector_size))
+        for gene_set in gene_sets:
+            table.update(gene_texts(gene_set), w2v_model)
+    return tables
+
+
+class GeneEmbeddingCosineDistance(EmbeddingCosineDistance):
+    """
+    Cosine distance of gene sets whose text is the concatenation of per-gene texts. The summed
+    embedding of a gene set is the sum over its genes' embeddings (membership matrix x gene matrix),
+    so every gene is embedded only once, no matter how many gene sets contain it.
+    """
 
-            return self.comparator(gene_syms_a, gene_syms_b)
+    def __init__(self,
+                 name: str,
+                 source: str,
+                 w2v_model: Word2VecKeyedVectors,
+                 gene_embeddings: Dict[str, GeneEmbeddingTable] = None):
+        super().__init__(name, None, w2v_model)
+        self.source = source
+        self.gene_embeddings = gene_embeddings if gene_embeddings is not None else {}
 
-        return calc_pairwise_distances(gene_sets, calc_path_distance)
+    def embed(self, gene_sets: List[GeneSet]) -> np.ndarray:
+        table = self.gene_embeddings.setdefault(self.source, GeneEmbeddingTable(self.w2v_model.vector_size))
+        gene_texts = [GENE_TEXT_SOURCES[self.source](gene_set) for gene_set in gene_sets]
+        for texts in gene_texts:
+            table.update(texts, self.w2v_model)
+        return np.asarray(table.membership_matrix([list(texts) for texts in gene_texts]) @ table.vectors)
 
 
 NLP_DISTS = {
-    'Cosine_dist_over_gene_sym': lambda w2v_model: NLPDistance("Cosine distance over gene symbols W2V",
-                                                               lambda x, y: cosine_distance_of(x, y, w2v_model),
-                                                               lambda x: extract_gene_symbols(x, w2v_model)),
-
-    'Cosine_dist_over_summary': lambda w2v_model: NLPDistance("Cosine distance over over summary W2V",
-                                                              lambda x, y: cosine_distance_of(x, y, w2v_model),
-                                                              lambda x: extract_words_from_gene_set_summary(
-                                                                  x, w2v_model)),
-
-    'Cosine_dist_over_ncbi_sum': lambda w2v_model: NLPDistance("Cosine distance over over NCBI summary W2V",
-                                                               lambda x, y: cosine_distance_of(x, y, w2v_model),
-                                                               lambda x: extract_summary_from_ncbi_descs(
-                                                                   x, w2v_model)),
-
-    'Cosine_dist_over_go_bp_desc': lambda w2v_model: NLPDistance("Cosine distance GO BP description W2V",
-                                                                 lambda x, y: cosine_distance_of(x, y, w2v_model),
-                                                                 lambda x: extract_words_from_go_descriptions(
-                                                                     x, w2v_model, [GOType.BIOLOGICAL_PROCESS])),
-
-    'Cosine_dist_over_go_cc_desc': lambda w2v_model: NLPDistance("Cosine distance GO CC description W2V",
-                                                                 lambda x, y: cosine_distance_of(x, y, w2v_model),
-                                                                 lambda x: extract_words_from_go_descriptions(
-                                                                     x, w2v_model, [GOType.CELLULAR_COMPONENT])),
-
-    'Cosine_dist_over_go_mf_desc': lambda w2v_model: NLPDistance("Cosine distance GO MF description W2V",
-                                                                 lambda x, y: cosine_distance_of(x, y, w2v_model),
-                                                                 lambda x: extract_words_from_go_descriptions(
-                                                                     x, w2v_model, [GOType.MOLECULAR_FUNCTION])),
-
-    'WM_dist_over_gene_sym': lambda w2v_model: NLPDistance("WM distance over gene symbols W2V",
-                                                           lambda x, y: wm_distance_of(x, y, w2v_model),
-                                                           lambda x: extract_gene_symbols(x, w2v_model)),
-
-    'WM_dist_over_summary': lambda w2v_model: NLPDistance("WM distance over summary W2V",
-                                                          lambda x, y: wm_distance_of(x, y, w2v_model),
-                                                          lambda x: extract_words_from_gene_set_summary(x, w2v_model)),
-
-    # 'WM_dist_over_ncbi_summary': lambda w2v_model: NLPDistance("WM distance over over NCBI summary W2V",
-    #                                                            lambda x, y: wm_distance_of(x, y, w2v_model),
-    #                                                            lambda x: extract_summary_from_ncbi_descs(
-    #                                                                x, w2v_model)),
-
+    'Cosine_dist_over_gene_sym': lambda w2v_model, token_cache=None, gene_embeddings=None: GeneEmbeddingCosineDistance(
+        "Cosine distance over gene symbols W2V",
+        'gene_symbols',
+        w2v_model,
+        gene_embeddings),
+
+    'Cosine_dist_over_summary': lambda w2v_model, token_cache=None, gene_embeddings=None: EmbeddingCosineDistance(
+        "Cosine distance over over summary W2V",
+        TextExtractor(['summary'], w2v_model, token_cache),
+        w2v_model),
+
+    'Cosine_dist_over_ncbi_sum': lambda w2v_model, token_cache=None, gene_embeddings=None: GeneEmbeddingCosineDistance(
+        "Cosine distance over over NCBI summary W2V",
+        'ncbi_summary',
+        w2v_model,
+        gene_embeddings),
+
+    'Cosine_dist_over_go_bp_desc': lambda w2v_model, token_cache=None, gene_embeddings=None: EmbeddingCosineDistance(
+        "Cosine distance GO BP description W2V",
+        TextExtractor([go_field(GOType.BIOLOGICAL_PROCESS, 'definitions')], w2v_model, token_cache),
+        w2v_model),
+
+    'Cosine_dist_over_go_cc_desc': lambda w2v_model, token_cache=None, gene_embeddings=None: EmbeddingCosineDistance(
+        "Cosine distance GO CC description W2V",
+        TextExtractor([go_field(GOType.CELLULAR_COMPONENT, 'definitions')], w2v_model, token_cache),
+        w2v_model),
+
+    'Cosine_dist_over_go_mf_desc': lambda w2v_model, token_cache=None, gene_embeddings=None: EmbeddingCosineDistance(
+        "Cosine distance GO MF description W2V",
+        TextExtractor([go_field(GOType.MOLECULAR_FUNCTION, 'definitions')], w2v_model, token_cache),
+        w2v_model),
+
+    'WM_dist_over_gene_sym': lambda w2v_model, token_cache=None, gene_embeddings=None, threads=1: WMDistance(
+        "WM distance over gene symbols W2V",
+        TextExtractor(['gene_symbols'], w2v_model, token_cache),
+        w2v_model,
+        n_jobs=threads),
+
+    'WM_dist_over_summary': lambda w2v_model, token_cache=None, gene_embeddings=None, threads=1: WMDistance(
+        "WM distance over summary W2V",
+        TextExtractor(['summary'], w2v_model, token_cache),
+        w2v_model,
+        n_jobs=threads),
+
+    'WM_dist_over_ncbi_summary': lambda w2v_model, token_cache=None, gene_embeddings=None, threads=1: WMDistance(
+        "WM distance over over NCBI summary W2V",
+        TextExtractor(['ncbi_summary'], w2v_model, token_cache),
+        w2v_model,
+        n_jobs=threads),
 }
@@ -0,0 +1,363 @@
+import argparse
+import os
+from typing import List, Iterable, Callable, Dict, Iterator
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from gsd.distance import DistanceMetric
+from gsd.distance.progress import Progress
+from gsd.gene_sets import GeneSet, GeneSetInfo, GOInfo, GOAnnotationIndex
+
+# Null model of an evaluation target: batches of random gene sets with the sizes of the target's gene sets,
+# drawn without replacement from a gene universe. With strata (e.g. PPI degree or GO annotation count bins)
+# every gene of a target gene set is replaced by a random gene of its own stratum, so the random sets keep
+# the degree / annotation profile of the originals.
+#
+# A batch of R replicates of n gene sets is one CSR membership matrix (R * n rows, replicate-major, columns
+# index the universe). Kernels turn a batch into an R × n_pairs array of condensed distances; the gene
+# overlap kernels need a single sparse product per batch, so thousands of replicates stay cheap.
+
+
+class NullBatch:
+    def __init__(self, membership: csr_matrix, n_replicates: int, n_sets: int):
+        self.membership = membership
+        self.n_replicates = n_replicates
+        self.n_sets = n_sets
+        self._intersections = None
+
+    @property
+    def set_sizes(self) -> np.ndarray:
+        """Gene set sizes, n_replicates × n_sets"""
+        return np.diff(self.membership.indptr).reshape(self.n_replicates, self.n_sets)
+
+    @property
+    def n_genes(self) -> np.ndarray:
+        """Distinct genes of every replicate, i.e. the columns of its binary gene matrix"""
+        n_universe = self.membership.shape[1]
+        replicates = np.repeat(np.arange(self.n_replicates), np.diff(self.membership.indptr[::self.n_sets]))
+        used = np.bincount(replicates * n_universe + self.membership.indices, minlength=self.n_replicates * n_universe)
+        return (used.reshape(self.n_replicates, n_universe) > 0).sum(axis=1)
+
+    def intersections(self) -> np.ndarray:
+        """Shared genes of all gene set pairs, n_replicates × n_pairs in condensed order"""
+        if self._intersections is None:
+            n, n_universe = self.n_sets, self.membership.shape[1]
+            # shifting the columns of every replicate apart keeps the product block diagonal
+            rows = np.repeat(np.arange(self.membership.shape[0]), np.diff(self.membership.indptr))
+            columns = (rows // n) * n_universe + self.membership.indices
+            shifted = csr_matrix((np.ones(len(rows), dtype=np.int64), columns, self.membership.indptr),
+                                 shape=(self.membership.shape[0], self.n_replicates * n_universe))
+            product = (shifted @ shifted.T).tocoo()
+            i, j = product.row % n, product.col % n
+            upper = i < j
+            i, j = i[upper], j[upper]
+            self._intersections = np.zeros((self.n_replicates, n * (n - 1) // 2), dtype=np.int64)
+            self._intersections[product.row[upper] // n, n * i - i * (i + 1) // 2 + j - i - 1] = product.data[upper]
+        return self._intersections
+
+    def gene_ids(self, universe: np.ndarray, replicate: int) -> List[np.ndarray]:
+        begin = replicate * self.n_sets
+        return [universe[self.membership.indices[self.membership.indptr[idx]:self.membership.indptr[idx + 1]]]
+                for idx in range(begin, begin + self.n_sets)]
+
+
+class NullModel:
+    def __init__(self, set_genes: List[Iterable[int]], universe: Iterable[int] = None, strata: np.ndarray = None):
+        """
+        :param set_genes: Entrez gene ids of the target's gene sets
+        :param universe: genes to draw from, the target's genes are always part of it
+        :param strata: stratum label of every gene of `universe`, None for plain size matching
+        """
+        set_genes = [np.unique(np.fromiter(genes, dtype=np.int64)) for genes in set_genes]
+        all_genes = np.concatenate(set_genes) if set_genes else np.zeros(0, dtype=np.int64)
+        if universe is None:
+            self.universe = np.unique(all_genes)
+        else:
+            self.universe = np.asarray(universe, dtype=np.int64)
+            if not np.all(self.universe[1:] > self.universe[:-1]):
+                raise ValueError("The universe must be sorted and unique")
+        positions = np.searchsorted(self.universe, all_genes)
+        if len(all_genes) and (positions.max() >= len(self.universe) or
+                               np.any(self.universe[np.minimum(positions, len(self.universe) - 1)] != all_genes)):
+            raise ValueError("Genes of the target are missing in the universe")
+        strata = np.zeros(len(self.universe), dtype=np.int64) if strata is None else np.asarray(strata)
+        if len(strata) != len(self.universe):
+            raise ValueError("Expected one stratum per universe gene, got %d for %d genes"
+                             % (len(strata), len(self.universe)))
+
+        self.set_sizes = np.array([len(genes) for genes in set_genes], dtype=np.int64)
+        labels, self.strata = np.unique(strata, return_inverse=True)
+        self.stratum_genes = np.argsort(self.strata, kind='stable')
+        stratum_sizes = np.bincount(self.strata, minlength=len(labels))
+        self.stratum_offsets = np.r_[0, np.cumsum(stratum_sizes)[:-1]]
+        self.stratum_sizes = stratum_sizes
+        # the stratum every gene of the target stands for
+        self.slot_strata = self.strata[positions]
+        self.target_positions = positions
+
+    def __len__(self):
+        return len(self.set_sizes)
+
+    def observed(self) -> NullBatch:
+        """The target's gene sets themselves as a batch of one replicate"""
+        indptr = np.r_[0, np.cumsum(self.set_sizes)]
+        membership = csr_matrix((np.ones(len(self.target_positions)), self.target_positions, indptr),
+                                shape=(len(self), len(self.universe)))
+        return NullBatch(membership, 1, len(self))
+
+    def sample(self, random: np.random.RandomState, n_replicates: int = 1) -> NullBatch:
+        """
+        Draws all gene sets of `n_replicates` replicates at once. Genes are drawn with replacement from their
+        slot's stratum, and slots holding a gene already drawn for the same gene set are redrawn until every
+        set is duplicate free, which gives a uniform sample without replacement per stratum.
+        """
+        n_universe = len(self.universe)
+        strata = np.tile(self.slot_strata, n_replicates)
+        rows = np.repeat(np.arange(n_replicates * len(self)), np.tile(self.set_sizes, n_replicates))
+        genes = np.zeros(len(strata), dtype=np.int64)
+        pending = np.arange(len(strata))
+        while len(pending):
+            pending_strata = strata[pending]
+            picks = (random.random_sample(len(pending)) * self.stratum_sizes[pending_strata]).astype(np.int64)
+            genes[pending] = self.stratum_genes[self.stratum_offsets[pending_strata] + picks]
+            keys = rows * n_universe + genes
+            order = np.argsort(keys, kind='stable')
+            duplicate = np.zeros(len(keys), dtype=bool)
+            duplicate[order[1:]] = keys[order[1:]] == keys[order[:-1]]
+            pending = np.flatnonzero(duplicate)
+
+        keys = rows * n_universe + genes
+        indptr = np.r_[0, np.cumsum(np.tile(self.set_sizes, n_replicates))]
+        membership = csr_matrix((np.ones(len(genes)), np.sort(keys) % n_universe, indptr),
+                                shape=(n_replicates * len(self), n_universe))
+        return NullBatch(membership, n_replicates, len(self))
+
+    def batches(self, n_replicates: int, seed: int = 0, batch_size: int = 100) -> Iterator[NullBatch]:
+        """Batches of at most `batch_size` replicates, each drawn with its own seed [seed, batch]"""
+        for batch, start in enumerate(range(0, n_replicates, batch_size)):
+            yield self.sample(np.random.RandomState([seed, batch]), min(batch_size, n_replicates - start))
+
+
+def _gene_ids_of(gene_sets: List[GeneSet]) -> List[np.ndarray]:
+    return [np.fromiter(gene_set.general_info.entrez_gene_ids, dtype=np.int64) for gene_set in gene_sets]
+
+
+def _universe_of(set_genes: List[np.ndarray], *backgrounds: Iterable[int]) -> np.ndarray:
+    genes = list(set_genes) + [np.fromiter(background, dtype=np.int64) for background in backgrounds]
+    return np.unique(np.concatenate(genes)) if genes else np.zeros(0, dtype=np.int64)
+
+
+def quantile_strata(values: np.ndarray, n_bins: int = 10) -> np.ndarray:
+    """Bins of (roughly) equal frequency, tied values always share a bin"""
+    edges = np.unique(np.quantile(values, np.linspace(0, 1, n_bins + 1)[1:-1])) if len(values) else []
+    return np.searchsorted(edges, values, side='right')
+
+
+def _lookup_counts(universe: np.ndarray, genes: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    positions = np.minimum(np.searchsorted(genes, universe), max(len(genes) - 1, 0))
+    if len(genes) == 0:
+        return np.zeros(len(universe), dtype=np.int64)
+    return np.where(genes[positions] == universe, counts[positions], 0)
+
+
+def ppi_degrees(universe: np.ndarray, ppi_data) -> np.ndarray:
+    """Interactions of every universe gene in a PPI table with FromId/ToId columns"""
+    genes, counts = np.unique(np.concatenate([np.asarray(ppi_data['FromId'], dtype=np.int64),
+                                              np.asarray(ppi_data['ToId'], dtype=np.int64)]), return_counts=True)
+    return _lookup_counts(universe, genes, counts)
+
+
+def go_annotation_counts(universe: np.ndarray, go_index: GOAnnotationIndex) -> np.ndarray:
+    """GO annotations of every universe gene"""
+    return _lookup_counts(universe, np.asarray(go_index.genes, dtype=np.int64), np.diff(go_index.offsets))
+
+
+def size_matched_null_model(gene_sets: List[GeneSet], background: Iterable[int] = ()) -> NullModel:
+    set_genes = _gene_ids_of(gene_sets)
+    return NullModel(set_genes, _universe_of(set_genes, background))
+
+
+def degree_matched_null_model(gene_sets: List[GeneSet],
+                              ppi_data,
+                              n_bins: int = 10,
+                              background: Iterable[int] = ()) -> NullModel:
+    set_genes = _gene_ids_of(gene_sets)
+    universe = _universe_of(set_genes, background, ppi_data['FromId'], ppi_data['ToId'])
+    return NullModel(set_genes, universe, quantile_strata(ppi_degrees(universe, ppi_data), n_bins))
+
+
+def annotation_matched_null_model(gene_sets: List[GeneSet],
+                                  go_index: GOAnnotationIndex,
+                                  n_bins: int = 10,
+                                  background: Iterable[int] = ()) -> NullModel:
+    set_genes = _gene_ids_of(gene_sets)
+    universe = _universe_of(set_genes, background, go_index.genes)
+    return NullModel(set_genes, universe, quantile_strata(go_annotation_counts(universe, go_index), n_bins))
+
+
+# Kernels: NullBatch -> n_replicates × n_pairs condensed distances
+
+def gene_overlap_kernel(distance: Callable[[np.ndarray, np.ndarray, np.ndarray, np.ndarray], np.ndarray]) \
+        -> Callable[[NullBatch], np.ndarray]:
+    """`distance(intersections, sizes_a, sizes_b, n_genes)` over the binary gene matrix of every replicate"""
+
+    def kernel(batch: NullBatch) -> np.ndarray:
+        i, j = np.triu_indices(batch.n_sets, 1)
+        sizes = batch.set_sizes.astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return distance(batch.intersections().astype(float), sizes[:, i], sizes[:, j],
+                            batch.n_genes.astype(float)[:, np.newaxis])
+
+    return kernel
+
+
+def _kappa_distance(intersections, sizes_a, sizes_b, n_genes):
+    observed = (n_genes - sizes_a - sizes_b + 2 * intersections) / n_genes
+    expected = (sizes_a * sizes_b + (n_genes - sizes_a) * (n_genes - sizes_b)) / n_genes ** 2
+    return 1 - (observed - expected) / (1 - expected)
+
+
+# the gene based metrics of GENERAL_DISTS, keyed like the registry
+GENE_KERNELS = {
+    'Minkowski_distance_p1_over_genes': gene_overlap_kernel(
+        lambda intersections, a, b, n: a + b - 2 * intersections),
+    'Minkowski_distance_p2_over_genes': gene_overlap_kernel(
+        lambda intersections, a, b, n: np.sqrt(a + b - 2 * intersections)),
+    'Jaccard_distance_over_genes': gene_overlap_kernel(
+        lambda intersections, a, b, n: (a + b - 2 * intersections) / (a + b - intersections)),
+    'Kappa_distance_over_genes': gene_overlap_kernel(_kappa_distance),
+    'Overlap_distance_over_genes': gene_overlap_kernel(
+        lambda intersections, a, b, n: 1 - intersections / np.minimum(a, b)),
+}
+
+
+def embedding_cosine_kernel(gene_vectors: np.ndarray) -> Callable[[NullBatch], np.ndarray]:
+    """Cosine distance of summed gene vectors, `gene_vectors` has one row per universe gene"""
+
+    def kernel(batch: NullBatch) -> np.ndarray:
+        embeddings = np.asarray(batch.membership @ gene_vectors).reshape(batch.n_replicates, batch.n_sets, -1)
+        norms = np.linalg.norm(embeddings, axis=2, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalized = embeddings / norms
+        i, j = np.triu_indices(batch.n_sets, 1)
+        return 1.0 - np.matmul(normalized, normalized.transpose(0, 2, 1))[:, i, j]
+
+    return kernel
+
+
+def universe_gene_vectors(universe: np.ndarray, table) -> np.ndarray:
+    """Rows of a GeneEmbeddingTable keyed by Entrez gene id (e.g. NCBI summaries), zeros for unknown genes"""
+    rows = np.array([table.index.get(str(gene), -1) for gene in universe.tolist()], dtype=np.int64)
+    vectors = np.zeros((len(universe), table.vectors.shape[1]))
+    vectors[rows >= 0] = table.vectors[rows[rows >= 0]]
+    return vectors
+
+
+def gene_set_kernel(metric: DistanceMetric,
+                    universe: np.ndarray,
+                    go_index: GOAnnotationIndex = None) -> Callable[[NullBatch], np.ndarray]:
+    """
+    Fallback for metrics without a kernel: every replicate is turned into GeneSets and passed to `metric`.
+    Only gene ids (and GO annotations if `go_index` is given) are known for random gene sets.
+    """
+
+    def kernel(batch: NullBatch) -> np.ndarray:
+        results = []
+        for replicate in range(batch.n_replicates):
+            gene_sets = [GeneSet(GeneSetInfo("random_%d" % idx, None, None, np.nan, True, genes, []),
+                                 GOInfo(genes, go_index) if go_index is not None else None)
+                         for idx, genes in enumerate(batch.gene_ids(universe, replicate))]
+            results.append(metric.calc(gene_sets))
+        return np.array(results, dtype=float).reshape(batch.n_replicates, -1)
+
+    return kernel
+
+
+def null_distribution(model: NullModel,
+                      kernel: Callable[[NullBatch], np.ndarray],
+                      n_replicates: int = 1000,
+                      seed: int = 0,
+                      batch_size: int = 100) -> np.ndarray:
+    """Null distances of all pairs, n_replicates × n_pairs"""
+    with Progress("Null model", n_replicates) as progress:
+        results = []
+        for batch in model.batches(n_replicates, seed, batch_size):
+            results.append(kernel(batch))
+            progress.update(batch.n_replicates)
+    return np.vstack(results) if results else np.zeros((0, len(model) * (len(model) - 1) // 2))
+
+
+def empirical_null(observed: np.ndarray,
+                   model: NullModel,
+                   kernel: Callable[[NullBatch], np.ndarray],
+                   n_replicates: int = 1000,
+                   seed: int = 0,
+                   batch_size: int = 100) -> Dict[str, np.ndarray]:
+    """
+    Mean and standard deviation of the null distances of every pair and the empirical p-value of the observed
+    distance, (1 + #null <= observed) / (1 + #null), ignoring NaN replicates. Only per pair sums are kept.
+    """
+    observed = np.asarray(observed, dtype=float)
+    count = np.zeros(len(observed))
+    total = np.zeros(len(observed))
+    total_sq = np.zeros(len(observed))
+    at_most = np.zeros(len(observed))
+    with Progress("Null model", n_replicates) as progress:
+        for batch in model.batches(n_replicates, seed, batch_size):
+            null = kernel(batch)
+            valid = ~np.isnan(null)
+            count += valid.sum(axis=0)
+            total += np.where(valid, null, 0).sum(axis=0)
+            total_sq += np.where(valid, null ** 2, 0).sum(axis=0)
+            at_most += (valid & (null <= observed + 1e-12)).sum(axis=0)
+            progress.update(batch.n_replicates)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum(total_sq / count - mean ** 2, 0))
+    p_values = (1 + at_most) / (1 + count)
+    p_values[np.isnan(observed)] = np.nan
+    return {'mean': mean, 'std': std, 'p_values': p_values, 'replicates': count}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Empirical null distributions of the gene based distances")
+    parser.add_argument("store_file", help="gene_sets.npz of the evaluation target")
+    parser.add_argument("out_file", help=".npz with mean, std and p-values of every metric")
+    parser.add_argument("--metrics", nargs="+", default=list(GENE_KERNELS), choices=list(GENE_KERNELS))
+    parser.add_argument("--replicates", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--bins", type=int, default=10)
+    parser.add_argument("--ppi-file", help="keep the PPI degree profile of the gene sets")
+    parser.add_argument("--tax-id", type=int, default=9606)
+    parser.add_argument("--go-anno", nargs=2, metavar=("ENTREZGENE2GO", "GO"),
+                        help="keep the GO annotation count profile of the gene sets")
+    args = parser.parse_args(args)
+
+    from gsd.gene_set_store import load_gene_set_store
+    gene_sets = load_gene_set_store(args.store_file)
+    if args.ppi_file is not None:
+        from gsd.distance.ppi import load_ppi_mitab
+        model = degree_matched_null_model(gene_sets, load_ppi_mitab(args.ppi_file, args.tax_id), args.bins)
+    elif args.go_anno is not None:
+        from gsd.gene_sets import read_go_anno_df
+        model = annotation_matched_null_model(gene_sets, GOAnnotationIndex(read_go_anno_df(*args.go_anno)), args.bins)
+    else:
+        model = size_matched_null_model(gene_sets)
+
+    columns = {'names': np.array([gene_set.general_info.name for gene_set in gene_sets], dtype=str)}
+    for key in args.metrics:
+        observed = GENE_KERNELS[key](model.observed())[0]
+        for name, values in empirical_null(observed, model, GENE_KERNELS[key], args.replicates, args.seed,
+                                           args.batch_size).items():
+            columns['%s_%s' % (key, name)] = values
+        columns[key + '_observed'] = observed
+    os.makedirs(os.path.dirname(args.out_file) or ".", exist_ok=True)
+    with open(args.out_file, "wb") as f:
+        np.savez(f, **columns)
+
+
+if __name__ == '__main__':
+    main()
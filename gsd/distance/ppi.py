@@ -6,9 +6,9 @@ from scipy.sparse.csgraph import shortest_path
 from statistics import mean
 
 from scipy.spatial.distance import pdist
-from tqdm import tqdm
 
 from gsd.distance import DistanceMetric, calc_pairwise_distances
+from gsd.distance.progress import Progress
 from gsd.distance.general import to_binary_matrix
 from gsd.gene_sets import GeneSet
 
@@ -40,10 +40,11 @@ class ShortestPathPPI(DistanceMetric):
         self.nodes_mapping = dict(zip(nodes, range(0, len(nodes))))
         dist_matrix = np.zeros((len(self.nodes_mapping), len(self.nodes_mapping)))
 
-        for index, row in tqdm(ppi_data.iterrows(), total=ppi_data.shape[0]):
-            from_idx = self.nodes_mapping[row['FromId']]
-            to_idx = self.nodes_mapping[row['ToId']]
-            dist_matrix[from_idx][to_idx] = 1
+        with Progress("PPI graph", ppi_data.shape[0]) as progress:
+            from_idx = [self.nodes_mapping[node] for node in ppi_data['FromId']]
+            to_idx = [self.nodes_mapping[node] for node in ppi_data['ToId']]
+            dist_matrix[from_idx, to_idx] = 1
+            progress.update(ppi_data.shape[0])
 
         self.graph = csr_matrix(dist_matrix)
 
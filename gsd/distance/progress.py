@@ -0,0 +1,241 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+# Progress reporting of long running calculations. The engine opens a `Progress` per phase and reports
+# finished tiles (e.g. one row of a pairwise distance matrix) and processed pairs; the installed hook
+# receives the events. Progress events are sampled: at most one per `sample_interval` seconds, each carrying
+# the last finished tile and how long it took.
+
+PHASE_STARTED = 'phase_started'
+PROGRESS = 'progress'
+PHASE_FINISHED = 'phase_finished'
+
+
+class ProgressEvent:
+    def __init__(self,
+                 kind: str,
+                 phase: str,
+                 done: int,
+                 total: int,
+                 elapsed: float,
+                 labels: Dict[str, str],
+                 tile: int = None,
+                 tile_seconds: float = None):
+        self.kind = kind
+        self.phase = phase
+        self.done = done
+        self.total = total
+        self.elapsed = elapsed
+        self.labels = labels
+        self.tile = tile
+        self.tile_seconds = tile_seconds
+
+    def __repr__(self):
+        return "ProgressEvent(kind=%s, phase=%s, done=%d, total=%s)" % (self.kind, self.phase, self.done, self.total)
+
+    @property
+    def rate(self) -> float:
+        """Processed units (pairs) per second"""
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> float:
+        """Estimated seconds until the phase is finished, None if unknown"""
+        if self.total is None or self.done == 0:
+            return None
+        return (self.total - self.done) / self.rate if self.rate > 0 else None
+
+    def to_dict(self) -> Dict:
+        return {'event': self.kind, 'phase': self.phase, 'done': self.done, 'total': self.total,
+                'elapsed': self.elapsed, 'rate': self.rate, 'eta': self.eta, 'tile': self.tile,
+                'tile_seconds': self.tile_seconds, 'labels': self.labels, 'time': time.time()}
+
+
+class ProgressHook:
+    """Receives progress events, this base class ignores all of them"""
+
+    def handle(self, event: ProgressEvent):
+        pass
+
+
+class TqdmProgress(ProgressHook):
+    """One tqdm bar per phase"""
+
+    def __init__(self):
+        self.bars = {}
+
+    def handle(self, event: ProgressEvent):
+        from tqdm import tqdm
+
+        key = (event.phase, threading.get_ident())
+        if event.kind == PHASE_STARTED:
+            self.bars[key] = tqdm(total=event.total, desc=event.phase)
+        elif event.kind in (PROGRESS, PHASE_FINISHED) and key in self.bars:
+            bar = self.bars[key]
+            bar.update(event.done - bar.n)
+            if event.kind == PHASE_FINISHED:
+                bar.close()
+                del self.bars[key]
+
+
+class JsonLinesProgress(ProgressHook):
+    """Appends one JSON object per event to a file"""
+
+    def __init__(self, out_file: str):
+        self.out_file = out_file
+        self.lock = threading.Lock()
+
+    def handle(self, event: ProgressEvent):
+        with self.lock, open(self.out_file, "a") as f:
+            f.write(json.dumps(event.to_dict()) + "\n")
+
+
+class PrometheusTextfileProgress(ProgressHook):
+    """
+    Keeps the state of every phase in a Prometheus textfile (for the node exporter's textfile collector).
+    The file is replaced atomically on every progress event.
+    """
+
+    def __init__(self, out_file: str, prefix: str = "gsd"):
+        self.out_file = out_file
+        self.prefix = prefix
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _labels(event: ProgressEvent) -> str:
+        labels = dict(event.labels, phase=event.phase)
+        return ",".join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for key, value in sorted(labels.items()))
+
+    def handle(self, event: ProgressEvent):
+        with self.lock:
+            self.phases[self._labels(event)] = event
+            self._write()
+
+    def _write(self):
+        metrics = [('pairs_done', 'Processed pairs', lambda event: event.done),
+                   ('pairs_total', 'Pairs of the phase', lambda event: event.total),
+                   ('pairs_per_second', 'Processing rate', lambda event: event.rate),
+                   ('eta_seconds', 'Estimated seconds until the phase is finished', lambda event: event.eta),
+                   ('phase_seconds', 'Elapsed seconds of the phase', lambda event: event.elapsed),
+                   ('phase_finished', 'Whether the phase is finished', lambda event: int(event.kind == PHASE_FINISHED))]
+        lines = []
+        for name, help_text, value in metrics:
+            lines.append("# HELP %s_%s %s" % (self.prefix, name, help_text))
+            lines.append("# TYPE %s_%s gauge" % (self.prefix, name))
+            for labels, event in self.phases.items():
+                if value(event) is not None:
+                    lines.append("%s_%s{%s} %s" % (self.prefix, name, labels, float(value(event))))
+        tmp_file = "%s.%d.tmp" % (self.out_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, self.out_file)
+
+
+class CompositeProgress(ProgressHook):
+    def __init__(self, hooks: List[ProgressHook]):
+        self.hooks = hooks
+
+    def handle(self, event: ProgressEvent):
+        for hook in self.hooks:
+            hook.handle(event)
+
+
+class _Settings(threading.local):
+    def __init__(self):
+        self.labels = {}
+
+
+_hook = TqdmProgress()
+_sample_interval = 1.0
+_settings = _Settings()
+
+
+def set_progress_hook(hook: ProgressHook, sample_interval: float = None):
+    global _hook, _sample_interval
+    _hook = hook
+    if sample_interval is not None:
+        _sample_interval = sample_interval
+
+
+def progress_hook() -> ProgressHook:
+    return _hook
+
+
+def progress_hook_from_spec(spec: str) -> ProgressHook:
+    """`tqdm`, `none`, `jsonl:<file>` or `prometheus:<file>`, comma separated for several hooks"""
+    hooks = []
+    for part in spec.split(","):
+        kind, _, out_file = part.partition(":")
+        if kind == 'tqdm':
+            hooks.append(TqdmProgress())
+        elif kind == 'none':
+            hooks.append(ProgressHook())
+        elif kind == 'jsonl' and out_file:
+            hooks.append(JsonLinesProgress(out_file))
+        elif kind == 'prometheus' and out_file:
+            hooks.append(PrometheusTextfileProgress(out_file))
+        else:
+            raise ValueError("Unknown progress hook %s" % part)
+    return hooks[0] if len(hooks) == 1 else CompositeProgress(hooks)
+
+
+@contextmanager
+def progress_labels(**labels):
+    """Attaches labels (e.g. the metric) to all events emitted by this thread within the block"""
+    previous = _settings.labels
+    _settings.labels = dict(previous, **labels)
+    try:
+        yield
+    finally:
+        _settings.labels = previous
+
+
+class Progress:
+    """Progress of one phase, to be used as a context manager"""
+
+    def __init__(self, phase: str, total: int = None, hook: ProgressHook = None, sample_interval: float = None):
+        self.phase = phase
+        self.total = total
+        self.hook = hook or _hook
+        self.sample_interval = sample_interval if sample_interval is not None else _sample_interval
+        self.labels = dict(_settings.labels)
+        self.done = 0
+        self.time_begin = None
+        self.last_emitted = None
+        self.tile_begin = None
+        self.last_tile = None
+        self.last_tile_seconds = None
+
+    def _emit(self, kind: str):
+        self.hook.handle(ProgressEvent(kind, self.phase, self.done, self.total, time.time() - self.time_begin,
+                                       self.labels, self.last_tile, self.last_tile_seconds))
+
+    def __enter__(self):
+        self.time_begin = self.last_emitted = time.time()
+        self._emit(PHASE_STARTED)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._emit(PHASE_FINISHED)
+
+    def update(self, n: int = 1):
+        self.done += n
+        now = time.time()
+        if now - self.last_emitted >= self.sample_interval:
+            self.last_emitted = now
+            self._emit(PROGRESS)
+
+    def tile_started(self, tile: int):
+        self.tile_begin = time.time()
+
+    def tile_finished(self, tile: int, n: int):
+        """Counts the `n` pairs of the tile, its timing goes out with the next sampled progress event"""
+        self.last_tile = tile
+        self.last_tile_seconds = time.time() - self.tile_begin if self.tile_begin is not None else None
+        self.update(n)
@@ -0,0 +1,186 @@
+import argparse
+import os
+import time
+from typing import List, Tuple, Dict, Any
+
+from gsd.distance import DistanceMetric, persist_evaluation
+from gsd.distance.progress import progress_labels, set_progress_hook, progress_hook_from_spec
+from gsd.gene_set_store import load_gene_set_store
+from gsd.gene_sets import GeneSet
+from gsd.registry import metric_keys, metric_spec
+
+# Computes several metrics of one evaluation target in a single process. Gene sets and heavy resources
+# (w2v model, PPI network) are loaded once, and metrics with the same feature extractor share its output.
+# Metrics are addressed as "<category>/<key>" with the keys of the category's registry, results are written
+# to <out_dir>/<category>/<key>/<evaluation_target>.json like the per-metric Snakefile rules do. Metrics and
+# their required resources are looked up in gsd.registry, only the modules of requested categories are imported.
+
+
+class Resources:
+    """Inputs of the metric factories, each loaded on first use"""
+
+    def __init__(self,
+                 store_file: str = None,
+                 w2v_file: str = None,
+                 token_file: str = None,
+                 gene_embedding_file: str = None,
+                 ppi_file: str = None,
+                 tax_id: int = 9606,
+                 threads: int = 1):
+        self.store_file = store_file
+        self.w2v_file = w2v_file
+        self.token_file = token_file
+        self.gene_embedding_file = gene_embedding_file
+        self.ppi_file = ppi_file
+        self.tax_id = tax_id
+        self.n_threads = threads
+        self.loaded = {}
+
+    def _load(self, name: str, loader):
+        if name not in self.loaded:
+            time_begin = time.time()
+            self.loaded[name] = loader()
+            print("Loaded %s in %.1fs" % (name, time.time() - time_begin))
+        return self.loaded[name]
+
+    def w2v_model(self):
+        from gsd.distance.nlp import load_w2v_model
+        return self._load('w2v model', lambda: load_w2v_model(self.w2v_file))
+
+    def token_cache(self):
+        if self.token_file is None:
+            return None
+        from gsd.distance.token_cache import load_token_cache
+        return self._load('token cache', lambda: load_token_cache(self.token_file, self.store_file))
+
+    def gene_embeddings(self):
+        if self.gene_embedding_file is None:
+            return None
+        from gsd.distance.nlp import load_gene_embeddings
+        return self._load('gene embeddings', lambda: load_gene_embeddings(self.gene_embedding_file))
+
+    def ppi_data(self):
+        from gsd.distance.ppi import load_ppi_mitab
+        return self._load('PPI data', lambda: load_ppi_mitab(self.ppi_file, self.tax_id))
+
+    def threads(self) -> int:
+        # worker processes a metric may start, e.g. the threads of the Snakemake rule
+        return self.n_threads
+
+    def go_data(self):
+        from gsd.distance.go import GOData
+        return self._load('GO data', GOData)
+
+
+def create_metric(metric_id: str, resources: Resources) -> DistanceMetric:
+    return metric_spec(metric_id).create(resources)
+
+
+def expand_metric_ids(metric_ids: List[str]) -> List[str]:
+    """Replaces bare categories by all metrics of their registry"""
+    expanded = []
+    for metric_id in metric_ids:
+        if '/' in metric_id:
+            expanded.append(metric_id)
+        else:
+            expanded.extend("%s/%s" % (metric_id, key) for key in metric_keys(metric_id))
+    return expanded
+
+
+class _SharedExtractor:
+    """Remembers the features extracted for an argument (a gene set or a list of gene sets)"""
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.features = {}
+        self.elapsed = 0.0
+
+    def __call__(self, arg):
+        if id(arg) not in self.features:
+            time_begin = time.time()
+            self.features[id(arg)] = (arg, self.extractor(arg))
+            self.elapsed += time.time() - time_begin
+        return self.features[id(arg)][1]
+
+
+def _extractor_key(metric: DistanceMetric):
+    extractor = getattr(metric, 'extractor', None)
+    if extractor is None:
+        return None
+    return getattr(extractor, 'key', extractor)
+
+
+def schedule(metric_ids: List[str], metrics: List[DistanceMetric]) -> List[List[Tuple[str, DistanceMetric]]]:
+    """Groups metrics with the same feature extractor and lets every group share one extractor"""
+    groups = {}
+    for metric_id, metric in zip(metric_ids, metrics):
+        key = _extractor_key(metric)
+        groups.setdefault(key if key is not None else metric_id, []).append((metric_id, metric))
+
+    for key, group in groups.items():
+        if len(group) > 1 and _extractor_key(group[0][1]) is not None:
+            shared = _SharedExtractor(group[0][1].extractor)
+            for metric_id, metric in group:
+                metric.extractor = shared
+    return list(groups.values())
+
+
+def run_metrics(store_file: str,
+                evaluation_target: str,
+                metric_ids: List[str],
+                out_dir: str = "experiment_data",
+                resources: Resources = None,
+                gene_sets: List[GeneSet] = None) -> Dict[str, str]:
+    """Evaluates all metrics on one target and returns the written result file of every metric"""
+    resources = resources or Resources(store_file)
+    gene_sets = gene_sets if gene_sets is not None else load_gene_set_store(store_file)
+    metrics = [create_metric(metric_id, resources) for metric_id in metric_ids]
+
+    out_files = {}
+    for group in schedule(metric_ids, metrics):
+        for metric_id, metric in group:
+            extractor = getattr(metric, 'extractor', None)
+            shared = isinstance(extractor, _SharedExtractor)
+            shared_extraction_time = extractor.elapsed if shared else 0.0
+
+            print("Perform calculation for: %s / %s" % (metric.display_name, evaluation_target))
+            time_begin = time.time()
+            with progress_labels(metric=metric_id, target=evaluation_target):
+                d = metric.calc(gene_sets)
+            exec_time = time.time() - time_begin
+            # report the time a standalone run would need, the shared extraction counts for every metric
+            exec_time += shared_extraction_time
+
+            out_files[metric_id] = os.path.join(out_dir, metric_id, evaluation_target + ".json")
+            persist_evaluation(metric.display_name, exec_time, d, gene_sets, out_files[metric_id])
+
+        extractor = getattr(group[0][1], 'extractor', None)
+        if isinstance(extractor, _SharedExtractor):
+            extractor.features.clear()
+    return out_files
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Computes several distance metrics of one evaluation target")
+    parser.add_argument("store_file", help="gene_sets.npz of the evaluation target")
+    parser.add_argument("evaluation_target", help="e.g. reactome/R-HSA-8982491")
+    parser.add_argument("metrics", nargs="+", help="<category>/<key>, or just <category> for all its metrics")
+    parser.add_argument("--out-dir", default="experiment_data")
+    parser.add_argument("--w2v-file")
+    parser.add_argument("--token-file")
+    parser.add_argument("--gene-embedding-file")
+    parser.add_argument("--ppi-file")
+    parser.add_argument("--tax-id", type=int, default=9606)
+    parser.add_argument("--threads", type=int, default=1, help="worker processes per metric")
+    parser.add_argument("--progress", default="tqdm", help="tqdm, none, jsonl:<file> or prometheus:<file>")
+    parser.add_argument("--progress-interval", type=float, default=1.0, help="seconds between progress events")
+    args = parser.parse_args(args)
+
+    set_progress_hook(progress_hook_from_spec(args.progress), args.progress_interval)
+    resources = Resources(args.store_file, args.w2v_file, args.token_file, args.gene_embedding_file,
+                          args.ppi_file, args.tax_id, args.threads)
+    run_metrics(args.store_file, args.evaluation_target, expand_metric_ids(args.metrics), args.out_dir, resources)
+
+
+if __name__ == '__main__':
+    main()
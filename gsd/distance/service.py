@@ -0,0 +1,306 @@
+import argparse
+import http.server
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Tuple
+
+import numpy as np
+from scipy.spatial.distance import squareform
+
+from gsd.distance.ann import build_ann_index, CosineANNIndex
+from gsd.distance.progress import set_progress_hook, progress_hook_from_spec
+from gsd.distance.runner import Resources, create_metric, expand_metric_ids
+from gsd.gene_set_store import load_gene_set_store
+from gsd.gene_sets import GeneSet
+
+
+# Long running distance service. Gene sets of the configured targets, metrics and their resources are
+# loaded once; requests are answered over HTTP on a local TCP port or a Unix socket:
+#
+#   GET  /metrics   configured metric ids and targets
+#   GET  /stats     request counts, latencies and throughput
+#   POST /distance  {"metric": ..., "target": ..., "gene_sets": [names]} -> condensed distances of these gene sets
+#   POST /knn       {"metric": ..., "target": ..., "gene_set": name, "k": 10} -> nearest gene sets of the target,
+#                   only for the metrics prepared at startup (`knn_metrics`)
+#   POST /batch     {"requests": [{"type": "distance" | "knn", ...}]} -> results in request order
+#
+# Undefined distances are null, infinite ones (e.g. WMD of identical vectors, unconnected PPI genes) "inf".
+
+class ServiceStats:
+    def __init__(self, window: int = 10000):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.errors = {}
+        self.latencies = {}
+        self.window = window
+
+    def record(self, endpoint: str, seconds: float, failed: bool = False):
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            if failed:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            self.latencies.setdefault(endpoint, deque(maxlen=self.window)).append(seconds)
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            uptime = time.time() - self.started
+            endpoints = {}
+            for endpoint, latencies in self.latencies.items():
+                latencies_ms = np.array(latencies) * 1000
+                endpoints[endpoint] = {'count': self.counts[endpoint],
+                                       'errors': self.errors.get(endpoint, 0),
+                                       'mean_ms': float(np.mean(latencies_ms)),
+                                       'p50_ms': float(np.percentile(latencies_ms, 50)),
+                                       'p95_ms': float(np.percentile(latencies_ms, 95)),
+                                       'max_ms': float(np.max(latencies_ms))}
+            n_requests = sum(self.counts.values())
+            return {'uptime_s': uptime,
+                    'requests': n_requests,
+                    'throughput_rps': n_requests / uptime if uptime > 0 else 0.0,
+                    'endpoints': endpoints}
+
+
+def _json_value(value: float):
+    """Strict JSON has no NaN and Infinity: NaN becomes null, infinite distances the strings inf or -inf"""
+    if np.isfinite(value):
+        return float(value)
+    if np.isnan(value):
+        return None
+    return "inf" if value > 0 else "-inf"
+
+
+class DistanceService:
+    """
+    Answers distance and k-NN requests with a pool of `max_workers` threads. Calls into the same
+    metric are serialized because metrics may keep caches; different metrics run concurrently.
+    """
+
+    def __init__(self,
+                 targets: Dict[str, str],
+                 metric_ids: List[str],
+                 resources: Resources = None,
+                 max_workers: int = 4,
+                 knn_metrics: List[str] = ()):
+        resources = resources or Resources()
+        self.gene_sets = {target: load_gene_set_store(store_file) for target, store_file in targets.items()}
+        self.gene_set_ids = {target: {gene_set.general_info.name: idx for idx, gene_set in enumerate(gene_sets)}
+                             for target, gene_sets in self.gene_sets.items()}
+        self.metrics = {metric_id: create_metric(metric_id, resources) for metric_id in expand_metric_ids(metric_ids)}
+        self.metric_locks = {metric_id: threading.Lock() for metric_id in self.metrics}
+        self.neighbour_data = {}
+        self.warm_up(expand_metric_ids(knn_metrics))
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.stats = ServiceStats()
+
+    def _metric(self, request: Dict) -> str:
+        if not isinstance(request, dict):
+            raise ValueError("Expected a JSON object as request")
+        if not isinstance(request.get('metric'), str) or request['metric'] not in self.metrics:
+            raise KeyError("Unknown metric %s" % request.get('metric'))
+        return request['metric']
+
+    def _gene_sets(self, request: Dict, names: List[str]) -> Tuple[str, List[GeneSet]]:
+        target = request.get('target')
+        if not isinstance(target, str) or target not in self.gene_sets:
+            raise KeyError("Unknown target %s" % target)
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            raise ValueError("Gene sets must be given by their names")
+        missing = [name for name in names if name not in self.gene_set_ids[target]]
+        if missing:
+            raise KeyError("Unknown gene sets in %s: %s" % (target, ', '.join(missing)))
+        return target, [self.gene_sets[target][self.gene_set_ids[target][name]] for name in names]
+
+    def distance(self, request: Dict) -> Dict:
+        metric_id = self._metric(request)
+        names = request.get('gene_sets', [])
+        if len(names) < 2:
+            raise ValueError("At least two gene sets are required")
+        target, gene_sets = self._gene_sets(request, names)
+        with self.metric_locks[metric_id]:
+            d = self.metrics[metric_id].calc(gene_sets)
+        labels = [[names[i], names[j]] for i in range(len(names) - 1) for j in range(i + 1, len(names))]
+        return {'labels': labels, 'distances': [_json_value(value) for value in d]}
+
+    def warm_up(self, metric_ids: List[str]):
+        """
+        Prepares k-NN requests of the metrics for all targets: an ANN index for embedding based metrics,
+        otherwise the full distance matrix. This may take as long as a whole evaluation, so it only happens
+        here (at startup or on an explicit call) and never within a request.
+        """
+        for metric_id in metric_ids:
+            if metric_id not in self.metrics:
+                raise KeyError("Unknown metric %s" % metric_id)
+            metric = self.metrics[metric_id]
+            for target, gene_sets in self.gene_sets.items():
+                with self.metric_locks[metric_id]:
+                    if hasattr(metric, 'embed'):
+                        data = build_ann_index(metric.embed(gene_sets),
+                                               [gene_set.general_info.name for gene_set in gene_sets])
+                    else:
+                        data = squareform(metric.calc(gene_sets), checks=False)
+                self.neighbour_data[(metric_id, target)] = data
+
+    def _neighbour_data(self, metric_id: str, target: str):
+        if (metric_id, target) not in self.neighbour_data:
+            raise ValueError("k-NN of %s is not enabled, warm it up first" % metric_id)
+        return self.neighbour_data[(metric_id, target)]
+
+    def knn(self, request: Dict) -> Dict:
+        metric_id = self._metric(request)
+        target, (gene_set,) = self._gene_sets(request, [request.get('gene_set')])
+        k = request.get('k', 10)
+        if not isinstance(k, int) or isinstance(k, bool) or k < 1:
+            raise ValueError("k must be a positive integer")
+        idx = self.gene_set_ids[target][gene_set.general_info.name]
+        names = list(self.gene_set_ids[target])
+
+        data = self._neighbour_data(metric_id, target)
+        if isinstance(data, CosineANNIndex):
+            ids, distances = data.query(data.vectors[idx], k + 1, request.get('search_k'))
+        else:
+            distances = data[idx].copy()
+            distances[idx] = np.inf
+            ids = np.argsort(distances, kind='stable')[:k + 1]
+            distances = distances[ids]
+        neighbours = [[names[other], _json_value(distance)] for other, distance in zip(ids, distances)
+                      if other != idx]
+        return {'gene_set': gene_set.general_info.name, 'neighbours': neighbours[:k]}
+
+    def batch(self, request: Dict) -> Dict:
+        handlers = {'distance': self.distance, 'knn': self.knn}
+
+        def run(sub_request: Dict):
+            try:
+                if not isinstance(sub_request, dict) or sub_request.get('type', 'distance') not in handlers:
+                    raise ValueError("Unknown request type")
+                return handlers[sub_request.get('type', 'distance')](sub_request)
+            except (KeyError, ValueError) as e:
+                return {'error': str(e.args[0]) if isinstance(e, KeyError) and e.args else str(e)}
+            except Exception as e:
+                # one broken sub request must not fail the whole batch
+                return {'error': "%s: %s" % (e.__class__.__name__, e)}
+
+        if not isinstance(request, dict) or not isinstance(request.get('requests', []), list):
+            raise ValueError("Expected {\"requests\": [...]}")
+        futures = [self.pool.submit(run, sub_request) for sub_request in request.get('requests', [])]
+        return {'results': [future.result() for future in futures]}
+
+    def handle(self, method: str, path: str, body: bytes) -> Tuple[int, Dict]:
+        time_begin = time.time()
+        status = 200
+        try:
+            if method == 'GET' and path == '/metrics':
+                response = {'metrics': list(self.metrics), 'targets': list(self.gene_sets)}
+            elif method == 'GET' and path == '/stats':
+                response = self.stats.summary()
+            elif method == 'POST' and path in ('/distance', '/knn', '/batch'):
+                request = json.loads(body.decode() or "{}")
+                handler = getattr(self, path[1:])
+                # batches fan out into the pool themselves, single requests take one worker
+                response = handler(request) if path == '/batch' else self.pool.submit(handler, request).result()
+            else:
+                status, response = 404, {'error': "No endpoint %s %s" % (method, path)}
+        except KeyError as e:
+            status, response = 404, {'error': str(e.args[0]) if e.args else str(e)}
+        except ValueError as e:
+            status, response = 400, {'error': str(e)}
+        except Exception as e:
+            status, response = 500, {'error': "%s: %s" % (e.__class__.__name__, e)}
+        self.stats.record(path, time.time() - time_begin, status != 200)
+        return status, response
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0, unix_socket: str = None) -> http.server.HTTPServer:
+        """Starts serving in a background thread, stop it with `shutdown()` on the returned server"""
+        service = self
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self, method: str):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, response = service.handle(method, self.path, body)
+                try:
+                    payload = json.dumps(response, allow_nan=False).encode()
+                except ValueError as e:
+                    status, payload = 500, json.dumps({'error': "ValueError: %s" % e}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def address_string(self):
+                return unix_socket or self.client_address[0]
+
+            def log_message(self, *args):
+                pass
+
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+
+            class UnixHTTPServer(http.server.ThreadingHTTPServer):
+                address_family = socket.AF_UNIX
+
+                def server_bind(self):
+                    self.socket.bind(self.server_address)
+                    self.server_name, self.server_port = "localhost", 0
+
+            server = UnixHTTPServer(unix_socket, RequestHandler)
+        else:
+            server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Serves gene set distances over HTTP")
+    parser.add_argument("--target", action="append", required=True, metavar="NAME=STORE_FILE",
+                        help="evaluation target and its gene_sets.npz, may be repeated")
+    parser.add_argument("--metrics", nargs="+", required=True, help="<category>/<key> or <category>")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--knn-metrics", nargs="*", default=[],
+                        help="metrics answering k-NN requests, prepared at startup")
+    parser.add_argument("--w2v-file")
+    parser.add_argument("--gene-embedding-file")
+    parser.add_argument("--ppi-file")
+    parser.add_argument("--tax-id", type=int, default=9606)
+    parser.add_argument("--progress", default="none", help="tqdm, none, jsonl:<file> or prometheus:<file>")
+    args = parser.parse_args(args)
+
+    set_progress_hook(progress_hook_from_spec(args.progress))
+    targets = dict(target.split("=", 1) for target in args.target)
+    resources = Resources(w2v_file=args.w2v_file, gene_embedding_file=args.gene_embedding_file,
+                          ppi_file=args.ppi_file, tax_id=args.tax_id)
+    service = DistanceService(targets, args.metrics, resources, args.workers, args.knn_metrics)
+    server = service.serve(args.host, args.port, args.unix_socket)
+    print("Serving %d metrics on %s" % (len(service.metrics), args.unix_socket or "%s:%d" % server.server_address))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+from typing import List, Tuple, Dict
+
+import numpy as np
+
+from gsd.distance import DistanceMetric, calc_n_comparisons, condensed_range, persist_evaluation
+from gsd.distance.progress import progress_labels
+from gsd.gene_sets import GeneSet
+
+# Sharded evaluation of one metric on one target, coordinated through a shared directory only:
+#
+#   <shard_dir>/plan.json              metric, number of gene sets and the condensed index range of every shard
+#   <shard_dir>/shard_000042.lock      claim of a worker, created with O_EXCL; its mtime is the heartbeat
+#   <shard_dir>/shard_000042.npz       partial result (distances of the shard's range and the time it took)
+#
+# Workers claim free shards, touch their lock while computing and replace the result file atomically. A lock
+# whose heartbeat is older than `stale_after` seconds belongs to a dead worker: it is renamed away and the shard
+# is claimed again. Only one worker wins the rename, and it gives up (moving the lock back) if what it renamed
+# is no longer the lock it judged stale, e.g. a fresh claim of a faster worker. Once every shard has a result,
+# the merge writes the usual EvaluationResult file. Heartbeats compare mtimes with the local clock, so nodes need synced clocks.
+
+
+def shard_ranges(n_comparisons: int, shard_size: int) -> List[Tuple[int, int]]:
+    return [(begin, min(begin + shard_size, n_comparisons)) for begin in range(0, n_comparisons, shard_size)]
+
+
+def _shard_file(shard_dir: str, shard: int, extension: str) -> str:
+    return os.path.join(shard_dir, "shard_%06d.%s" % (shard, extension))
+
+
+def _default_worker_id() -> str:
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def write_plan(shard_dir: str, metric: DistanceMetric, gene_sets: List[GeneSet], shard_size: int) -> Dict:
+    """Creates the plan of `shard_dir` unless present, an existing plan must describe the same evaluation"""
+    os.makedirs(shard_dir, exist_ok=True)
+    n_comparisons = calc_n_comparisons(gene_sets)
+    plan = {'metric': metric.display_name,
+            'gene_sets': [gene_set.general_info.name for gene_set in gene_sets],
+            'shards': shard_ranges(n_comparisons, shard_size)}
+
+    plan_file = os.path.join(shard_dir, "plan.json")
+    tmp_file = "%s.%s.tmp" % (plan_file, _default_worker_id())
+    with open(tmp_file, "w") as f:
+        json.dump(plan, f)
+    try:
+        # link fails if another worker created the plan first
+        os.link(tmp_file, plan_file)
+    except FileExistsError:
+        existing = read_plan(shard_dir)
+        if existing['metric'] != plan['metric'] or existing['gene_sets'] != plan['gene_sets']:
+            raise ValueError("%s holds shards of another evaluation (%s)" % (shard_dir, existing['metric']))
+        plan = existing
+    finally:
+        os.remove(tmp_file)
+    return plan
+
+
+def read_plan(shard_dir: str) -> Dict:
+    with open(os.path.join(shard_dir, "plan.json")) as f:
+        plan = json.load(f)
+    plan['shards'] = [tuple(shard) for shard in plan['shards']]
+    return plan
+
+
+def _lock_state(lock_file: str):
+    """Identity of a lock (inode, heartbeat, owner), None once it is gone"""
+    try:
+        with open(lock_file) as f:
+            stat = os.fstat(f.fileno())
+            return stat.st_ino, stat.st_mtime_ns, f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _claim(lock_file: str, worker_id: str, stale_after: float) -> bool:
+    try:
+        fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        observed = _lock_state(lock_file)
+        if observed is None or time.time() - observed[1] / 1e9 <= stale_after:
+            return False
+        stale_file = "%s.stale.%s" % (lock_file, worker_id)
+        try:
+            os.rename(lock_file, stale_file)
+        except FileNotFoundError:
+            return False
+        if _lock_state(stale_file) != observed:
+            # the stale lock was replaced (or its heartbeat came back) after we judged it: what we moved away
+            # is a live lock, put it back unless yet another lock took its place, and leave the shard to it
+            try:
+                os.link(stale_file, lock_file)
+            except FileExistsError:
+                pass
+            os.remove(stale_file)
+            return False
+        os.remove(stale_file)
+        return _claim(lock_file, worker_id, stale_after)
+    with os.fdopen(fd, "w") as f:
+        f.write(worker_id)
+    return True
+
+
+def _release(lock_file: str, worker_id: str):
+    try:
+        with open(lock_file) as f:
+            if f.read() == worker_id:
+                os.remove(lock_file)
+    except FileNotFoundError:
+        pass
+
+
+class _Heartbeat:
+    """Touches the lock file every `interval` seconds until stopped"""
+
+    def __init__(self, lock_file: str, interval: float):
+        self.lock_file = lock_file
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.lock_file)
+            except FileNotFoundError:
+                # the shard was taken over, the result is written anyway
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.thread.join()
+
+
+def calc_shard(metric: DistanceMetric, gene_sets: List[GeneSet], begin: int, end: int) -> np.ndarray:
+    """Distances of the condensed indices [begin, end); pairwise metrics only compute these"""
+    with condensed_range(begin, end):
+        return np.asarray(metric.calc(gene_sets), dtype=float)[begin:end]
+
+
+def completed_shards(shard_dir: str, plan: Dict) -> List[int]:
+    return [shard for shard in range(len(plan['shards'])) if os.path.exists(_shard_file(shard_dir, shard, "npz"))]
+
+
+def run_shard_worker(metric: DistanceMetric,
+                     gene_sets: List[GeneSet],
+                     shard_dir: str,
+                     worker_id: str = None,
+                     heartbeat_interval: float = 30.0,
+                     stale_after: float = 300.0,
+                     wait: bool = True,
+                     poll_interval: float = 5.0) -> int:
+    """
+    Computes shards of the plan in `shard_dir` until none is left to claim and returns how many this worker
+    computed. With `wait` the worker keeps polling while other workers hold shards, so it can take over
+    shards of workers that died.
+    """
+    worker_id = worker_id or _default_worker_id()
+    plan = read_plan(shard_dir)
+    computed = 0
+    while True:
+        pending = [shard for shard in range(len(plan['shards']))
+                   if not os.path.exists(_shard_file(shard_dir, shard, "npz"))]
+        if len(pending) == 0:
+            return computed
+
+        claimed = False
+        for shard in pending:
+            lock_file = _shard_file(shard_dir, shard, "lock")
+            if os.path.exists(_shard_file(shard_dir, shard, "npz")) or not _claim(lock_file, worker_id, stale_after):
+                continue
+            claimed = True
+            try:
+                begin, end = plan['shards'][shard]
+                with _Heartbeat(lock_file, heartbeat_interval), progress_labels(shard=str(shard)):
+                    time_begin = time.time()
+                    d = calc_shard(metric, gene_sets, begin, end)
+                    exec_time = time.time() - time_begin
+
+                result_file = _shard_file(shard_dir, shard, "npz")
+                tmp_file = "%s.%s.tmp" % (result_file, worker_id)
+                with open(tmp_file, "wb") as f:
+                    np.savez(f, distances=d, exec_time=exec_time, worker=worker_id)
+                os.replace(tmp_file, result_file)
+                computed += 1
+            finally:
+                _release(lock_file, worker_id)
+
+        if not claimed:
+            if not wait:
+                return computed
+            time.sleep(poll_interval)
+
+
+def merge_shards(shard_dir: str, gene_sets: List[GeneSet], out_file: str) -> bool:
+    """Writes the EvaluationResult once all shards are done, returns whether it did"""
+    plan = read_plan(shard_dir)
+    if len(completed_shards(shard_dir, plan)) < len(plan['shards']):
+        return False
+
+    d = np.full(calc_n_comparisons(gene_sets), np.nan)
+    exec_time = 0.0
+    for shard, (begin, end) in enumerate(plan['shards']):
+        with np.load(_shard_file(shard_dir, shard, "npz")) as npz:
+            d[begin:end] = npz['distances']
+            exec_time += float(npz['exec_time'])
+
+    # several workers may merge at once, each writes a complete file and replaces the result atomically
+    tmp_file = "%s.%s.tmp" % (out_file, _default_worker_id())
+    persist_evaluation(plan['metric'], exec_time, d, gene_sets, tmp_file)
+    os.replace(tmp_file, out_file)
+    return True
+
+
+def run_sharded_evaluation(metric: DistanceMetric,
+                           gene_sets: List[GeneSet],
+                           out_file: str,
+                           shard_dir: str,
+                           shard_size: int = 10000,
+                           worker_id: str = None,
+                           heartbeat_interval: float = 30.0,
+                           stale_after: float = 300.0,
+                           wait: bool = True,
+                           poll_interval: float = 5.0) -> bool:
+    """
+    Joins the sharded evaluation in `shard_dir` as one worker; start it on as many nodes as needed. The
+    exec time of the merged result is the sum over all shards. Returns whether this worker wrote `out_file`.
+    """
+    write_plan(shard_dir, metric, gene_sets, shard_size)
+    run_shard_worker(metric, gene_sets, shard_dir, worker_id, heartbeat_interval, stale_after, wait, poll_interval)
+    return merge_shards(shard_dir, gene_sets, out_file)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Joins a sharded evaluation of one metric as a worker")
+    parser.add_argument("store_file", help="gene_sets.npz of the evaluation target")
+    parser.add_argument("metric", help="<category>/<key>")
+    parser.add_argument("out_file")
+    parser.add_argument("shard_dir", help="directory shared by all workers of this evaluation")
+    parser.add_argument("--shard-size", type=int, default=10000, help="pairs per shard")
+    parser.add_argument("--worker-id")
+    parser.add_argument("--heartbeat-interval", type=float, default=30.0)
+    parser.add_argument("--stale-after", type=float, default=300.0,
+                        help="seconds without heartbeat after which a shard is taken over")
+    parser.add_argument("--no-wait", action="store_true", help="exit once no shard is left to claim")
+    parser.add_argument("--w2v-file")
+    parser.add_argument("--token-file")
+    parser.add_argument("--gene-embedding-file")
+    parser.add_argument("--ppi-file")
+    parser.add_argument("--tax-id", type=int, default=9606)
+    parser.add_argument("--threads", type=int, default=1, help="worker processes of the metric")
+    parser.add_argument("--progress", default="tqdm", help="tqdm, none, jsonl:<file> or prometheus:<file>")
+    args = parser.parse_args(args)
+
+    from gsd.distance.progress import set_progress_hook, progress_hook_from_spec
+    from gsd.distance.runner import Resources, create_metric
+    from gsd.gene_set_store import load_gene_set_store
+
+    set_progress_hook(progress_hook_from_spec(args.progress))
+    resources = Resources(args.store_file, args.w2v_file, args.token_file, args.gene_embedding_file,
+                          args.ppi_file, args.tax_id, args.threads)
+    metric = create_metric(args.metric, resources)
+    with progress_labels(metric=args.metric):
+        merged = run_sharded_evaluation(metric, load_gene_set_store(args.store_file), args.out_file, args.shard_dir,
+                                        args.shard_size, args.worker_id, args.heartbeat_interval, args.stale_after,
+                                        not args.no_wait)
+    print("Merged %s" % args.out_file if merged else "Shards left to other workers")
+
+
+if __name__ == '__main__':
+    main()
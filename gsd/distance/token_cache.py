@@ -0,0 +1,104 @@
+import hashlib
+import os
+from typing import List
+
+import numpy as np
+
+from gsd.distance.nlp import TEXT_FIELDS, TEXT_SOURCES, has_text_field
+from gsd.gene_set_store import _StringTable, _to_csr
+from gsd.gene_sets import GeneSet
+
+
+# Tokenised texts of one evaluation target: token ids per gene set and text field (CSR-like offset arrays)
+# over one token table. The cache remembers the checksum of the file the gene sets were loaded from.
+
+def file_checksum(file: str) -> str:
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_token_cache(gene_sets: List[GeneSet], out_file: str, checksum: str = ""):
+    tokens = _StringTable()
+    names = _StringTable()
+    columns = {}
+    columns['names'] = np.array(names.intern_all(gene_set.general_info.name for gene_set in gene_sets),
+                                dtype=np.int32)
+    columns['name_strings'], columns['name_string_offsets'] = names.to_arrays()
+
+    for field, (texts, tokenize) in TEXT_SOURCES.items():
+        if all(has_text_field(gene_set, field) for gene_set in gene_sets):
+            # every distinct text (GO term, gene, ...) is tokenised once, however many gene sets contain it
+            text_tokens = {}
+
+            def token_ids(text) -> List[int]:
+                key = text if isinstance(text, str) else None
+                if key not in text_tokens:
+                    text_tokens[key] = tokens.intern_all(tokenize(text))
+                return text_tokens[key]
+
+            columns[field + '_offsets'], columns[field] = _to_csr(
+                [[token_id for text in texts(gene_set) for token_id in token_ids(text)] for gene_set in gene_sets])
+
+    columns['tokens'], columns['token_offsets'] = tokens.to_arrays()
+    columns['checksum'] = np.array(checksum)
+
+    os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+    with open(out_file, "wb") as f:
+        np.savez(f, **columns)
+
+
+def _decode_strings(data: np.ndarray, offsets: np.ndarray) -> List[str]:
+    data = data.tobytes()
+    return [data[offsets[idx]:offsets[idx + 1]].decode() for idx in range(len(offsets) - 1)]
+
+
+class TokenCache:
+    def __init__(self, cache_file: str):
+        with np.load(cache_file) as npz:
+            self.checksum = str(npz['checksum'])
+            self.tokens = _decode_strings(npz['tokens'], npz['token_offsets'])
+            name_strings = _decode_strings(npz['name_strings'], npz['name_string_offsets'])
+            self.gene_set_ids = {name_strings[name]: idx for idx, name in enumerate(npz['names'])}
+            self.fields = {field: (npz[field], npz[field + '_offsets'])
+                           for field in TEXT_FIELDS if field in npz.files}
+        self.vocabulary_model = None
+        self.vocabulary_mask = None
+
+    def has(self, gene_set: GeneSet, field: str) -> bool:
+        return field in self.fields and gene_set.general_info.name in self.gene_set_ids
+
+    def token_ids(self, gene_set: GeneSet, field: str) -> np.ndarray:
+        token_ids, offsets = self.fields[field]
+        idx = self.gene_set_ids[gene_set.general_info.name]
+        return token_ids[offsets[idx]:offsets[idx + 1]]
+
+    def _vocabulary_mask(self, w2v_model) -> np.ndarray:
+        if self.vocabulary_model is not w2v_model:
+            self.vocabulary_mask = np.array([token in w2v_model.vocab for token in self.tokens], dtype=bool)
+            self.vocabulary_model = w2v_model
+        return self.vocabulary_mask
+
+    def words(self, gene_set: GeneSet, field: str, w2v_model=None) -> List[str]:
+        token_ids = self.token_ids(gene_set, field)
+        if w2v_model is not None:
+            token_ids = token_ids[self._vocabulary_mask(w2v_model)[token_ids]]
+        return [self.tokens[token_id] for token_id in token_ids]
+
+
+def load_token_cache(cache_file: str, source_file: str, gene_sets: List[GeneSet] = None) -> TokenCache:
+    """
+    Loads the token cache of the gene sets in `source_file`. A missing or outdated cache is rebuilt
+    from `gene_sets` when they are given, otherwise a ValueError is raised.
+    """
+    checksum = file_checksum(source_file)
+    if os.path.exists(cache_file):
+        token_cache = TokenCache(cache_file)
+        if token_cache.checksum == checksum:
+            return token_cache
+    if gene_sets is None:
+        raise ValueError("Token cache %s is missing or outdated for %s" % (cache_file, source_file))
+    write_token_cache(gene_sets, cache_file, checksum)
+    return TokenCache(cache_file)
@@ -0,0 +1,213 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Callable, Dict, Tuple
+
+import numpy as np
+from pyemd import emd
+from scipy.sparse import csr_matrix
+from scipy.spatial.distance import cdist, pdist
+
+from gsd.distance import DistanceMetric, calc_n_comparisons, active_condensed_range
+from gsd.gene_sets import GeneSet
+
+
+# Word Mover's Distance (Kusner et al., 2015) for many documents at once. Every document is a normalized
+# bag-of-words histogram over one shared vocabulary, so word-word distances, centroids (WCD) and relaxed
+# WMD (RWMD) lower bounds are computed for all pairs together and exact EMDs are solved only where needed.
+
+def condensed_index(i: int, j: int, n: int) -> int:
+    if i > j:
+        i, j = j, i
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+class WMDEngine:
+    def __init__(self, documents: List[List[str]], w2v_model, max_cached_words: int = 4096):
+        vocabulary = {}
+        self.word_ids = []
+        self.weights = []
+        for words in documents:
+            ids = np.array([vocabulary.setdefault(word, len(vocabulary)) for word in words], dtype=np.int64)
+            word_ids, counts = np.unique(ids, return_counts=True)
+            self.word_ids.append(word_ids)
+            self.weights.append(counts / max(len(words), 1))
+
+        self.words = list(vocabulary)
+        if len(self.words) > 0:
+            self.embeddings = np.asarray(w2v_model[self.words], dtype=np.float64)
+        else:
+            self.embeddings = np.zeros((0, w2v_model.vector_size))
+
+        # the complete word-word distance matrix is shared by all pairs as long as it stays small
+        self.word_distances = cdist(self.embeddings, self.embeddings) \
+            if len(self.words) <= max_cached_words else None
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def is_empty(self, idx: int) -> bool:
+        return len(self.word_ids[idx]) == 0
+
+    def distances(self, ids_a: np.ndarray, ids_b: np.ndarray) -> np.ndarray:
+        if self.word_distances is not None:
+            return self.word_distances[np.ix_(ids_a, ids_b)]
+        return cdist(self.embeddings[ids_a], self.embeddings[ids_b])
+
+    def histogram_matrix(self) -> csr_matrix:
+        indptr = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum([len(ids) for ids in self.word_ids], out=indptr[1:])
+        return csr_matrix((np.concatenate(self.weights + [np.zeros(0)]),
+                           np.concatenate(self.word_ids + [np.zeros(0, dtype=np.int64)]),
+                           indptr),
+                          shape=(len(self), len(self.words)))
+
+    def _mask_empty(self, condensed: np.ndarray) -> np.ndarray:
+        empty = np.array([self.is_empty(idx) for idx in range(len(self))], dtype=bool)
+        i, j = np.triu_indices(len(self), k=1)
+        condensed[empty[i] | empty[j]] = np.nan
+        return condensed
+
+    def centroid_bounds(self) -> np.ndarray:
+        """Word centroid distances (WCD) of all pairs in condensed order"""
+        centroids = self.histogram_matrix() @ self.embeddings
+        return self._mask_empty(pdist(centroids) if len(self) > 1 else np.zeros(0))
+
+    def relaxed_bounds(self, max_block_elements: int = 2 ** 22) -> np.ndarray:
+        """Relaxed WMD (RWMD) of all pairs in condensed order, a tighter lower bound than WCD"""
+        # one_sided[a, b]: cost of moving document a onto the closest words of document b. nearest[b, w], the
+        # distance of vocabulary word w to the closest word of document b, only exists for a block of b at once.
+        histograms = self.histogram_matrix()
+        one_sided = np.zeros((len(self), len(self)))
+        all_ids = np.arange(len(self.words))
+        block_size = max(1, max_block_elements // max(len(self.words), 1))
+        for begin in range(0, len(self), block_size):
+            end = min(begin + block_size, len(self))
+            nearest = np.zeros((end - begin, len(self.words)))
+            for idx in range(begin, end):
+                if not self.is_empty(idx):
+                    nearest[idx - begin] = self.distances(all_ids, self.word_ids[idx]).min(axis=1)
+            one_sided[:, begin:end] = histograms @ nearest.T
+
+        i, j = np.triu_indices(len(self), k=1)
+        return self._mask_empty(np.maximum(one_sided[i, j], one_sided[j, i]))
+
+    def exact(self, idx_a: int, idx_b: int) -> float:
+        if self.is_empty(idx_a) or self.is_empty(idx_b):
+            return np.nan
+
+        union = np.union1d(self.word_ids[idx_a], self.word_ids[idx_b])
+        histogram_a = np.zeros(len(union))
+        histogram_a[np.searchsorted(union, self.word_ids[idx_a])] = self.weights[idx_a]
+        histogram_b = np.zeros(len(union))
+        histogram_b[np.searchsorted(union, self.word_ids[idx_b])] = self.weights[idx_b]
+
+        distances = np.ascontiguousarray(self.distances(union, union))
+        if np.sum(distances) == 0.0:
+            # like gensim's wmdistance: all words share one vector, no meaningful distance
+            return np.inf
+        return emd(histogram_a, histogram_b, distances)
+
+    def exact_pairs(self, pairs: List[Tuple[int, int]]) -> np.ndarray:
+        return np.array([self.exact(i, j) for i, j in pairs], dtype=float)
+
+    def nearest_neighbours(self, k: int) -> Dict[int, List[Tuple[int, float]]]:
+        """
+        Exact k nearest neighbours of every document. Candidates are visited by increasing WCD and
+        skipped without solving the EMD whenever their RWMD already exceeds the current k-th distance.
+        """
+        n = len(self)
+        wcd = self.centroid_bounds()
+        rwmd = self.relaxed_bounds()
+        solved = {}
+        neighbours = {}
+        for idx in range(n):
+            if self.is_empty(idx):
+                neighbours[idx] = []
+                continue
+            others = [other for other in range(n) if other != idx and not self.is_empty(other)]
+            others.sort(key=lambda other: wcd[condensed_index(idx, other, n)])
+
+            best = []
+            for other in others:
+                pair = (min(idx, other), max(idx, other))
+                if len(best) >= k and rwmd[condensed_index(idx, other, n)] >= best[-1][1]:
+                    continue
+                if pair not in solved:
+                    solved[pair] = self.exact(*pair)
+                best.append((other, solved[pair]))
+                best.sort(key=lambda neighbour: neighbour[1])
+                best = best[:k]
+            neighbours[idx] = best
+        return neighbours
+
+
+_worker_engine = None
+
+
+def _init_worker(engine: WMDEngine):
+    global _worker_engine
+    _worker_engine = engine
+
+
+def _exact_pairs_in_worker(pairs: List[Tuple[int, int]]) -> np.ndarray:
+    return _worker_engine.exact_pairs(pairs)
+
+
+class WMDistance(DistanceMetric):
+    """
+    Word Mover's Distance between the words of two gene sets.
+    Without `top_k` every pair is solved exactly, spread over `n_jobs` worker processes (1 solves in-process).
+    With `top_k` only the k nearest neighbours of every gene set are solved exactly,
+    all remaining pairs get their RWMD lower bound.
+    """
+
+    def __init__(self,
+                 name: str,
+                 extractor: Callable[[GeneSet], List[str]],
+                 w2v_model,
+                 top_k: int = None,
+                 n_jobs: int = 1,
+                 max_cached_words: int = 4096):
+        self.name = name
+        self.extractor = extractor
+        self.w2v_model = w2v_model
+        self.top_k = top_k
+        self.n_jobs = n_jobs
+        self.max_cached_words = max_cached_words
+
+    @property
+    def display_name(self) -> str:
+        return self.name
+
+    def engine(self, gene_sets: List[GeneSet]) -> WMDEngine:
+        return WMDEngine([self.extractor(gene_set) for gene_set in gene_sets], self.w2v_model,
+                         self.max_cached_words)
+
+    def calc(self, gene_sets: List[GeneSet]) -> np.ndarray:
+        engine = self.engine(gene_sets)
+        if self.top_k is not None:
+            return self._calc_top_k(engine)
+
+        i, j = np.triu_indices(len(engine), k=1)
+        begin, end = active_condensed_range(len(i))
+        if (begin, end) != (0, len(i)):
+            result = np.full(len(i), np.nan)
+            result[begin:end] = self._exact_pairs(engine, list(zip(i[begin:end].tolist(), j[begin:end].tolist())))
+            return result
+        return self._exact_pairs(engine, list(zip(i.tolist(), j.tolist())))
+
+    def _exact_pairs(self, engine: WMDEngine, pairs: List[Tuple[int, int]]) -> np.ndarray:
+        if self.n_jobs <= 1 or len(pairs) < 2 * self.n_jobs:
+            return engine.exact_pairs(pairs)
+
+        chunk_size = -(-len(pairs) // (4 * self.n_jobs))
+        chunks = [pairs[start:start + chunk_size] for start in range(0, len(pairs), chunk_size)]
+        with ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker, initargs=(engine,)) as executor:
+            return np.concatenate(list(executor.map(_exact_pairs_in_worker, chunks)))
+
+    def _calc_top_k(self, engine: WMDEngine) -> np.ndarray:
+        n = len(engine)
+        result = engine.relaxed_bounds() if n > 1 else np.zeros(calc_n_comparisons(range(n)))
+        for idx, neighbours in engine.nearest_neighbours(self.top_k).items():
+            for other, distance in neighbours:
+                result[condensed_index(idx, other, n)] = distance
+        return result
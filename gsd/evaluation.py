@@ -0,0 +1,389 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple, Set
+
+import jsonpickle
+import numpy as np
+from anytree import Node, PostOrderIter
+from pandas import DataFrame
+from scipy.cluster.hierarchy import linkage, cophenet
+from scipy.stats import rankdata, kendalltau, spearmanr, pearsonr
+
+from gsd.distance import EvaluationResult
+from gsd.gene_sets import load_tree
+
+# Compares the distances of every metric with the pairwise path lengths in the reference tree. Results are
+# read from <experiment_dir>/<category>/<metric>/<evaluation_target>.json, the reference from
+# <experiment_dir>/tree_path/<evaluation_target>.json. Pairs where either distance is NaN are ignored.
+# Tree recovery clusters the distances hierarchically and compares the dendrogram with the reference tree
+# of <evaluation_data_dir>/<evaluation_target>/tree.json.
+
+REFERENCE_CATEGORY = 'tree_path'
+CORRELATION_METHODS = ['pearson', 'spearman', 'kendall']
+MANTEL_METHODS = ['pearson', 'spearman']
+
+
+def load_evaluation_result(file: str) -> EvaluationResult:
+    with open(file) as f:
+        return jsonpickle.decode(f.read())
+
+
+def load_evaluation_results(experiment_dir: str, evaluation_target: str) -> Dict[Tuple[str, str], EvaluationResult]:
+    """Results of all metrics for one evaluation target (e.g. reactome/R-HSA-8982491) by (category, metric)"""
+    results = {}
+    for category in sorted(os.listdir(experiment_dir)):
+        category_dir = os.path.join(experiment_dir, category)
+        if category == REFERENCE_CATEGORY or not os.path.isdir(category_dir):
+            continue
+        for metric in sorted(os.listdir(category_dir)):
+            file = os.path.join(category_dir, metric, evaluation_target + ".json")
+            if os.path.exists(file):
+                results[(category, metric)] = load_evaluation_result(file)
+    return results
+
+
+def load_reference(experiment_dir: str, evaluation_target: str) -> EvaluationResult:
+    return load_evaluation_result(os.path.join(experiment_dir, REFERENCE_CATEGORY, evaluation_target + ".json"))
+
+
+def n_objects(n_comparisons: int) -> int:
+    n = int(round((1 + np.sqrt(1 + 8 * n_comparisons)) / 2))
+    if n * (n - 1) // 2 != n_comparisons:
+        raise ValueError("%d is not the length of a condensed distance matrix" % n_comparisons)
+    return n
+
+
+def _nan_rank(x: np.ndarray) -> np.ndarray:
+    ranks = np.full(len(x), np.nan)
+    defined = ~np.isnan(x)
+    ranks[defined] = rankdata(x[defined])
+    return ranks
+
+
+def correlations(x: np.ndarray, y: np.ndarray) -> Dict[str, float]:
+    """Pearson, Spearman and Kendall (tau-b) correlation over the pairs defined in both vectors"""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    defined = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[defined], y[defined]
+    if len(x) < 3 or np.all(x == x[0]) or np.all(y == y[0]):
+        return {method: np.nan for method in CORRELATION_METHODS}
+    return {'pearson': pearsonr(x, y)[0],
+            'spearman': spearmanr(x, y)[0],
+            'kendall': kendalltau(x, y)[0]}
+
+
+def batched_pearson(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Pearson correlation of `x` with every row of `y`, each over the pairs defined in both"""
+    defined = ~(np.isnan(x)[np.newaxis, :] | np.isnan(y))
+    x = np.where(defined, x[np.newaxis, :], 0.0)
+    y = np.where(defined, y, 0.0)
+    n = defined.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = x.sum(axis=1) / n
+        mean_y = y.sum(axis=1) / n
+        cov = (x * y).sum(axis=1) / n - mean_x * mean_y
+        var_x = (x * x).sum(axis=1) / n - mean_x ** 2
+        var_y = (y * y).sum(axis=1) / n - mean_y ** 2
+        r = cov / np.sqrt(var_x * var_y)
+    r[(n < 3) | (var_x <= 1e-12 * np.abs(mean_x ** 2)) | (var_y <= 1e-12 * np.abs(mean_y ** 2))] = np.nan
+    return np.clip(r, -1.0, 1.0)
+
+
+def permuted_condensed_indices(permutations: np.ndarray) -> np.ndarray:
+    """
+    Positions in a condensed distance vector after relabelling its objects, one row per permutation.
+    Taking `d[idx]` of the result permutes rows and columns of the square matrix simultaneously.
+    """
+    n = permutations.shape[1]
+    # int32 as long as n * n fits, the index arithmetic below stays in place on three buffers
+    permutations = permutations.astype(np.int32 if n * n < 2 ** 31 else np.int64, copy=False)
+    i, j = np.triu_indices(n, 1)
+    a = permutations[:, i]
+    high = permutations[:, j]
+    low = np.minimum(a, high)
+    np.maximum(a, high, out=high)
+    # idx = (n - 1) * low - low * (low + 1) // 2 + high - 1
+    np.add(low, 1, out=a)
+    a *= low
+    a //= 2
+    high -= a
+    high -= 1
+    low *= n - 1
+    high += low
+    return high
+
+
+def _mantel_statistic(x: np.ndarray, y: np.ndarray, method: str) -> Tuple[np.ndarray, np.ndarray]:
+    if method not in MANTEL_METHODS:
+        raise ValueError("Unsupported Mantel statistic %s, expected one of %s" % (method, ', '.join(MANTEL_METHODS)))
+    # Spearman is the Pearson correlation of the ranks, ranking once keeps the permutations a gather
+    if method == 'spearman':
+        return _nan_rank(x), _nan_rank(y)
+    return x, y
+
+
+def _count_extreme(x: np.ndarray,
+                   y: np.ndarray,
+                   observed: float,
+                   seed: int,
+                   chunk: int,
+                   size: int,
+                   alternative: str) -> Tuple[int, int]:
+    random = np.random.RandomState([seed, chunk])
+    permutations = random.rand(size, n_objects(len(y))).argsort(axis=1)
+    r = batched_pearson(x, y[permuted_condensed_indices(permutations)])
+    r = r[~np.isnan(r)]
+    if alternative == 'greater':
+        extreme = r >= observed - 1e-12
+    elif alternative == 'less':
+        extreme = r <= observed + 1e-12
+    else:
+        extreme = np.abs(r) >= abs(observed) - 1e-12
+    return int(extreme.sum()), len(r)
+
+
+_worker_vectors = None
+
+
+def _init_worker(x: np.ndarray, y: np.ndarray):
+    global _worker_vectors
+    _worker_vectors = (x, y)
+
+
+def _count_extreme_in_worker(args) -> Tuple[int, int]:
+    return _count_extreme(*_worker_vectors, *args)
+
+
+def mantel_test(x: np.ndarray,
+                y: np.ndarray,
+                method: str = 'pearson',
+                permutations: int = 999,
+                alternative: str = 'greater',
+                seed: int = 0,
+                batch_size: int = None,
+                n_jobs: int = 1,
+                max_batch_elements: int = 2 ** 22) -> Tuple[float, float]:
+    """
+    Mantel test of two condensed distance vectors, returns the statistic and its permutation p-value.
+    Permutations are drawn in batches, every batch with its own seed, so the result does not depend on
+    `n_jobs`. Without `batch_size` a batch holds as many permutations as fit `max_batch_elements`
+    permuted distances.
+    """
+    if alternative not in ('greater', 'less', 'two-sided'):
+        raise ValueError("Unknown alternative %s" % alternative)
+    x, y = _mantel_statistic(np.asarray(x, dtype=float), np.asarray(y, dtype=float), method)
+    if len(x) != len(y):
+        raise ValueError("Distance vectors differ in length: %d != %d" % (len(x), len(y)))
+    batch_size = batch_size or max(1, max_batch_elements // max(len(y), 1))
+    observed = batched_pearson(x, y[np.newaxis, :])[0]
+    if np.isnan(observed):
+        return np.nan, np.nan
+
+    chunks = [(observed, seed, chunk, min(batch_size, permutations - start), alternative)
+              for chunk, start in enumerate(range(0, permutations, batch_size))]
+    if n_jobs == 1 or len(chunks) == 1:
+        counts = [_count_extreme(x, y, *chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(x, y)) as executor:
+            counts = list(executor.map(_count_extreme_in_worker, chunks))
+    n_extreme = sum(extreme for extreme, total in counts)
+    n_valid = sum(total for extreme, total in counts)
+    return observed, (n_extreme + 1) / (n_valid + 1)
+
+
+def _check_labels(result: EvaluationResult, reference: EvaluationResult):
+    if [tuple(label) for label in result.comparison_label] != [tuple(label) for label in reference.comparison_label]:
+        raise ValueError("Comparisons of %s differ from the reference" % result.name)
+
+
+def evaluate_result(result: EvaluationResult,
+                    reference: EvaluationResult,
+                    permutations: int = 999,
+                    seed: int = 0) -> Dict[str, float]:
+    _check_labels(result, reference)
+    x = np.array(result.results, dtype=float)
+    y = np.array(reference.results, dtype=float)
+    row = {'name': result.name,
+           'n_pairs': int((~(np.isnan(x) | np.isnan(y))).sum()),
+           'exec_time': result.exec_time}
+    row.update(correlations(x, y))
+    for method in MANTEL_METHODS:
+        row['mantel_%s_p' % method] = mantel_test(x, y, method, permutations, seed=seed)[1] \
+            if permutations > 0 else np.nan
+    return row
+
+
+def _evaluate_task(args) -> Dict[str, float]:
+    experiment_dir, evaluation_target, category, metric, permutations, seed = args
+    reference = load_reference(experiment_dir, evaluation_target)
+    result = load_evaluation_result(os.path.join(experiment_dir, category, metric, evaluation_target + ".json"))
+    row = evaluate_result(result, reference, permutations, seed)
+    row.update({'target': evaluation_target, 'category': category, 'metric': metric})
+    return row
+
+
+def evaluate(experiment_dir: str,
+             evaluation_targets: List[str],
+             permutations: int = 999,
+             seed: int = 0,
+             n_jobs: int = 1) -> DataFrame:
+    """Correlations with the tree path reference for all metrics × targets, one row each"""
+    tasks = [(experiment_dir, evaluation_target, category, metric, permutations, seed)
+             for evaluation_target in evaluation_targets
+             for category, metric in load_evaluation_results(experiment_dir, evaluation_target)]
+    if n_jobs == 1:
+        rows = [_evaluate_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            rows = list(executor.map(_evaluate_task, tasks))
+    columns = ['target', 'category', 'metric', 'name', 'n_pairs', 'exec_time'] + CORRELATION_METHODS + \
+              ['mantel_%s_p' % method for method in MANTEL_METHODS]
+    return DataFrame(rows, columns=columns).set_index(['target', 'category', 'metric'])
+
+
+def result_labels(result: EvaluationResult) -> List[str]:
+    """Gene set names in the order of the condensed results"""
+    labels = result.comparison_label
+    if len(labels) == 0:
+        return []
+    n = n_objects(len(labels))
+    return [labels[0][0]] + [label[1] for label in labels[:n - 1]]
+
+
+def nan_filled(d: np.ndarray) -> np.ndarray:
+    """Replaces undefined distances by the largest defined one, such pairs are merged last"""
+    d = np.array(d, dtype=float)
+    defined = np.isfinite(d)
+    d[~defined] = d[defined].max() if defined.any() else 0.0
+    return d
+
+
+def recover_tree(d: np.ndarray, method: str = 'average') -> np.ndarray:
+    """Linkage matrix of a hierarchical clustering computed on the condensed distances"""
+    return linkage(nan_filled(d), method)
+
+
+def _bit_count(bits: int) -> int:
+    return bin(bits).count('1')
+
+
+def _bipartition(bits: int, n: int):
+    """Canonical form of the split `bits` vs. rest (the side without object 0), None for trivial splits"""
+    if bits & 1:
+        bits ^= (1 << n) - 1
+    return bits if 1 < _bit_count(bits) < n - 1 else None
+
+
+def linkage_bipartitions(z: np.ndarray) -> Set[int]:
+    """Non-trivial splits of a linkage matrix as bitsets over the clustered objects"""
+    n = len(z) + 1
+    bits = [1 << idx for idx in range(n)]
+    for left, right in z[:, :2].astype(int):
+        bits.append(bits[left] | bits[right])
+    splits = (_bipartition(cluster, n) for cluster in bits[n:])
+    return set(split for split in splits if split is not None)
+
+
+def tree_bipartitions(root: Node, labels: List[str]) -> Set[int]:
+    """
+    Non-trivial splits of a reference tree as bitsets over `labels`. Every edge splits the labels of the
+    subtree below it from all others, tree nodes without a label only pass on the labels of their children.
+    """
+    positions = {label: idx for idx, label in enumerate(labels)}
+    bits = {}
+    splits = set()
+    for node in PostOrderIter(root):
+        node_bits = 1 << positions[node.name] if node.name in positions else 0
+        for child in node.children:
+            node_bits |= bits.pop(id(child))
+        bits[id(node)] = node_bits
+        split = _bipartition(node_bits, len(labels)) if node.parent is not None else None
+        if split is not None:
+            splits.add(split)
+    return splits
+
+
+def bipartition_distance(splits_a: Set[int], splits_b: Set[int]) -> float:
+    """Robinson-Foulds distance normalized to [0, 1]"""
+    if len(splits_a) + len(splits_b) == 0:
+        return 0.0
+    return len(splits_a ^ splits_b) / (len(splits_a) + len(splits_b))
+
+
+def tree_recovery_scores(result: EvaluationResult,
+                         reference: EvaluationResult,
+                         root: Node,
+                         method: str = 'average') -> Dict[str, float]:
+    """
+    Scores the clustering of a metric's distances: cophenetic correlation with the metric's own distances
+    and with the reference tree paths, and the bipartition distance to the reference tree.
+    """
+    _check_labels(result, reference)
+    d = np.array(result.results, dtype=float)
+    z = recover_tree(d, method)
+    cophenetic = cophenet(z)
+    defined = np.isfinite(d)
+    recovered_splits = linkage_bipartitions(z)
+    reference_splits = tree_bipartitions(root, result_labels(result))
+    return {'name': result.name,
+            'cophenetic_correlation': correlations(cophenetic[defined], d[defined])['pearson'],
+            'reference_cophenetic_correlation': correlations(cophenetic, reference.results)['pearson'],
+            'bipartition_distance': bipartition_distance(recovered_splits, reference_splits),
+            'shared_bipartitions': len(recovered_splits & reference_splits),
+            'reference_bipartitions': len(reference_splits)}
+
+
+def _tree_recovery_task(args) -> Dict[str, float]:
+    experiment_dir, evaluation_data_dir, evaluation_target, category, metric, method = args
+    reference = load_reference(experiment_dir, evaluation_target)
+    root = load_tree(os.path.join(evaluation_data_dir, evaluation_target, "tree.json"))
+    result = load_evaluation_result(os.path.join(experiment_dir, category, metric, evaluation_target + ".json"))
+    row = tree_recovery_scores(result, reference, root, method)
+    row.update({'target': evaluation_target, 'category': category, 'metric': metric})
+    return row
+
+
+def evaluate_tree_recovery(experiment_dir: str,
+                           evaluation_targets: List[str],
+                           evaluation_data_dir: str = "evaluation_data",
+                           method: str = 'average',
+                           n_jobs: int = 1) -> DataFrame:
+    """Tree recovery scores for all metrics × targets, one row each"""
+    tasks = [(experiment_dir, evaluation_data_dir, evaluation_target, category, metric, method)
+             for evaluation_target in evaluation_targets
+             for category, metric in load_evaluation_results(experiment_dir, evaluation_target)]
+    if n_jobs == 1:
+        rows = [_tree_recovery_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            rows = list(executor.map(_tree_recovery_task, tasks))
+    columns = ['target', 'category', 'metric', 'name', 'cophenetic_correlation', 'reference_cophenetic_correlation',
+               'bipartition_distance', 'shared_bipartitions', 'reference_bipartitions']
+    return DataFrame(rows, columns=columns).set_index(['target', 'category', 'metric'])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Compares all metric results with the reference trees")
+    parser.add_argument("out_file", help="CSV file with one row per evaluation target and metric")
+    parser.add_argument("evaluation_targets", nargs="+", help="e.g. reactome/R-HSA-8982491")
+    parser.add_argument("--experiment-dir", default="experiment_data")
+    parser.add_argument("--permutations", type=int, default=999)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--tree-recovery", action="store_true",
+                        help="score hierarchical clusterings against the reference trees instead")
+    parser.add_argument("--evaluation-data-dir", default="evaluation_data")
+    parser.add_argument("--linkage", default='average', help="linkage method of the clustering")
+    args = parser.parse_args(args)
+
+    if args.tree_recovery:
+        df = evaluate_tree_recovery(args.experiment_dir, args.evaluation_targets, args.evaluation_data_dir,
+                                    args.linkage, args.jobs)
+    else:
+        df = evaluate(args.experiment_dir, args.evaluation_targets, args.permutations, args.seed, args.jobs)
+    df.to_csv(args.out_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Any
+
+
+class RateLimiter:
+    """Spaces out calls so that at most `rate` of them start per second (across all threads)"""
+
+    def __init__(self, rate: float = None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class HTTPStatusError(IOError):
+    def __init__(self, url: str, status: int, reason: str):
+        super().__init__("GET %s failed with %d %s" % (url, status, reason))
+        self.url = url
+        self.status = status
+
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class HTTPClient:
+    """
+    Thread-safe GET client that keeps one keep-alive connection per thread and host,
+    and retries failed requests with exponential backoff
+    """
+
+    def __init__(self,
+                 rate_limiter: RateLimiter = None,
+                 retries: int = 3,
+                 backoff: float = 1.0,
+                 timeout: float = 60.0):
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        connections = self.local.__dict__.setdefault('connections', {})
+        if (scheme, netloc) not in connections:
+            connection_type = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            connections[(scheme, netloc)] = connection_type(netloc, timeout=self.timeout)
+        return connections[(scheme, netloc)]
+
+    def _drop_connection(self, scheme: str, netloc: str):
+        connection = self.local.__dict__.get('connections', {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def get(self, url: str) -> bytes:
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait()
+            try:
+                connection = self._connection(parts.scheme, parts.netloc)
+                connection.request("GET", path, headers={'Connection': 'keep-alive'})
+                response = connection.getresponse()
+                body = response.read()
+                if response.will_close:
+                    self._drop_connection(parts.scheme, parts.netloc)
+            except (http.client.HTTPException, OSError) as e:
+                self._drop_connection(parts.scheme, parts.netloc)
+                error = e
+            else:
+                if response.status == 200:
+                    return body
+                error = HTTPStatusError(url, response.status, response.reason)
+                if response.status not in RETRYABLE_STATUS:
+                    raise error
+
+            if attempt < self.retries:
+                delay = self.backoff * 2 ** attempt
+                print("Request failed (%s), retrying in %.1fs" % (error, delay), file=sys.stderr)
+                time.sleep(delay)
+
+        raise error
+
+    def get_json(self, url: str) -> Any:
+        return json.loads(self.get(url).decode())
+
+
+class JsonFileCache:
+    """On-disk cache storing one JSON document per key; writes are atomic so interrupted runs can be resumed"""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, "%s.json" % urllib.parse.quote(str(key), safe=''))
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str, default=None) -> Any:
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    def put(self, key: str, value: Any):
+        path = self._path(key)
+        tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
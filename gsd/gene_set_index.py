@@ -0,0 +1,139 @@
+import os.path
+from typing import List, Iterable, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix
+
+from gsd.gene_set_store import GeneSetStore, _to_csr
+from gsd.gene_sets import GeneSet
+
+# Inverted index of a gene set library: for every Entrez gene id the gene sets containing it, stored as
+# CSR posting lists (sorted gene ids + offsets into the gene set ids). Intersection counts of a query only
+# touch the postings of its genes. Scores are similarities, the general distances use 1 - score.
+
+MEASURES = ['overlap', 'jaccard', 'overlap_coefficient']
+
+
+def _unique_genes(genes: Iterable[int]) -> np.ndarray:
+    return np.unique(np.fromiter(genes, dtype=np.int64))
+
+
+def _gather_postings(offsets: np.ndarray, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Indices into the postings of the posting lists at `positions`, and the list each index belongs to"""
+    begins = offsets[positions]
+    lengths = offsets[positions + 1] - begins
+    owners = np.repeat(np.arange(len(positions)), lengths)
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return begins[owners] + within, owners
+
+
+def similarity(intersections: np.ndarray,
+               query_sizes: np.ndarray,
+               set_sizes: np.ndarray,
+               measure: str) -> np.ndarray:
+    if measure == 'overlap':
+        return intersections.astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if measure == 'jaccard':
+            return intersections / (query_sizes + set_sizes - intersections)
+        if measure == 'overlap_coefficient':
+            return intersections / np.minimum(query_sizes, set_sizes)
+    raise ValueError("Unknown measure %s, expected one of %s" % (measure, ', '.join(MEASURES)))
+
+
+class GeneSetIndex:
+    def __init__(self,
+                 names: List[str],
+                 set_sizes: np.ndarray,
+                 gene_ids: np.ndarray,
+                 posting_offsets: np.ndarray,
+                 postings: np.ndarray):
+        self.names = names
+        self.set_sizes = set_sizes
+        self.gene_ids = gene_ids
+        self.posting_offsets = posting_offsets
+        self.postings = postings
+
+    def __len__(self):
+        return len(self.names)
+
+    def _postings_of(self, genes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Gene set ids in the posting lists of `genes` and the query gene each came from"""
+        positions = np.minimum(np.searchsorted(self.gene_ids, genes), max(len(self.gene_ids) - 1, 0))
+        known = np.flatnonzero(self.gene_ids[positions] == genes) if len(self.gene_ids) else \
+            np.zeros(0, dtype=np.int64)
+        postings, owners = _gather_postings(self.posting_offsets, positions[known])
+        return self.postings[postings], known[owners]
+
+    def intersections(self, genes: Iterable[int]) -> np.ndarray:
+        """Number of query genes in every gene set of the library"""
+        set_ids = self._postings_of(_unique_genes(genes))[0]
+        return np.bincount(set_ids, minlength=len(self))
+
+    def query(self, genes: Iterable[int], measure: str = 'jaccard', top_k: int = None) -> List[Tuple[str, float]]:
+        """Gene sets sharing at least one gene with the query, best scores first"""
+        genes = _unique_genes(genes)
+        intersections = self.intersections(genes)
+        hits = np.flatnonzero(intersections)
+        scores = similarity(intersections[hits], len(genes), self.set_sizes[hits], measure)
+        order = np.argsort(-scores, kind='stable')[:top_k]
+        return [(self.names[hits[idx]], float(scores[idx])) for idx in order]
+
+    def batch_intersections(self, queries: List[Iterable[int]]) -> csr_matrix:
+        """Intersection counts of many queries at once as a queries × gene sets sparse matrix"""
+        query_genes = [_unique_genes(genes) for genes in queries]
+        genes = np.concatenate(query_genes) if query_genes else np.zeros(0, dtype=np.int64)
+        query_ids = np.repeat(np.arange(len(queries)), [len(genes) for genes in query_genes])
+
+        set_ids, owners = self._postings_of(genes)
+        counts = coo_matrix((np.ones(len(set_ids), dtype=np.int64), (query_ids[owners], set_ids)),
+                            shape=(len(queries), len(self)))
+        return counts.tocsr()
+
+    def batch_query(self, queries: List[Iterable[int]], measure: str = 'jaccard') -> csr_matrix:
+        """Scores of all query / gene set pairs sharing a gene as a queries × gene sets sparse matrix"""
+        queries = [_unique_genes(genes) for genes in queries]
+        intersections = self.batch_intersections(queries)
+        rows = np.repeat(np.arange(len(queries)), np.diff(intersections.indptr))
+        query_sizes = np.array([len(genes) for genes in queries], dtype=np.int64)
+        scores = similarity(intersections.data, query_sizes[rows], self.set_sizes[intersections.indices], measure)
+        return csr_matrix((scores, intersections.indices, intersections.indptr), shape=intersections.shape)
+
+
+def _build_index(names: List[str], gene_offsets: np.ndarray, genes: np.ndarray) -> GeneSetIndex:
+    set_ids = np.repeat(np.arange(len(names), dtype=np.int32), np.diff(gene_offsets))
+    order = np.lexsort((set_ids, genes))
+    gene_ids, counts = np.unique(genes[order], return_counts=True)
+    posting_offsets = np.zeros(len(gene_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=posting_offsets[1:])
+    return GeneSetIndex(names, np.diff(gene_offsets), gene_ids.astype(np.int64), posting_offsets, set_ids[order])
+
+
+def index_gene_sets(gene_sets: List[GeneSet]) -> GeneSetIndex:
+    gene_offsets, genes = _to_csr([sorted(gene_set.general_info.entrez_gene_ids) for gene_set in gene_sets],
+                                  dtype=np.int64)
+    return _build_index([gene_set.general_info.name for gene_set in gene_sets], gene_offsets, genes)
+
+
+def index_gene_set_store(store_file: str) -> GeneSetIndex:
+    """Builds the index from the membership columns of a gene set store without decoding gene sets"""
+    store = GeneSetStore(store_file)
+    return _build_index(store.strings(store.column('name')), store.column('genes_offsets'),
+                        store.column('genes').astype(np.int64))
+
+
+def save_gene_set_index(index: GeneSetIndex, out_file: str):
+    os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+    with open(out_file, "wb") as f:
+        np.savez(f,
+                 names=np.array(index.names, dtype=str),
+                 set_sizes=index.set_sizes,
+                 gene_ids=index.gene_ids,
+                 posting_offsets=index.posting_offsets,
+                 postings=index.postings)
+
+
+def load_gene_set_index(index_file: str) -> GeneSetIndex:
+    with np.load(index_file) as npz:
+        return GeneSetIndex(npz['names'].tolist(), npz['set_sizes'], npz['gene_ids'], npz['posting_offsets'],
+                            npz['postings'])
@@ -0,0 +1,283 @@
+import json
+import os.path
+from typing import List, Dict, Any, Iterable, Tuple
+
+import numpy as np
+
+from gsd.gene_sets import GeneSet, GeneSetInfo, GOInfo, GOCategory, NCBIGeneInfo, GWASGeneTraitInfo, IdSetView, \
+    Vocabulary, load_gene_sets
+
+# Columnar gene set store: one uncompressed .npz file whose members are only read when first touched.
+# Text lives once in a string table (utf-8 data + offsets), set memberships are CSR-like offset arrays.
+# A string id of -1 marks a missing (NaN) value.
+
+_GO_CATEGORIES = ['molecular_function', 'cellular_component', 'biological_process']
+_GO_FIELDS = ['ids', 'names', 'definitions']
+
+
+class _StringTable:
+    def __init__(self):
+        self.ids = {}
+
+    def intern(self, value) -> int:
+        if not isinstance(value, str):
+            return -1
+        if value not in self.ids:
+            self.ids[value] = len(self.ids)
+        return self.ids[value]
+
+    def intern_all(self, values: Iterable) -> List[int]:
+        return [self.intern(value) for value in values]
+
+    def to_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        encoded = [value.encode() for value in self.ids]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _to_csr(lists: List[List[int]], dtype=np.int32) -> Tuple[np.ndarray, np.ndarray]:
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(values) for values in lists], out=offsets[1:])
+    values = np.fromiter((value for values in lists for value in values), dtype=dtype, count=offsets[-1])
+    return offsets, values
+
+
+def write_gene_set_store(gene_sets: List[GeneSet], out_file: str):
+    strings = _StringTable()
+    columns = {}
+
+    infos = [gene_set.general_info for gene_set in gene_sets]
+    for field in ['name', 'external_id', 'external_source', 'summary']:
+        columns[field] = np.array(strings.intern_all(getattr(info, field) for info in infos), dtype=np.int32)
+    columns['calculated'] = np.array([info.calculated for info in infos], dtype=bool)
+    columns['genes_offsets'], columns['genes'] = _to_csr([sorted(info.entrez_gene_ids) for info in infos])
+    columns['symbols_offsets'], columns['symbols'] = _to_csr(
+        [strings.intern_all(sorted(info.gene_symbols)) for info in infos])
+
+    for category in _GO_CATEGORIES:
+        go_categories = [getattr(gene_set.go_info, category) for gene_set in gene_sets]
+        for field in _GO_FIELDS:
+            columns['go_%s_%s_offsets' % (category, field)], columns['go_%s_%s' % (category, field)] = _to_csr(
+                [strings.intern_all(sorted(getattr(go_category, field), key=str)) for go_category in go_categories])
+
+    if all(getattr(gene_set, 'ncbi_gene_desc', None) is not None for gene_set in gene_sets):
+        gene_infos = [gene_set.ncbi_gene_desc.gene_infos for gene_set in gene_sets]
+        columns['ncbi_keys_offsets'], columns['ncbi_keys'] = _to_csr(
+            [strings.intern_all(str(key) for key in infos) for infos in gene_infos])
+        columns['ncbi_entries'] = _to_csr(
+            [strings.intern_all(json.dumps(entry) for entry in infos.values())
+             for infos in gene_infos])[1]
+
+    if all(getattr(gene_set, 'gwas_gene_traigs', None) is not None for gene_set in gene_sets):
+        gene_traits = [gene_set.gwas_gene_traigs.gene_traits for gene_set in gene_sets]
+        columns['gwas_symbols_offsets'], columns['gwas_symbols'] = _to_csr(
+            [strings.intern_all(traits) for traits in gene_traits])
+        columns['gwas_traits_offsets'], columns['gwas_traits'] = _to_csr(
+            [strings.intern_all(trait_list) for traits in gene_traits for trait_list in traits.values()])
+
+    columns['strings'], columns['string_offsets'] = strings.to_arrays()
+
+    os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+    with open(out_file, "wb") as f:
+        np.savez(f, **columns)
+
+
+def convert_gene_sets_json(gene_sets_file: str,
+                           out_file: str,
+                           ncbi_gene_desc_file: str = None,
+                           gwas_gene_traits_file: str = None):
+    write_gene_set_store(load_gene_sets(gene_sets_file, ncbi_gene_desc_file, gwas_gene_traits_file), out_file)
+
+
+class GeneSetStore:
+    def __init__(self, store_file: str):
+        self.store_file = store_file
+        self.npz = np.load(store_file)
+        self.columns = {}
+        # interned text of the views, lives as long as the store
+        self.vocabulary = Vocabulary()
+
+    def __len__(self):
+        return len(self.column('name'))
+
+    def has(self, name: str) -> bool:
+        return name in self.npz.files
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self.columns:
+            self.columns[name] = self.npz[name]
+        return self.columns[name]
+
+    def members(self, column: str, idx: int, offsets: str = None) -> np.ndarray:
+        offsets = self.column(offsets or column + '_offsets')
+        return self.column(column)[offsets[idx]:offsets[idx + 1]]
+
+    def string(self, string_id: int):
+        if string_id < 0:
+            return np.nan
+        offsets = self.column('string_offsets')
+        return self.column('strings')[offsets[string_id]:offsets[string_id + 1]].tobytes().decode()
+
+    def strings(self, string_ids: Iterable[int]) -> List:
+        return [self.string(string_id) for string_id in string_ids]
+
+    def string_set(self, string_ids: Iterable[int]) -> IdSetView:
+        return IdSetView(self.vocabulary.intern_all(self.strings(string_ids)), self.vocabulary)
+
+    def gene_sets(self) -> List[GeneSet]:
+        with_ncbi = self.has('ncbi_keys')
+        with_gwas = self.has('gwas_symbols')
+        return [GeneSet(StoredGeneSetInfo(self, idx),
+                        StoredGOInfo(self, idx),
+                        StoredNCBIGeneInfo(self, idx) if with_ncbi else None,
+                        StoredGWASGeneTraitInfo(self, idx) if with_gwas else None)
+                for idx in range(len(self))]
+
+
+def load_gene_set_store(store_file: str) -> List[GeneSet]:
+    return GeneSetStore(store_file).gene_sets()
+
+
+def _materialized(obj):
+    return obj
+
+
+# Lazy views on a single gene set of a store. Fields are decoded on first access and cached on the instance.
+# Views pickle (and jsonpickle) as the plain model object with all fields decoded, see `materialize`.
+
+class _StoredObject:
+    _model = None
+
+    def __init__(self, store: GeneSetStore, idx: int):
+        self.store = store
+        self.idx = idx
+        self.cache = {}
+
+    def _cached(self, field: str, fun):
+        if field not in self.cache:
+            self.cache[field] = fun()
+        return self.cache[field]
+
+    def materialize(self):
+        """The plain model object of this view"""
+        obj = self._model.__new__(self._model)
+        obj.__setstate__(self._model.__getstate__(self))
+        return obj
+
+    def __reduce_ex__(self, protocol):
+        return _materialized, (self.materialize(),)
+
+
+class StoredGeneSetInfo(_StoredObject, GeneSetInfo):
+    _model = GeneSetInfo
+
+    @property
+    def name(self) -> str:
+        return self._cached('name', lambda: self.store.string(self.store.column('name')[self.idx]))
+
+    @property
+    def external_id(self) -> str:
+        return self._cached('external_id', lambda: self.store.string(self.store.column('external_id')[self.idx]))
+
+    @property
+    def external_source(self) -> str:
+        return self._cached('external_source',
+                            lambda: self.store.string(self.store.column('external_source')[self.idx]))
+
+    @property
+    def summary(self) -> str:
+        return self._cached('summary', lambda: self.store.string(self.store.column('summary')[self.idx]))
+
+    @property
+    def calculated(self) -> bool:
+        return bool(self.store.column('calculated')[self.idx])
+
+    @property
+    def entrez_gene_ids(self) -> IdSetView:
+        # the store keeps the genes of every gene set sorted and unique
+        return self._cached('entrez_gene_ids', lambda: IdSetView(self.store.members('genes', self.idx)))
+
+    @property
+    def gene_symbols(self) -> IdSetView:
+        return self._cached('gene_symbols', lambda: self.store.string_set(self.store.members('symbols', self.idx)))
+
+
+class StoredGOCategory(_StoredObject, GOCategory):
+    _model = GOCategory
+
+    def __init__(self, store: GeneSetStore, idx: int, category: str):
+        super().__init__(store, idx)
+        self.category = category
+
+    def _field(self, field: str) -> IdSetView:
+        column = 'go_%s_%s' % (self.category, field)
+        return self._cached(field, lambda: self.store.string_set(self.store.members(column, self.idx)))
+
+    @property
+    def ids(self) -> IdSetView:
+        return self._field('ids')
+
+    @property
+    def names(self) -> IdSetView:
+        return self._field('names')
+
+    @property
+    def definitions(self) -> IdSetView:
+        return self._field('definitions')
+
+
+class StoredGOInfo(_StoredObject, GOInfo):
+    _model = GOInfo
+
+    @property
+    def molecular_function(self) -> GOCategory:
+        return self._cached('molecular_function', lambda: StoredGOCategory(self.store, self.idx,
+                                                                           'molecular_function'))
+
+    @property
+    def cellular_component(self) -> GOCategory:
+        return self._cached('cellular_component', lambda: StoredGOCategory(self.store, self.idx,
+                                                                           'cellular_component'))
+
+    @property
+    def biological_process(self) -> GOCategory:
+        return self._cached('biological_process', lambda: StoredGOCategory(self.store, self.idx,
+                                                                           'biological_process'))
+
+
+class StoredNCBIGeneInfo(_StoredObject, NCBIGeneInfo):
+    _model = NCBIGeneInfo
+
+    @property
+    def gene_set_name(self) -> str:
+        return self.store.string(self.store.column('name')[self.idx])
+
+    @property
+    def gene_infos(self) -> Dict[str, Any]:
+        def decode():
+            keys = self.store.strings(self.store.members('ncbi_keys', self.idx))
+            entries = self.store.strings(self.store.members('ncbi_entries', self.idx, 'ncbi_keys_offsets'))
+            return {key: json.loads(entry) for key, entry in zip(keys, entries)}
+
+        return self._cached('gene_infos', decode)
+
+
+class StoredGWASGeneTraitInfo(_StoredObject, GWASGeneTraitInfo):
+    _model = GWASGeneTraitInfo
+
+    @property
+    def gene_set_name(self) -> str:
+        return self.store.string(self.store.column('name')[self.idx])
+
+    @property
+    def gene_traits(self) -> Dict[str, List[str]]:
+        def decode():
+            offsets = self.store.column('gwas_symbols_offsets')
+            trait_offsets = self.store.column('gwas_traits_offsets')
+            traits = self.store.column('gwas_traits')
+            symbols = self.store.strings(self.store.members('gwas_symbols', self.idx))
+            return {symbol: self.store.strings(traits[trait_offsets[entry]:trait_offsets[entry + 1]])
+                    for symbol, entry in zip(symbols, range(offsets[self.idx], offsets[self.idx + 1]))}
+
+        return self._cached('gene_traits', decode)
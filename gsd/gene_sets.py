@@ -1,17 +1,28 @@
+import codecs
 import json
+import os
+import re
+import sys
+import threading
+import urllib.parse
 import urllib.request
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from enum import unique, Enum
-from typing import Set, List, Any, Dict
+from xml.etree.ElementTree import Element, SubElement, tostring
+from collections.abc import Set as AbstractSet
+from typing import Set, List, Any, Dict, Union, Iterable
 import jsonpickle
+import numpy as np
 from anytree import Node
-from biomart import BiomartDataset, BiomartServer
-from pandas import DataFrame, read_table, read_csv
+from pandas import DataFrame, Categorical, read_table
 
 from anytree.importer import JsonImporter
-from pandas.compat import cStringIO
 from tqdm import tqdm
 
 from gsd import flat_list
+from gsd.fetch import HTTPClient, RateLimiter, JsonFileCache
 
 BIOMART_GO_ID = "go_id"
 BIOMART_GO_NAME = "name_1006"
@@ -20,24 +31,254 @@ BIOMART_GO_NAMESPACE = "namespace_1003"
 BIOMART_GO_LINKAGE_TYPE = 'go_linkage_type'
 
 
-class GOCategory:
-    def __init__(self, df: DataFrame):
-        self.ids = set(df[BIOMART_GO_ID].tolist())
-        self.names = set(df[BIOMART_GO_NAME].tolist())
-        self.definitions = set(df[BIOMART_GO_DEFINITION].tolist())
+class Vocabulary:
+    """Interns values to dense int ids so that every distinct value is stored once, however many gene sets use it"""
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.values)
+
+    def intern(self, value) -> int:
+        if value != value:
+            # all NaNs share one id
+            value = np.nan
+        idx = self.ids.get(value)
+        if idx is None:
+            with self.lock:
+                idx = self.ids.setdefault(value, len(self.values))
+                if idx == len(self.values):
+                    self.values.append(value)
+        return idx
+
+    def intern_all(self, values: Iterable) -> np.ndarray:
+        return np.unique(np.fromiter((self.intern(value) for value in values), dtype=np.int32))
+
+
+class Vocabularies:
+    """Vocabularies of the text fields of gene sets. Every model object keeps the instance it was created with."""
+
+    def __init__(self):
+        self.gene_symbols = Vocabulary()
+        self.go_ids = Vocabulary()
+        self.go_names = Vocabulary()
+        self.go_definitions = Vocabulary()
+
+
+_DEFAULT_VOCABULARIES = Vocabularies()
+_scope = threading.local()
+
+
+def current_vocabularies() -> Vocabularies:
+    """Vocabularies of the innermost `vocabulary_scope` of this thread, the module-wide ones outside of any"""
+    scopes = getattr(_scope, 'vocabularies', None)
+    return scopes[-1] if scopes else _DEFAULT_VOCABULARIES
+
+
+@contextmanager
+def vocabulary_scope(vocabularies: Vocabularies = None):
+    """
+    Model objects created within the block intern their text into `vocabularies` (fresh ones by default), which
+    are freed together with the last of these objects instead of growing for the lifetime of the process.
+    """
+    vocabularies = vocabularies or Vocabularies()
+    if getattr(_scope, 'vocabularies', None) is None:
+        _scope.vocabularies = []
+    _scope.vocabularies.append(vocabularies)
+    try:
+        yield vocabularies
+    finally:
+        _scope.vocabularies.pop()
+
+
+def reset_default_vocabularies():
+    """Replaces the module-wide vocabularies, existing model objects keep theirs"""
+    global _DEFAULT_VOCABULARIES
+    _DEFAULT_VOCABULARIES = Vocabularies()
+
+
+class IdSetView(AbstractSet):
+    """Read-only set view on a sorted int32 id array, decoded through `vocabulary` if given"""
+
+    __slots__ = ('array', 'vocabulary')
+
+    def __init__(self, array: np.ndarray, vocabulary: Vocabulary = None):
+        self.array = array
+        self.array.flags.writeable = False
+        self.vocabulary = vocabulary
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        if self.vocabulary is None:
+            return iter(self.array.tolist())
+        values = self.vocabulary.values
+        return (values[idx] for idx in self.array.tolist())
+
+    def __contains__(self, value):
+        if self.vocabulary is not None:
+            value = self.vocabulary.ids.get(np.nan if value != value else value)
+            if value is None:
+                return False
+        elif isinstance(value, (float, np.floating)) and float(value).is_integer():
+            # like a set of ints, 1017.0 is a member if 1017 is
+            value = int(value)
+        elif not isinstance(value, (int, np.integer)):
+            return False
+        pos = np.searchsorted(self.array, value)
+        return pos < len(self.array) and self.array[pos] == value
+
+    def __repr__(self):
+        return "IdSetView(%s)" % set(self)
+
+
+def _to_id_array(values: Iterable, vocabulary: Vocabulary = None) -> np.ndarray:
+    if isinstance(values, IdSetView) and values.vocabulary is vocabulary:
+        return values.array
+    if vocabulary is None:
+        return np.unique(np.fromiter(values, dtype=np.int32))
+    return vocabulary.intern_all(values)
+
+
+class _Record:
+    """
+    Base of the slotted model classes. Instances pickle as a dict of their public fields, which is the attribute
+    layout of gene set files written before the model used slots, so both old and new files can be restored.
+    """
+
+    __slots__ = ()
+    _fields = ()
+
+    def __getstate__(self):
+        state = {field: getattr(self, field) for field in self._fields if hasattr(self, field)}
+        # lazy views (e.g. of a gene set store) are stored as the plain objects they stand for
+        state = {field: value.materialize() if hasattr(value, 'materialize') else value
+                 for field, value in state.items()}
+        return {field: set(value) if isinstance(value, IdSetView) else value for field, value in state.items()}
+
+    def __setstate__(self, state):
+        for field, value in state.items():
+            setattr(self, field, value)
+
+    def _own_vocabularies(self) -> Vocabularies:
+        """Vocabularies of this object, the current ones when its first text field is set (also when unpickling)"""
+        try:
+            return self._vocabularies
+        except AttributeError:
+            self._vocabularies = current_vocabularies()
+            return self._vocabularies
+
+
+class GOCategory(_Record):
+    __slots__ = ('_ids', '_names', '_definitions', '_vocabularies')
+    _fields = ('ids', 'names', 'definitions')
+
+    def __init__(self, ids: Iterable[str], names: Iterable[str], definitions: Iterable[str]):
+        self.ids = ids
+        self.names = names
+        self.definitions = definitions
+
+    @property
+    def ids(self) -> IdSetView:
+        return IdSetView(self._ids, self._own_vocabularies().go_ids)
+
+    @ids.setter
+    def ids(self, ids: Iterable[str]):
+        self._ids = _to_id_array(ids, self._own_vocabularies().go_ids)
+
+    @property
+    def names(self) -> IdSetView:
+        return IdSetView(self._names, self._own_vocabularies().go_names)
+
+    @names.setter
+    def names(self, names: Iterable[str]):
+        self._names = _to_id_array(names, self._own_vocabularies().go_names)
+
+    @property
+    def definitions(self) -> IdSetView:
+        return IdSetView(self._definitions, self._own_vocabularies().go_definitions)
+
+    @definitions.setter
+    def definitions(self, definitions: Iterable[str]):
+        self._definitions = _to_id_array(definitions, self._own_vocabularies().go_definitions)
 
     def __repr__(self):
         return "<GOCategory(n_ids=%d)>" % len(self.ids)
 
 
-class GOInfo:
-    def __init__(self, genes: Set[int], go_anno: DataFrame):
-        self.molecular_function = GOCategory(go_anno[(go_anno['entrezgene'].isin(genes))
-                                                     & (go_anno[BIOMART_GO_NAMESPACE] == "molecular_function")])
-        self.cellular_component = GOCategory(go_anno[(go_anno['entrezgene'].isin(genes))
-                                                     & (go_anno[BIOMART_GO_NAMESPACE] == "cellular_component")])
-        self.biological_process = GOCategory(go_anno[(go_anno['entrezgene'].isin(genes))
-                                                     & (go_anno[BIOMART_GO_NAMESPACE] == "biological_process")])
+GO_NAMESPACES = ["molecular_function", "cellular_component", "biological_process"]
+
+
+def _concat_ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    lengths = ends - starts
+    shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(lengths.sum()) + shifts
+
+
+class GOAnnotationIndex:
+    """Gene -> GO annotation index over a joined entrezgene2go/go table, built once and sliced per gene set"""
+
+    def __init__(self, go_anno: DataFrame):
+        go_anno = go_anno.dropna(subset=['entrezgene', BIOMART_GO_NAMESPACE]) \
+            .sort_values('entrezgene', kind='mergesort')
+
+        genes = go_anno['entrezgene'].values
+        starts = np.flatnonzero(np.r_[True, genes[1:] != genes[:-1]]) if len(genes) > 0 else np.array([], dtype=int)
+        self.genes = genes[starts]
+        self.offsets = np.r_[starts, len(genes)]
+
+        namespaces = Categorical(go_anno[BIOMART_GO_NAMESPACE], categories=GO_NAMESPACES)
+        self.namespace_codes = namespaces.codes
+
+        # per column: row -> id in the GO vocabulary of that column
+        self.vocabularies = current_vocabularies()
+        self.vocabulary_ids = {}
+        for column, vocabulary in [(BIOMART_GO_ID, self.vocabularies.go_ids),
+                                   (BIOMART_GO_NAME, self.vocabularies.go_names),
+                                   (BIOMART_GO_DEFINITION, self.vocabularies.go_definitions)]:
+            values = Categorical(go_anno[column])
+            # code -1 (missing value) maps onto the trailing NaN
+            category_ids = np.append(np.fromiter((vocabulary.intern(value) for value in values.categories),
+                                                 dtype=np.int32, count=len(values.categories)),
+                                     vocabulary.intern(np.nan))
+            self.vocabulary_ids[column] = category_ids[values.codes]
+
+    def rows_of(self, genes: Iterable[int]) -> np.ndarray:
+        genes = np.asarray(sorted(genes))
+        pos = np.searchsorted(self.genes, genes)
+        found = pos < len(self.genes)
+        found[found] = self.genes[pos[found]] == genes[found]
+        pos = pos[found]
+        return _concat_ranges(self.offsets[pos], self.offsets[pos + 1])
+
+    def category_of(self, rows: np.ndarray, namespace: str) -> GOCategory:
+        rows = rows[self.namespace_codes[rows] == GO_NAMESPACES.index(namespace)]
+        vocabularies = self.vocabularies
+        with vocabulary_scope(vocabularies):
+            return GOCategory(
+                IdSetView(np.unique(self.vocabulary_ids[BIOMART_GO_ID][rows]), vocabularies.go_ids),
+                IdSetView(np.unique(self.vocabulary_ids[BIOMART_GO_NAME][rows]), vocabularies.go_names),
+                IdSetView(np.unique(self.vocabulary_ids[BIOMART_GO_DEFINITION][rows]), vocabularies.go_definitions))
+
+
+class GOInfo(_Record):
+    __slots__ = _fields = ('molecular_function', 'cellular_component', 'biological_process')
+
+    def __init__(self, genes: Iterable[int], go_anno: Union[DataFrame, GOAnnotationIndex]):
+        if not isinstance(go_anno, GOAnnotationIndex):
+            go_anno = GOAnnotationIndex(go_anno)
+        rows = go_anno.rows_of(genes)
+        self.molecular_function = go_anno.category_of(rows, "molecular_function")
+        self.cellular_component = go_anno.category_of(rows, "cellular_component")
+        self.biological_process = go_anno.category_of(rows, "biological_process")
 
     def __repr__(self):
         return "<GOInfo(molecular_function=%s, cellular_component=%s, biological_process=%s)>" % \
@@ -58,7 +299,9 @@ class GOType(Enum):
         return go_info.biological_process
 
 
-class NCBIGeneInfo:
+class NCBIGeneInfo(_Record):
+    __slots__ = _fields = ('gene_set_name', 'gene_infos')
+
     def __init__(self,
                  gene_set_name: str,
                  gene_infos: Dict[str, Any]):
@@ -69,7 +312,9 @@ class NCBIGeneInfo:
         return "<NCBIGeneInfo(gene_set_name='%s', gene_infos='%s')>" % (self.gene_set_name, self.gene_infos)
 
 
-class GWASGeneTraitInfo:
+class GWASGeneTraitInfo(_Record):
+    __slots__ = _fields = ('gene_set_name', 'gene_traits')
+
     def __init__(self,
                  gene_set_name: str,
                  gene_traits: Dict[str, List[str]]):
@@ -80,15 +325,19 @@ class GWASGeneTraitInfo:
         return "<GWASGeneTraitInfo(gene_set_name='%s', gene_traits='%s')>" % (self.gene_set_name, self.gene_traits)
 
 
-class GeneSetInfo:
+class GeneSetInfo(_Record):
+    __slots__ = ('name', 'external_id', 'external_source', 'summary', 'calculated', '_entrez_gene_ids',
+                 '_gene_symbols', '_vocabularies')
+    _fields = ('name', 'external_id', 'external_source', 'summary', 'calculated', 'entrez_gene_ids', 'gene_symbols')
+
     def __init__(self,
                  name: str,
                  external_id: str,
                  external_source: str,
                  summary: str,
                  calculated: bool,
-                 entrez_gene_ids: Set[int],
-                 gene_symbols: Set[str]):
+                 entrez_gene_ids: Iterable[int],
+                 gene_symbols: Iterable[str]):
         self.name = name
         self.external_id = external_id
         self.external_source = external_source
@@ -97,16 +346,34 @@ class GeneSetInfo:
         self.entrez_gene_ids = entrez_gene_ids
         self.gene_symbols = gene_symbols
 
+    @property
+    def entrez_gene_ids(self) -> IdSetView:
+        return IdSetView(self._entrez_gene_ids)
+
+    @entrez_gene_ids.setter
+    def entrez_gene_ids(self, entrez_gene_ids: Iterable[int]):
+        self._entrez_gene_ids = _to_id_array(entrez_gene_ids)
+
+    @property
+    def gene_symbols(self) -> IdSetView:
+        return IdSetView(self._gene_symbols, self._own_vocabularies().gene_symbols)
+
+    @gene_symbols.setter
+    def gene_symbols(self, gene_symbols: Iterable[str]):
+        self._gene_symbols = _to_id_array(gene_symbols, self._own_vocabularies().gene_symbols)
+
     def __repr__(self):
         return "<GeneralInfo(name='%s', n_entrez_gene_ids='%s')>" % (self.name, len(self.entrez_gene_ids))
 
 
-class GeneSet:
+class GeneSet(_Record):
+    __slots__ = _fields = ('general_info', 'go_info', 'ncbi_gene_desc', 'gwas_gene_traigs')
+
     def __init__(self,
                  general_info: GeneSetInfo,
                  go_info: GOInfo,
-                 ncbi_gene_desc: Dict[str, Any] = None,
-                 gwas_gene_traigs: Dict[str, List[str]] = None):
+                 ncbi_gene_desc: NCBIGeneInfo = None,
+                 gwas_gene_traigs: GWASGeneTraitInfo = None):
         self.general_info = general_info
         self.go_info = go_info
         self.ncbi_gene_desc = ncbi_gene_desc
@@ -117,8 +384,10 @@ class GeneSet:
 
 
 def annotate_with_go(gene_set_info_list: List[GeneSetInfo], go_anno: DataFrame) -> [GeneSet]:
+    with vocabulary_scope():
+        go_index = GOAnnotationIndex(go_anno)
     return [GeneSet(gene_set_info,
-                    GOInfo(genes=gene_set_info.entrez_gene_ids, go_anno=go_anno))
+                    GOInfo(genes=gene_set_info.entrez_gene_ids, go_anno=go_index))
             for gene_set_info in gene_set_info_list]
 
 
@@ -126,7 +395,8 @@ def annotate_with_go(gene_set_info_list: List[GeneSetInfo], go_anno: DataFrame)
 def load_gene_sets(gene_sets_file: str,
                    ncbi_gene_desc_file: str = None,
                    gwas_gene_traits_file: str = None) -> List[GeneSet]:
-    with open(gene_sets_file) as f:
+    # the text of every load is interned separately and freed with its gene sets
+    with open(gene_sets_file) as f, vocabulary_scope():
         gene_sets = jsonpickle.decode(f.read())
 
     if ncbi_gene_desc_file is not None:
@@ -161,22 +431,134 @@ def load_tree(tree_file: str) -> Node:
         return importer.import_(json_str)
 
 
-def read_go_anno_df(entrezgene2go_file: str, go_file: str) -> DataFrame:
-    entrezgene2go_df = read_table(entrezgene2go_file)
-    go_df = read_table(go_file)
-    return entrezgene2go_df.join(go_df.set_index("go_id"), on="go_id")
+def read_anno_df(anno_file: str) -> DataFrame:
+    if not anno_file.endswith(".npz"):
+        return read_table(anno_file)
+
+    def read_column(anno, column: str):
+        if column in anno.files:
+            return anno[column]
+        categories = anno[column + '.categories'].tobytes().decode().split("\n")
+        return Categorical.from_codes(anno[column + '.codes'], categories)
 
+    with np.load(anno_file) as anno:
+        columns = [str(column) for column in anno['columns']]
+        return DataFrame({column: read_column(anno, column) for column in columns}, columns=columns)
 
-def query_df(ds: BiomartDataset, params: dict) -> DataFrame:
-    response = ds.search(params=params)
-    return read_csv(cStringIO(response.text), sep='\t', names=params['attributes'], dtype=str)
 
+def read_go_anno_df(entrezgene2go_file: str, go_file: str) -> DataFrame:
+    entrezgene2go_df = read_anno_df(entrezgene2go_file)
+    go_df = read_anno_df(go_file)
+    return entrezgene2go_df.join(go_df.set_index("go_id"), on="go_id")
 
-def download_biomart_anno(attributes: List[str], out_file: str):
-    server = BiomartServer("http://www.ensembl.org/biomart")
-    ds = server.datasets["hsapiens_gene_ensembl"]
-    df = query_df(ds, {'attributes': attributes}).dropna()
-    df.to_csv(out_file, sep="\t", index=False)
+
+BIOMART_URL = "http://www.ensembl.org/biomart"
+BIOMART_DATASET = "hsapiens_gene_ensembl"
+BIOMART_INT_ATTRIBUTES = {"entrezgene", "entrezgene_id"}
+
+
+def _biomart_query(dataset: str, attributes: List[str], virtual_schema: str) -> str:
+    query = Element('Query', virtualSchemaName=virtual_schema, formatter='TSV', header='0', uniqueRows='1',
+                    datasetConfigVersion='0.6', completionStamp='1')
+    dataset_elem = SubElement(query, 'Dataset', name=dataset, interface='default')
+    for attribute in attributes:
+        SubElement(dataset_elem, 'Attribute', name=attribute)
+    return tostring(query).decode()
+
+
+class _BinaryAnnoWriter:
+    """Collects streamed Biomart rows as integer columns or categorical codes"""
+
+    def __init__(self, attributes: List[str]):
+        self.attributes = attributes
+        self.values = [array('q') for _ in attributes]
+        self.categories = [None if attribute in BIOMART_INT_ATTRIBUTES else {} for attribute in attributes]
+
+    def add(self, fields: List[str]):
+        for values, categories, field in zip(self.values, self.categories, fields):
+            values.append(int(field) if categories is None else categories.setdefault(field, len(categories)))
+
+    def write(self, out_file: str):
+        columns = {'columns': np.array(self.attributes)}
+        for attribute, values, categories in zip(self.attributes, self.values, self.categories):
+            if categories is None:
+                columns[attribute] = np.frombuffer(values, dtype=np.int64)
+            else:
+                columns[attribute + '.codes'] = np.frombuffer(values, dtype=np.int64).astype(np.int32)
+                # categories never contain newlines (they come from TSV lines), so they are stored newline-separated
+                columns[attribute + '.categories'] = np.frombuffer("\n".join(categories).encode(), dtype=np.uint8)
+        with open(out_file, "wb") as f:
+            np.savez(f, **columns)
+
+
+def stream_biomart_anno(attributes: List[str],
+                        out_file: str,
+                        binary_out_file: str = None,
+                        server_url: str = BIOMART_URL,
+                        dataset: str = BIOMART_DATASET,
+                        virtual_schema: str = "default",
+                        chunk_size: int = 1 << 20):
+    """
+    Streams a Biomart TSV export to `out_file` chunk by chunk. Rows with missing values are dropped, the column
+    count is checked per row and the Biomart completion stamp guards against truncated downloads.
+    """
+    url = "%s/martservice?%s" % (server_url, urllib.parse.urlencode(
+        {'query': _biomart_query(dataset, attributes, virtual_schema)}))
+
+    binary_writer = _BinaryAnnoWriter(attributes) if binary_out_file is not None else None
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    line_no = 0
+    complete = False
+
+    def write_lines(lines: List[str]):
+        nonlocal line_no, complete
+        kept = []
+        for line in lines:
+            line_no += 1
+            if line == "[success]":
+                complete = True
+                continue
+            fields = line.split("\t")
+            if len(fields) != len(attributes):
+                raise ValueError("Biomart response line %d has %d instead of %d columns: %s"
+                                 % (line_no, len(fields), len(attributes), line[:200]))
+            if "" in fields:
+                continue
+            kept.append(line)
+            if binary_writer is not None:
+                binary_writer.add(fields)
+        if kept:
+            out.write("\n".join(kept) + "\n")
+
+    tmp_file = out_file + ".part"
+    try:
+        with urllib.request.urlopen(url) as response, open(tmp_file, "w") as out:
+            out.write("\t".join(attributes) + "\n")
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                lines = (pending + decoder.decode(chunk)).split("\n")
+                pending = lines.pop()
+                write_lines(lines)
+            pending += decoder.decode(b"", final=True)
+            write_lines([pending] if pending else [])
+
+        if not complete:
+            raise IOError("Biomart response for %s is incomplete (no completion stamp)" % out_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+    os.replace(tmp_file, out_file)
+    if binary_writer is not None:
+        binary_writer.write(binary_out_file)
+
+
+def download_biomart_anno(attributes: List[str], out_file: str, binary_out_file: str = None):
+    stream_biomart_anno(attributes, out_file, binary_out_file)
 
 
 def get_json_from(url):
@@ -191,18 +573,61 @@ def chunks(l: List, n: int):
         yield l[i:i + n]
 
 
-def _get_ncbi_gene_desc(entrezgene_list: List[int]):
-    url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?db=gene&id=%s&retmode=json;' % \
-          ','.join([str(x) for x in entrezgene_list])
-    return get_json_from(url)
+NCBI_ESUMMARY_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi'
+
 
+def _get_ncbi_gene_desc(client: HTTPClient, entrezgene_list: List[int], base_url: str, api_key: str = None):
+    params = {'db': 'gene', 'id': ','.join([str(x) for x in entrezgene_list]), 'retmode': 'json'}
+    if api_key is not None:
+        params['api_key'] = api_key
+    return client.get_json('%s?%s' % (base_url, urllib.parse.urlencode(params)))
 
-def _get_all_ncbi_gene_dscr(entrezgene_list: List[int]):
-    chunk_list = [chunk for chunk in chunks(entrezgene_list, 300)]
+
+def _get_all_ncbi_gene_dscr(entrezgene_list: List[int],
+                            cache_dir: str = None,
+                            base_url: str = NCBI_ESUMMARY_URL,
+                            api_key: str = None,
+                            chunk_size: int = 300,
+                            max_workers: int = 3,
+                            requests_per_second: float = None) -> Dict[str, Any]:
+    """
+    Fetches NCBI gene summaries with a bounded number of concurrent requests. Every fetched gene is written to
+    `cache_dir` right away, so a rerun after a failure only requests the genes that are still missing.
+    """
+    if requests_per_second is None:
+        # NCBI E-utilities allow 3 requests per second without an API key and 10 with one
+        requests_per_second = 10 if api_key is not None else 3
+
+    cache = JsonFileCache(cache_dir) if cache_dir is not None else None
     result = {}
-    for chunk in tqdm(chunk_list):
-        part_result = _get_ncbi_gene_desc(chunk)['result']
-        result = {**result, **part_result}
+    missing = []
+    for gene_id in entrezgene_list:
+        entry = cache.get(gene_id) if cache is not None else None
+        if entry is None:
+            missing.append(gene_id)
+        else:
+            result[str(gene_id)] = entry
+
+    client = HTTPClient(RateLimiter(requests_per_second))
+    failed_chunks = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_get_ncbi_gene_desc, client, chunk, base_url, api_key)
+                   for chunk in chunks(missing, chunk_size)]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                part_result = future.result()['result']
+            except (IOError, ValueError, KeyError) as e:
+                print("Failed to fetch NCBI gene summaries: %s" % e, file=sys.stderr)
+                failed_chunks += 1
+                continue
+            for gene_id in part_result['uids']:
+                result[gene_id] = part_result[gene_id]
+                if cache is not None:
+                    cache.put(gene_id, part_result[gene_id])
+
+    if failed_chunks > 0:
+        raise IOError("%d of %d NCBI requests failed, rerun to fetch the remaining genes"
+                      % (failed_chunks, len(futures)))
     return result
 
 
@@ -213,29 +638,46 @@ def create_gene_info(gene_set: GeneSet, data):
     return NCBIGeneInfo(gene_set.general_info.name, genes)
 
 
-def downlaod_ncbi_gene_desc(gene_sets: List[GeneSet], ncbi_gene_desc_file: str):
+def downlaod_ncbi_gene_desc(gene_sets: List[GeneSet], ncbi_gene_desc_file: str, cache_dir: str = None):
     target_genes = set(flat_list([gene_set.general_info.entrez_gene_ids for gene_set in gene_sets]))
-    data = _get_all_ncbi_gene_dscr(list(target_genes))
-    del data['uids']
+    data = _get_all_ncbi_gene_dscr(sorted(target_genes), cache_dir)
 
     gene_info_list = [create_gene_info(gene_set, data) for gene_set in gene_sets]
     with open(ncbi_gene_desc_file, "w") as out_file:
         out_file.write(jsonpickle.encode(gene_info_list))
 
 
-def create_gwas_traits_info(gene_set: GeneSet, gwas_file: DataFrame):
-    tbl_slice = gwas_file.loc[gwas_file['MAPPED_GENE'].isin(gene_set.general_info.gene_symbols),
-                              ["DISEASE/TRAIT", 'MAPPED_GENE']]
+# MAPPED_GENE lists several genes for intergenic ("A - B"), multi-gene ("A, B") and interaction ("A x B") hits
+GWAS_MAPPED_GENE_SEPARATOR = re.compile(r" - |, |; | x ")
+
+
+def read_gwas_trait_index(gwas_file: str, chunksize: int = 100000) -> Dict[str, List[str]]:
+    """Reads gene symbol -> trait list from a GWAS catalog file in one chunked pass over two of its columns"""
+    index = {}
+    for chunk in read_table(gwas_file, usecols=['MAPPED_GENE', 'DISEASE/TRAIT'], dtype=str, chunksize=chunksize):
+        chunk = chunk.dropna()
+        for mapped_gene, trait in zip(chunk['MAPPED_GENE'].tolist(), chunk['DISEASE/TRAIT'].tolist()):
+            for gene_symbol in set(GWAS_MAPPED_GENE_SEPARATOR.split(mapped_gene)):
+                index.setdefault(gene_symbol.strip(), []).append(trait)
+    return index
+
+
+def write_gwas_trait_index(gwas_file: str, gwas_index_out: str):
+    with open(gwas_index_out, "w") as out_file:
+        json.dump(read_gwas_trait_index(gwas_file), out_file)
+
 
-    mapping = {idx: row for idx, row in
-               tbl_slice.groupby('MAPPED_GENE')['DISEASE/TRAIT'].apply(list).iteritems()}
+def create_gwas_traits_info(gene_set: GeneSet, gwas_index: Dict[str, List[str]]):
+    mapping = {gene_symbol: list(gwas_index[gene_symbol])
+               for gene_symbol in sorted(gene_set.general_info.gene_symbols) if gene_symbol in gwas_index}
 
     return GWASGeneTraitInfo(gene_set.general_info.name, mapping)
 
 
-def extract_gwas_traits(gwas_file: str, gene_sets: List[GeneSet], gwas_mapping_out: str):
-    gwas_file = read_table(gwas_file)
-    gene_traits_list = [create_gwas_traits_info(gene_set, gwas_file) for gene_set in gene_sets]
+def extract_gwas_traits(gwas_index_file: str, gene_sets: List[GeneSet], gwas_mapping_out: str):
+    with open(gwas_index_file) as f:
+        gwas_index = json.load(f)
+    gene_traits_list = [create_gwas_traits_info(gene_set, gwas_index) for gene_set in gene_sets]
 
     with open(gwas_mapping_out, "w") as out_file:
         out_file.write(jsonpickle.encode(gene_traits_list))
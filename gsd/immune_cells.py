@@ -2,10 +2,9 @@ import os.path
 from functools import reduce
 from typing import TypeVar, Iterable, Set, Tuple, List, Dict
 
-from anytree import Node
+from anytree import Node, PostOrderIter, PreOrderIter
 from pandas import read_excel, read_table, DataFrame
 
-from gsd import flat_list
 from gsd.gene_sets import GeneSetInfo, GeneSet, annotate_with_go
 
 T = TypeVar('T')
@@ -42,36 +41,44 @@ def filter_missing_sub_trees(node: Node, gene_set_names: Set[str]):
     return node_cpy
 
 
-def to_gene_set(generated_immune_marker_genes, cell_type) -> GeneSetInfo:
-    tbl_slice = generated_immune_marker_genes[generated_immune_marker_genes.cell_type == cell_type]
-
-    return GeneSetInfo(cell_type,
-                       cell_type,
-                       'Literature Review',
-                       "",
-                       False,
-                       set([int(x) for x in tbl_slice['entrezgene']]),
-                       set(tbl_slice['gene_symbol']))
+def to_gene_sets(generated_immune_marker_genes) -> Dict[str, GeneSetInfo]:
+    return {cell_type: GeneSetInfo(cell_type,
+                                   cell_type,
+                                   'Literature Review',
+                                   "",
+                                   False,
+                                   set([int(x) for x in tbl_slice['entrezgene']]),
+                                   set(tbl_slice['gene_symbol']))
+            for cell_type, tbl_slice in generated_immune_marker_genes.groupby('cell_type', sort=False)}
 
 
 def extract_genes_from(node: Node, gene_sets: Dict[str, GeneSetInfo], cell_types_with_genes) -> List[GeneSetInfo]:
-    children_gene_sets = flat_list([extract_genes_from(children, gene_sets, cell_types_with_genes)
-                                    for children in node.children])
-    if node.name in cell_types_with_genes:
-        return [gene_sets[node.name]] + children_gene_sets
-
-    genes = flat_list([children_gene_set.entrez_gene_ids for children_gene_set in children_gene_sets])
-    gene_symbol = flat_list([children_gene_set.gene_symbols for children_gene_set in children_gene_sets])
-
-    parent_gene_set = GeneSetInfo(node.name,
-                                  node.name,
-                                  'Literature Review',
-                                  "",
-                                  True,
-                                  set(genes),
-                                  set(gene_symbol))
-
-    return [parent_gene_set] + children_gene_sets
+    """
+    Returns the gene sets of the tree in pre-order. Cell types without own markers get the union
+    of all their descendants, which is built bottom-up from the already merged child unions.
+    """
+    sub_tree_unions = {}
+    calculated_gene_sets = {}
+    for n in PostOrderIter(node):
+        child_unions = [sub_tree_unions[child] for child in n.children]
+        if n.name in cell_types_with_genes:
+            gene_set = gene_sets[n.name]
+        else:
+            gene_set = GeneSetInfo(n.name,
+                                   n.name,
+                                   'Literature Review',
+                                   "",
+                                   True,
+                                   set().union(*[genes for genes, symbols in child_unions]),
+                                   set().union(*[symbols for genes, symbols in child_unions]))
+            calculated_gene_sets[n] = gene_set
+        if n.children and n.name in cell_types_with_genes:
+            sub_tree_unions[n] = (set(gene_set.entrez_gene_ids).union(*[genes for genes, symbols in child_unions]),
+                                  set(gene_set.gene_symbols).union(*[symbols for genes, symbols in child_unions]))
+        else:
+            sub_tree_unions[n] = (gene_set.entrez_gene_ids, gene_set.gene_symbols)
+
+    return [calculated_gene_sets[n] if n in calculated_gene_sets else gene_sets[n.name] for n in PreOrderIter(node)]
 
 
 def extract_from_raw_data(immune_cell_data_dir: str, gene_sym_hsapiens: DataFrame, go_anno: DataFrame) \
@@ -84,10 +91,8 @@ def extract_from_raw_data(immune_cell_data_dir: str, gene_sym_hsapiens: DataFram
     immune_cell_tree = extract_immune_cell_tree(immune_cell_data_dir)
     immune_cell_tree = filter_missing_sub_trees(immune_cell_tree, cell_types_with_genes)
 
-    gene_sets = [to_gene_set(generated_immune_marker_genes, cell_type) for cell_type in cell_types_with_genes]
-    gene_sets = [gene_set for gene_set in gene_sets if len(gene_set.entrez_gene_ids) > 0]
+    gene_sets = {name: gene_set for name, gene_set in to_gene_sets(generated_immune_marker_genes).items()
+                 if len(gene_set.entrez_gene_ids) > 0}
 
-    all_gene_sets = extract_genes_from(immune_cell_tree,
-                                       {gene_set.name: gene_set for gene_set in gene_sets},
-                                       cell_types_with_genes)
+    all_gene_sets = extract_genes_from(immune_cell_tree, gene_sets, cell_types_with_genes)
     return immune_cell_tree, annotate_with_go(all_gene_sets, go_anno)
@@ -1,39 +1,107 @@
+import json
+import os
 import sys
-from functools import reduce
-from typing import Tuple, List, Set
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, List, Set, Dict, Any
 from anytree import Node
 from pandas import DataFrame
 
 from gsd import flat_list
-from gsd.gene_sets import GeneSetInfo, annotate_with_go, GeneSet, get_json_from
-
-
-def _get_event_hierarchy(tax_id):
-    url = 'https://reactome.org/ContentService/data/eventsHierarchy/%s' % tax_id
-    return get_json_from(url)
-
-
-def _get_reactome_information(reactome_id):
-    url = 'https://reactome.org/ContentService/data/query/%s' % reactome_id
-    return get_json_from(url)
-
-
-def _get_reactome_reference_entities(reactome_id):
-    url = 'https://www.reactome.org/ContentService/data/participants/%s/referenceEntities' % reactome_id
-    return get_json_from(url)
-
-
-def _get_node_by_reactome_id(reactome_node, reactome_id):
-    if reactome_node["stId"] == reactome_id:
-        return reactome_node
-
-    if 'children' in reactome_node:
-        for child in reactome_node['children']:
-            match = _get_node_by_reactome_id(child, reactome_id)
-            if match is not None:
-                return match
-
-    return None
+from gsd.fetch import HTTPClient, RateLimiter, JsonFileCache
+from gsd.gene_sets import GeneSetInfo, annotate_with_go, GeneSet
+
+REACTOME_CONTENT_SERVICE_URL = 'https://reactome.org/ContentService'
+
+
+class ReactomeClient:
+    """
+    Reactome ContentService access through an optional response cache keyed by stId.
+    In offline mode every response has to come from the cache.
+    """
+
+    def __init__(self,
+                 cache_dir: str = None,
+                 offline: bool = False,
+                 base_url: str = REACTOME_CONTENT_SERVICE_URL,
+                 requests_per_second: float = 10):
+        if offline and cache_dir is None:
+            raise ValueError("Offline mode requires a cache directory")
+        self.cache = JsonFileCache(cache_dir) if cache_dir is not None else None
+        self.offline = offline
+        self.base_url = base_url
+        self.client = HTTPClient(RateLimiter(requests_per_second))
+        # stId -> GeneSetInfo, shared by all sub-trees extracted through this client
+        self.gene_sets = {}
+
+    def get(self, cache_key: str, path: str) -> Any:
+        if self.cache is not None and cache_key in self.cache:
+            return self.cache.get(cache_key)
+        if self.offline:
+            raise KeyError("%s is not in the Reactome cache" % cache_key)
+
+        data = self.client.get_json(self.base_url + path)
+        if self.cache is not None:
+            self.cache.put(cache_key, data)
+        return data
+
+    def get_event_hierarchy(self, tax_id) -> List[Dict]:
+        return self.get('eventsHierarchy_%s' % tax_id, '/data/eventsHierarchy/%s' % tax_id)
+
+    def get_reactome_information(self, reactome_id: str) -> Dict:
+        return self.get('%s_query' % reactome_id, '/data/query/%s' % reactome_id)
+
+    def get_reactome_reference_entities(self, reactome_id: str) -> List[Dict]:
+        return self.get('%s_referenceEntities' % reactome_id,
+                        '/data/participants/%s/referenceEntities' % reactome_id)
+
+
+class ReactomeHierarchy:
+    """Event hierarchy snapshot with an stId -> node index and parent pointers"""
+
+    def __init__(self, events: List[Dict]):
+        self.events = events
+        self.nodes = {}
+        self.parents = {}
+
+        stack = [(event, None) for event in events]
+        while stack:
+            node, parent_id = stack.pop()
+            self.nodes.setdefault(node['stId'], node)
+            parents = self.parents.setdefault(node['stId'], [])
+            if parent_id is not None and parent_id not in parents:
+                parents.append(parent_id)
+            stack.extend((child, node['stId']) for child in node.get('children', []))
+
+    def __contains__(self, reactome_id: str) -> bool:
+        return reactome_id in self.nodes
+
+    def sub_tree(self, reactome_id: str) -> Dict:
+        if reactome_id not in self.nodes:
+            raise KeyError("%s is not part of the Reactome event hierarchy" % reactome_id)
+        return self.nodes[reactome_id]
+
+    def ancestors(self, reactome_id: str) -> List[str]:
+        ancestors = []
+        stack = list(self.parents[reactome_id])
+        while stack:
+            parent_id = stack.pop()
+            if parent_id not in ancestors:
+                ancestors.append(parent_id)
+                stack.extend(self.parents[parent_id])
+        return ancestors
+
+
+def download_reactome_hierarchy(tax_id: int, snapshot_file: str, client: ReactomeClient = None):
+    client = client or ReactomeClient()
+    os.makedirs(os.path.dirname(snapshot_file) or ".", exist_ok=True)
+    with open(snapshot_file, "w") as f:
+        json.dump(client.get_event_hierarchy(tax_id), f)
+
+
+def load_reactome_hierarchy(snapshot_file: str) -> ReactomeHierarchy:
+    with open(snapshot_file) as f:
+        return ReactomeHierarchy(json.load(f))
 
 
 def _extract_entrezgene_ident(gene_product):
@@ -44,8 +112,14 @@ def _extract_entrezgene_ident(gene_product):
             ident.startswith(entrezgene_prefix)]
 
 
-def _extract_reactome_gene_set(reactome_id) -> GeneSetInfo:
-    reference_entities = _get_reactome_reference_entities(reactome_id)
+def _get_reactome_gene_set(client: ReactomeClient, reactome_id) -> GeneSetInfo:
+    if reactome_id not in client.gene_sets:
+        client.gene_sets[reactome_id] = _extract_reactome_gene_set(client, reactome_id)
+    return client.gene_sets[reactome_id]
+
+
+def _extract_reactome_gene_set(client: ReactomeClient, reactome_id) -> GeneSetInfo:
+    reference_entities = client.get_reactome_reference_entities(reactome_id)
 
     gene_products = [elem for elem in reference_entities if elem["className"] == "ReferenceGeneProduct"]
 
@@ -66,7 +140,7 @@ def _extract_reactome_gene_set(reactome_id) -> GeneSetInfo:
 
     reactome_genes = set(reactome_genes)
 
-    reactome_info = _get_reactome_information(reactome_id)
+    reactome_info = client.get_reactome_information(reactome_id)
 
     reactome_name = reactome_info['displayName']
     reactome_summation = reactome_info['summation']
@@ -77,7 +151,7 @@ def _extract_reactome_gene_set(reactome_id) -> GeneSetInfo:
     if len(reactome_summation) == 0:
         print("%s has no summary" % reactome_id, file=sys.stderr)
 
-    reactome_summary = reduce(lambda a, b: a + " <br><br><br> " + b, [x['text'] for x in reactome_summation])
+    reactome_summary = " <br><br><br> ".join([x['text'] for x in reactome_summation])
 
     return GeneSetInfo("%s (%s)" % (reactome_name, reactome_info['stId']),
                        reactome_info['stId'],
@@ -88,11 +162,27 @@ def _extract_reactome_gene_set(reactome_id) -> GeneSetInfo:
                        symbol_list)
 
 
-def _dump_gene_sets(reactome_node) -> List[GeneSetInfo]:
-    gene_set = [_extract_reactome_gene_set(reactome_node['stId'])]
-    if 'children' not in reactome_node:
-        return gene_set
-    return gene_set + reduce(lambda a, b: a + b, [_dump_gene_sets(node) for node in reactome_node['children']])
+def _sub_tree_ids(reactome_node) -> List[str]:
+    """Returns the stIds of a Reactome event tree in pre-order, including repeated sub-pathways"""
+    reactome_ids = []
+    stack = [reactome_node]
+    while stack:
+        node = stack.pop()
+        reactome_ids.append(node['stId'])
+        stack.extend(reversed(node.get('children', [])))
+    return reactome_ids
+
+
+def _dump_gene_sets(client: ReactomeClient, reactome_node, max_workers: int = 8) -> List[GeneSetInfo]:
+    reactome_ids = _sub_tree_ids(reactome_node)
+    unique_ids = list(dict.fromkeys(reactome_ids))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        gene_sets = dict(zip(unique_ids,
+                             executor.map(lambda reactome_id: _get_reactome_gene_set(client, reactome_id),
+                                          unique_ids)))
+
+    return [gene_sets[reactome_id] for reactome_id in reactome_ids]
 
 
 def _reactome_to_anytree(node, filters: Set[str], parent: Node = None) -> Node:
@@ -104,16 +194,23 @@ def _reactome_to_anytree(node, filters: Set[str], parent: Node = None) -> Node:
     return n
 
 
-def download(tax_id: int, reactome_id: str, go_anno: DataFrame) -> Tuple[Node, List[GeneSet]]:
-    reactome_tree = _get_event_hierarchy(tax_id)
-
-    reactome_pseudo_tree = {'stId': "FAKE", 'name': "PseudoRoot", 'children': reactome_tree}
+def download(tax_id: int,
+             reactome_id: str,
+             go_anno: DataFrame,
+             cache_dir: str = None,
+             offline: bool = False,
+             base_url: str = REACTOME_CONTENT_SERVICE_URL,
+             max_workers: int = 8,
+             hierarchy: ReactomeHierarchy = None,
+             client: ReactomeClient = None) -> Tuple[Node, List[GeneSet]]:
+    client = client or ReactomeClient(cache_dir, offline, base_url)
+    hierarchy = hierarchy or ReactomeHierarchy(client.get_event_hierarchy(tax_id))
 
-    sub_tree = _get_node_by_reactome_id(reactome_pseudo_tree, reactome_id)
+    sub_tree = hierarchy.sub_tree(reactome_id)
 
-    gene_sets = _dump_gene_sets(sub_tree)
-    reactome_ids = [gene_set.external_id for gene_set in gene_sets]
-    duplicated_ids = set([x for x in reactome_ids if reactome_ids.count(x) > 1])
+    gene_sets = _dump_gene_sets(client, sub_tree, max_workers)
+    id_counts = Counter(gene_set.external_id for gene_set in gene_sets)
+    duplicated_ids = set([x for x, count in id_counts.items() if count > 1])
 
     if len(duplicated_ids) > 0:
         print("%s has %d redundant child pathways. Gene sets %s are removed from analysis" %
@@ -125,3 +222,19 @@ def download(tax_id: int, reactome_id: str, go_anno: DataFrame) -> Tuple[Node, L
     root = _reactome_to_anytree(sub_tree, duplicated_ids)
 
     return root, annotate_with_go(unique_gene_sets, go_anno)
+
+
+def download_sub_trees(tax_id: int,
+                       reactome_ids: List[str],
+                       go_anno: DataFrame,
+                       cache_dir: str = None,
+                       offline: bool = False,
+                       base_url: str = REACTOME_CONTENT_SERVICE_URL,
+                       max_workers: int = 8,
+                       hierarchy: ReactomeHierarchy = None) -> Dict[str, Tuple[Node, List[GeneSet]]]:
+    """Extracts several (possibly overlapping) sub-trees, fetching every pathway only once"""
+    client = ReactomeClient(cache_dir, offline, base_url)
+    hierarchy = hierarchy or ReactomeHierarchy(client.get_event_hierarchy(tax_id))
+    return {reactome_id: download(tax_id, reactome_id, go_anno, max_workers=max_workers,
+                                  hierarchy=hierarchy, client=client)
+            for reactome_id in reactome_ids}
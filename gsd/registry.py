@@ -0,0 +1,151 @@
+import argparse
+import importlib
+import subprocess
+import sys
+from collections import OrderedDict
+from typing import List, Tuple, Dict
+
+# Metric keys of all categories, importable without the implementation modules: NLP pulls in gensim and
+# nltk, PPI pandas and scipy, GO starts R. A metric is created by importing its module on first use and
+# calling the registry entry there with the declared resources.
+#
+# Keys must match the registries of the implementation modules (GENERAL_DISTS, NLP_DISTS, ...).
+
+W2V_MODEL = 'w2v_model'
+TOKEN_CACHE = 'token_cache'
+GENE_EMBEDDINGS = 'gene_embeddings'
+PPI_DATA = 'ppi_data'
+GO_DATA = 'go_data'
+THREADS = 'threads'
+
+
+class MetricSpec:
+    def __repr__(self):
+        return "MetricSpec(metric_id=%s, requires=%s)" % (self.metric_id, list(self.requires))
+
+    def __init__(self, category: str, key: str, module: str, attribute: str, requires: Tuple[str, ...] = ()):
+        self.category = category
+        self.key = key
+        self.module = module
+        self.attribute = attribute
+        self.requires = requires
+
+    @property
+    def metric_id(self) -> str:
+        return "%s/%s" % (self.category, self.key)
+
+    def load(self):
+        """Entry of the implementation registry: a metric instance or a factory taking the resources"""
+        return getattr(importlib.import_module(self.module), self.attribute)[self.key]
+
+    def create(self, resources):
+        """Creates the metric, `resources` provides a loader method for every requirement"""
+        import copy
+        from gsd.distance import DistanceMetric
+
+        entry = self.load()
+        if isinstance(entry, DistanceMetric):
+            # shared registry instances must not see the extractors the runner installs
+            return copy.copy(entry)
+        return entry(*[getattr(resources, requirement)() for requirement in self.requires])
+
+
+def _specs(category: str, module: str, attribute: str, keys: List[str], requires: Tuple[str, ...] = ()):
+    return OrderedDict((key, MetricSpec(category, key, module, attribute, requires)) for key in keys)
+
+
+def _merged(*specs: Dict[str, MetricSpec]):
+    return OrderedDict(item for category_specs in specs for item in category_specs.items())
+
+
+METRICS = OrderedDict([
+    ('general', _specs('general', 'gsd.distance.general', 'GENERAL_DISTS', [
+        'Minkowski_distance_p1_over_genes',
+        'Minkowski_distance_p2_over_genes',
+        'Jaccard_distance_over_genes',
+        'Kappa_distance_over_genes',
+        'Overlap_distance_over_genes',
+        'Minkowski_distance_p1_over_gene_traits',
+        'Minkowski_distance_p2_over_gene_traits',
+        'Jaccard_distance_over_gene_traits',
+        'Kappa_distance_over_gene_traits',
+        'Overlap_distance_over_gene_traits',
+        'Minkowski_distance_p1_over_gene_trait_frequency',
+        'Minkowski_distance_p2_over_gene_trait_frequency',
+        'Cosine_distance_over_gene_trait_frequency'])),
+    ('benchmark', _specs('benchmark', 'gsd.distance.benchmark', 'BENCHMARK_DISTS', [
+        'Random_0_1'])),
+    ('nlp', _merged(
+        _specs('nlp', 'gsd.distance.nlp', 'NLP_DISTS', [
+            'Cosine_dist_over_gene_sym',
+            'Cosine_dist_over_summary',
+            'Cosine_dist_over_ncbi_sum',
+            'Cosine_dist_over_go_bp_desc',
+            'Cosine_dist_over_go_cc_desc',
+            'Cosine_dist_over_go_mf_desc'], (W2V_MODEL, TOKEN_CACHE, GENE_EMBEDDINGS)),
+        # WMD solves its EMDs in `threads` worker processes
+        _specs('nlp', 'gsd.distance.nlp', 'NLP_DISTS', [
+            'WM_dist_over_gene_sym',
+            'WM_dist_over_summary',
+            'WM_dist_over_ncbi_summary'], (W2V_MODEL, TOKEN_CACHE, GENE_EMBEDDINGS, THREADS)))),
+    ('ppi', _specs('ppi', 'gsd.distance.ppi', 'PPI_DISTS', [
+        'Direct_PPI',
+        'Dijkstra_BMA_PPI'], (PPI_DATA,))),
+    ('go', _specs('go', 'gsd.distance.go', 'GO_DISTS', [
+        'GO_SIM_BP_Wang_BMA',
+        'GO_SIM_CC_Wang_BMA',
+        'GO_SIM_MF_Wang_BMA'], (GO_DATA,))),
+])
+
+CATEGORIES = list(METRICS)
+
+
+def metric_keys(category: str) -> List[str]:
+    if category not in METRICS:
+        raise KeyError("Unknown metric category %s, expected one of %s" % (category, ', '.join(CATEGORIES)))
+    return list(METRICS[category])
+
+
+def metric_spec(metric_id: str) -> MetricSpec:
+    category, key = metric_id.split('/', 1)
+    if key not in metric_keys(category):
+        raise KeyError("Unknown metric %s" % metric_id)
+    return METRICS[category][key]
+
+
+def import_time(module: str) -> float:
+    """Seconds to import `module` in a fresh interpreter"""
+    code = "import time; begin = time.perf_counter(); import %s; print(time.perf_counter() - begin)" % module
+    output = subprocess.check_output([sys.executable, "-c", code], stderr=subprocess.DEVNULL)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def import_times() -> Dict[str, float]:
+    """Import times of the registry and of the implementation module of every category"""
+    modules = ['gsd.registry'] + list(OrderedDict.fromkeys(spec.module for specs in METRICS.values()
+                                                           for spec in specs.values()))
+    times = OrderedDict()
+    for module in modules:
+        try:
+            times[module] = import_time(module)
+        except subprocess.CalledProcessError:
+            times[module] = float('nan')
+    return times
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Lists the registered distance metrics")
+    parser.add_argument("--import-times", action="store_true",
+                        help="measure the import time of every implementation module")
+    args = parser.parse_args(args)
+
+    for category, specs in METRICS.items():
+        for spec in specs.values():
+            print("%s\t%s" % (spec.metric_id, ", ".join(spec.requires) or "-"))
+    if args.import_times:
+        for module, seconds in import_times().items():
+            print("%s\t%s" % (module, "not importable" if seconds != seconds else "%.3fs" % seconds))
+
+
+if __name__ == '__main__':
+    main()
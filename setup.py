@@ -8,7 +8,6 @@ setup(
     install_requires=[
         'scipy',
         'pandas',
-        'biomart',
         'anytree',
         'jsonpickle',
         'numpy',
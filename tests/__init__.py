@@ -9,3 +9,52 @@ def has_equal_elements(left, right, epsilon=None):
     if epsilon is not None:
         return all([abs(left_elem - right_elem) <= epsilon for left_elem, right_elem in zip(left, right)])
     return all([left_elem == right_elem for left_elem, right_elem in zip(left, right)])
+
+
+class StubHTTPServer:
+    """
+    Serves `handler(path) -> (status, body)` on a random localhost port while used as a context manager.
+    Requested paths are recorded in `requests`.
+    """
+
+    def __init__(self, handler):
+        import http.server
+        import threading
+
+        stub = self
+        self.handler = handler
+        self.requests = []
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self, body_in: bytes = None):
+                stub.requests.append(self.path)
+                status, body = stub.handler(self.path) if body_in is None else stub.handler(self.path, body_in)
+                if isinstance(body, str):
+                    body = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._respond()
+
+            def do_POST(self):
+                self._respond(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,44 @@
+import numpy as np
+
+from gsd.distance.ann import build_ann_index, load_ann_index, recall_report
+
+random = np.random.RandomState(0)
+vectors = random.randn(500, 8)
+queries = vectors[:20] + 0.01 * random.randn(20, 8)
+
+
+def test_exhaustive_search_is_exact():
+    index = build_ann_index(vectors, n_trees=4, leaf_size=8)
+    ids, distances = index.query(queries[0], k=5, search_k=len(vectors))
+    exact_ids, exact_distances = index.exact_query(queries[0], k=5)
+    assert ids.tolist() == exact_ids.tolist()
+    assert np.allclose(distances, exact_distances)
+    assert ids[0] == 0
+
+
+def test_recall_grows_with_search_k():
+    index = build_ann_index(vectors, n_trees=8, leaf_size=8)
+    report = recall_report(index, queries, k=5, search_ks=[5, 40, len(vectors)])
+    assert [row['search_k'] for row in report] == [5, 40, len(vectors)]
+    assert report[0]['recall'] <= report[1]['recall'] <= report[2]['recall'] == 1.0
+
+
+def test_insert_after_load(tmpdir):
+    index = build_ann_index(vectors[:400], labels=["set%d" % idx for idx in range(400)], n_trees=4, leaf_size=8)
+    index.save(str(tmpdir))
+
+    loaded = load_ann_index(str(tmpdir))
+    assert isinstance(loaded.vectors, np.memmap)
+    assert loaded.query(queries[1], k=3)[0].tolist() == index.query(queries[1], k=3)[0].tolist()
+
+    loaded.add(vectors[400:], labels=["set%d" % idx for idx in range(400, 500)])
+    assert len(loaded) == 500
+    assert loaded.query_labels(vectors[450], k=1)[0][0] == "set450"
+    ids, distances = loaded.query(vectors[450], k=10, search_k=len(vectors))
+    assert ids.tolist() == loaded.exact_query(vectors[450], k=10)[0].tolist()
+
+
+def test_zero_vectors_come_last():
+    index = build_ann_index(np.vstack([np.zeros((1, 8)), vectors[:10]]), n_trees=2, leaf_size=4)
+    ids, distances = index.query(vectors[0], k=11, search_k=11)
+    assert ids[-1] == 0 and np.isnan(distances[-1])
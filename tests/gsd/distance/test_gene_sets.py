@@ -1,3 +1,6 @@
+import jsonpickle
+import numpy as np
+
 import gsd.gene_sets
 
 def test_load():
@@ -5,3 +8,38 @@ def test_load():
     assert len(gene_sets) == 3
     assert gene_sets[0].general_info.name == 'SetA'
     assert len(gene_sets[0].go_info.biological_process.ids) > 5
+
+
+def test_interned_views():
+    gene_sets = gsd.gene_sets.load_gene_sets("gsd/distance/fake_gene_sets.json")
+    general_info = gene_sets[0].general_info
+    assert general_info.entrez_gene_ids == {8908, 2997, 2998}
+    assert 2997 in general_info.entrez_gene_ids
+    assert general_info.entrez_gene_ids | {1} == {1, 8908, 2997, 2998}
+    assert general_info.gene_symbols == {'GYS1', 'GYS2', 'GYG2'}
+    assert 'GYS3' not in general_info.gene_symbols
+    assert 2997.0 in general_info.entrez_gene_ids and np.float32(2997) in general_info.entrez_gene_ids
+    assert 2997.5 not in general_info.entrez_gene_ids
+
+    definitions = gene_sets[0].go_info.biological_process._definitions
+    assert definitions.dtype == np.int32
+    assert list(definitions) == sorted(definitions)
+
+
+def test_encode_roundtrip():
+    gene_sets = gsd.gene_sets.load_gene_sets("gsd/distance/fake_gene_sets.json")
+    decoded = jsonpickle.decode(jsonpickle.encode(gene_sets))
+    assert decoded[1].general_info.entrez_gene_ids == gene_sets[1].general_info.entrez_gene_ids
+    assert decoded[1].go_info.molecular_function.names == gene_sets[1].go_info.molecular_function.names
+
+
+def test_vocabularies_per_load():
+    first = gsd.gene_sets.load_gene_sets("gsd/distance/fake_gene_sets.json")
+    second = gsd.gene_sets.load_gene_sets("gsd/distance/fake_gene_sets.json")
+    assert first[0].general_info.gene_symbols == second[0].general_info.gene_symbols
+    assert first[0].general_info._vocabularies is not second[0].general_info._vocabularies
+
+    with gsd.gene_sets.vocabulary_scope() as vocabularies:
+        category = gsd.gene_sets.GOCategory(['GO:1'], ['name'], [np.nan])
+    assert category._vocabularies is vocabularies and len(vocabularies.go_ids) == 1
+    assert np.nan in category.definitions and float('nan') in category.definitions
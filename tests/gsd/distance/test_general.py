@@ -1,11 +1,13 @@
+import numpy as np
 from anytree import Node
-from scipy.spatial.distance import pdist
+from scipy.spatial.distance import pdist, squareform
 
 from gsd.distance import PairwiseTreePathDistanceMetric
 from tests import has_equal_elements
 
 from gsd.distance.general import overlap_coefficient, to_binary_matrix, to_gene_id_map, to_gene_trait_map, \
-    MatrixBasedDistanceMetric, kappa_distance, overlap_distance, to_gene_trait_freq, to_freq_matrix
+    MatrixBasedDistanceMetric, kappa_distance, overlap_distance, to_gene_trait_freq, to_freq_matrix, \
+    similarity_join, gene_similarity_join
 from tests.gsd.distance import gene_sets
 
 
@@ -107,3 +109,29 @@ def test_to_freq_matrix():
     }
     assert to_freq_matrix(freqs) == [[2, 1, 3, 0],
                                      [0, 2, 0, 3]]
+
+
+def test_similarity_join():
+    random = np.random.RandomState(3)
+    id_sets = [set(random.choice(60, random.randint(1, 15), replace=False).tolist()) for _ in range(80)]
+    id_sets += [set(id_sets[0]), set()]
+    matrix = np.array(to_binary_matrix(dict(enumerate(id_sets))))
+    jaccard = squareform(pdist(matrix, 'jaccard'))
+    overlap = squareform(overlap_distance(matrix[:-1]))
+
+    for threshold in [0.2, 0.5, 1.0]:
+        joined = similarity_join(id_sets, threshold)
+        expected = {(i, j): jaccard[i, j] for i in range(len(id_sets) - 1) for j in range(i + 1, len(id_sets) - 1)
+                    if 1 - jaccard[i, j] >= threshold - 1e-12}
+        assert {(i, j) for i, j in zip(joined.row, joined.col)} == set(expected)
+        assert all(abs(d - expected[(i, j)]) < 1e-12 for i, j, d in zip(joined.row, joined.col, joined.data))
+
+        joined = similarity_join(id_sets, threshold, 'overlap')
+        expected = {(i, j) for i in range(len(id_sets) - 2) for j in range(i + 1, len(id_sets) - 1)
+                    if 1 - overlap[i, j] >= threshold - 1e-12}
+        assert {(i, j) for i, j in zip(joined.row, joined.col)} == expected
+    assert (0, 80) in {(i, j) for i, j in zip(joined.row, joined.col)}
+
+    d = gene_similarity_join(gene_sets, 0.2)
+    assert has_equal_elements(d.toarray()[np.triu_indices(len(gene_sets), 1)], [0.5, 0.5, 0.8], epsilon=0.001)
+    assert d.nnz == 3 and gene_similarity_join(gene_sets, 0.5).nnz == 2
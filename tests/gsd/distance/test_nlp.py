@@ -3,10 +3,12 @@
 from gensim.models import KeyedVectors
 
 from gsd.gene_sets import GOType
+from gsd.distance.wmd import WMDistance
 from gsd.distance.nlp import NLPDistance, extract_gene_symbols, \
     extract_words_from_gene_set_summary, extract_words_from_go_descriptions, cosine_distance_of, \
     extract_words_from_go_names, extract_words_from_gene_symbols_and_summary_and_go_info, wm_distance_of, \
-    extract_summary_from_ncbi_descs
+    extract_summary_from_ncbi_descs, EmbeddingCosineDistance, prune_w2v_model, load_w2v_model, \
+    GeneEmbeddingCosineDistance, build_gene_embeddings, save_gene_embeddings, load_gene_embeddings
 from tests import has_equal_elements
 from tests.gsd.distance import gene_sets
 
@@ -66,3 +68,50 @@ def test_wm_distance_over_gene_symbols():
 def test_extract_summary_from_ncbi_gene_desc():
     summary_words = extract_summary_from_ncbi_descs(gene_sets[0], w2v_model)
     assert has_equal_elements(summary_words[:3], ['gys1', 'glycogen', 'synthase'])
+
+
+def test_embedding_cosine_distance_matches_pairwise_cosine():
+    pairwise = NLPDistance("Cosine Distance over gene symbols",
+                           lambda x, y: cosine_distance_of(x, y, w2v_model),
+                           lambda x: extract_gene_symbols(x, w2v_model))
+    vectorized = EmbeddingCosineDistance("Cosine Distance over gene symbols",
+                                         lambda x: extract_gene_symbols(x, w2v_model),
+                                         w2v_model)
+    assert has_equal_elements(vectorized.calc(gene_sets), pairwise.calc(gene_sets), epsilon=0.0001)
+
+
+def test_batched_wm_distance_over_gene_symbols():
+    dist_metric = WMDistance("WM Distance over gene symbols",
+                             lambda x: extract_gene_symbols(x, w2v_model),
+                             w2v_model,
+                             n_jobs=1)
+    d = dist_metric.calc(gene_sets)
+    assert has_equal_elements(d, [1.013, 0.458, 1.472], epsilon=0.001)
+
+
+def test_pruned_w2v_model(tmpdir):
+    model_file = str(tmpdir.join("pruned.kv"))
+    prune_w2v_model(w2v_model, gene_sets, model_file)
+    pruned_model = load_w2v_model(model_file)
+
+    assert len(pruned_model.vocab) < len(w2v_model.vocab)
+    assert extract_gene_symbols(gene_sets[0], pruned_model) == extract_gene_symbols(gene_sets[0], w2v_model)
+    d = EmbeddingCosineDistance("Cosine Distance over gene symbols",
+                                lambda x: extract_gene_symbols(x, pruned_model),
+                                pruned_model).calc(gene_sets)
+    assert has_equal_elements(d, [0.080, 0.015, 0.101], epsilon=0.001)
+
+
+def test_gene_embedding_cosine_distance(tmpdir):
+    embedding_file = str(tmpdir.join("gene_embeddings.npz"))
+    save_gene_embeddings(build_gene_embeddings(gene_sets[:2], w2v_model), embedding_file)
+    gene_embeddings = load_gene_embeddings(embedding_file)
+    n_genes = len(gene_embeddings['ncbi_summary'])
+
+    d = GeneEmbeddingCosineDistance("Cosine distance over NCBI summary", 'ncbi_summary', w2v_model,
+                                    gene_embeddings).calc(gene_sets)
+    expected = EmbeddingCosineDistance("Cosine distance over NCBI summary",
+                                       lambda x: extract_summary_from_ncbi_descs(x, w2v_model),
+                                       w2v_model).calc(gene_sets)
+    assert has_equal_elements(d, expected, epsilon=0.0001)
+    assert len(gene_embeddings['ncbi_summary']) >= n_genes
@@ -0,0 +1,77 @@
+import numpy as np
+from pandas import DataFrame
+
+from gsd.distance.general import GENERAL_DISTS
+from gsd.distance.null_model import NullModel, GENE_KERNELS, size_matched_null_model, degree_matched_null_model, \
+    gene_set_kernel, embedding_cosine_kernel, null_distribution, empirical_null, quantile_strata
+from tests.gsd.distance import gene_sets
+
+
+def random_model(strata: bool = False) -> NullModel:
+    random = np.random.RandomState(1)
+    universe = np.arange(100, 160)
+    set_genes = [random.choice(universe, size, replace=False) for size in [3, 8, 5, 12, 4]]
+    return NullModel(set_genes, universe, universe % 4 if strata else None)
+
+
+def test_sample():
+    model = random_model(strata=True)
+    batch = model.sample(np.random.RandomState(0), 50)
+    assert batch.membership.shape == (250, 60)
+    assert np.all(batch.set_sizes == model.set_sizes)
+    strata = model.strata[batch.membership.indices]
+    for row in range(batch.membership.shape[0]):
+        genes = batch.membership.indices[batch.membership.indptr[row]:batch.membership.indptr[row + 1]]
+        assert len(set(genes)) == len(genes)
+    # every random gene set keeps the stratum profile of its target gene set
+    target = model.observed()
+    for row in range(batch.membership.shape[0]):
+        drawn = strata[batch.membership.indptr[row]:batch.membership.indptr[row + 1]]
+        target_row = row % len(model)
+        expected = model.strata[target.membership.indices[
+                                target.membership.indptr[target_row]:target.membership.indptr[target_row + 1]]]
+        assert sorted(drawn) == sorted(expected)
+
+    again = model.sample(np.random.RandomState(0), 50)
+    assert np.array_equal(batch.membership.indices, again.membership.indices)
+
+
+def test_gene_kernels_match_metrics():
+    model = size_matched_null_model(gene_sets)
+    for key, kernel in GENE_KERNELS.items():
+        assert np.allclose(kernel(model.observed())[0], GENERAL_DISTS[key].calc(gene_sets))
+
+    model = random_model()
+    batch = model.sample(np.random.RandomState(3), 4)
+    for key, kernel in GENE_KERNELS.items():
+        assert np.allclose(kernel(batch), gene_set_kernel(GENERAL_DISTS[key], model.universe)(batch))
+
+
+def test_embedding_kernel():
+    model = random_model()
+    vectors = np.random.RandomState(0).rand(len(model.universe), 5)
+    batch = model.sample(np.random.RandomState(0), 3)
+    d = embedding_cosine_kernel(vectors)(batch)
+    embeddings = np.asarray(batch.membership[len(model):2 * len(model)] @ vectors)
+    a, b = embeddings[0], embeddings[1]
+    assert np.isclose(d[1, 0], 1 - a.dot(b) / np.linalg.norm(a) / np.linalg.norm(b))
+
+
+def test_null_distribution():
+    model = random_model()
+    kernel = GENE_KERNELS['Jaccard_distance_over_genes']
+    null = null_distribution(model, kernel, 250, seed=5, batch_size=100)
+    assert null.shape == (250, 10)
+    assert np.array_equal(null, null_distribution(model, kernel, 250, seed=5, batch_size=100))
+
+    observed = kernel(model.observed())[0]
+    summary = empirical_null(observed, model, kernel, 250, seed=5, batch_size=100)
+    assert np.allclose(summary['mean'], np.nanmean(null, axis=0))
+    assert np.allclose(summary['p_values'], (1 + (null <= observed + 1e-12).sum(axis=0)) / 251)
+
+
+def test_degree_matched():
+    ppi_data = DataFrame({'FromId': [1, 1, 1, 2, 5], 'ToId': [2, 3, 4, 3, 6]})
+    model = degree_matched_null_model(gene_sets, ppi_data, n_bins=2)
+    assert set(model.universe.tolist()) >= {1, 2, 3, 4, 5, 6}
+    assert list(quantile_strata(np.array([0, 0, 0, 1, 5, 9]), 2)) == [0, 0, 0, 1, 1, 1]
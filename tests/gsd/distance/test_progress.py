@@ -0,0 +1,82 @@
+import json
+
+from gsd.distance import calc_pairwise_distances
+from gsd.distance.progress import ProgressHook, JsonLinesProgress, PrometheusTextfileProgress, Progress, \
+    progress_labels, progress_hook_from_spec, CompositeProgress, set_progress_hook, progress_hook, PHASE_STARTED, \
+    PHASE_FINISHED, PROGRESS
+
+
+class RecordingProgress(ProgressHook):
+    def __init__(self):
+        self.events = []
+
+    def handle(self, event):
+        self.events.append(event)
+
+
+def test_pairwise_distances_emit_events():
+    recorder = RecordingProgress()
+    previous = progress_hook()
+    set_progress_hook(recorder, 0)
+    try:
+        with progress_labels(metric="general/Sum"):
+            d = calc_pairwise_distances(list(range(5)), lambda a, b: a + b, "Sum")
+    finally:
+        set_progress_hook(previous, 1.0)
+
+    assert d.tolist() == [1, 2, 3, 4, 3, 4, 5, 5, 6, 7]
+    kinds = [event.kind for event in recorder.events]
+    assert kinds[0] == PHASE_STARTED and kinds[-1] == PHASE_FINISHED
+    progress = [event for event in recorder.events if event.kind == PROGRESS]
+    assert [(event.tile, event.done) for event in progress] == [(0, 4), (1, 7), (2, 9), (3, 10)]
+    assert all(event.tile_seconds >= 0 for event in progress)
+    assert all(event.labels == {'metric': "general/Sum"} and event.phase == "Sum" for event in recorder.events)
+    assert recorder.events[-1].done == recorder.events[-1].total == 10
+
+
+def test_sampling():
+    recorder = RecordingProgress()
+    with Progress("Sampled", 1000, recorder, sample_interval=3600) as progress:
+        for _ in range(1000):
+            progress.update()
+    assert [event.kind for event in recorder.events] == [PHASE_STARTED, PHASE_FINISHED]
+
+    # tiles are sampled like everything else
+    recorder = RecordingProgress()
+    with Progress("Sampled tiles", 1000, recorder, sample_interval=3600) as progress:
+        for tile in range(1000):
+            progress.tile_started(tile)
+            progress.tile_finished(tile, 1)
+    assert [event.kind for event in recorder.events] == [PHASE_STARTED, PHASE_FINISHED]
+    assert recorder.events[-1].tile == 999 and recorder.events[-1].done == 1000
+
+    recorder = RecordingProgress()
+    with Progress("Unsampled", 10, recorder, sample_interval=0) as progress:
+        progress.update(4)
+    event = recorder.events[1]
+    assert event.kind == PROGRESS and event.done == 4 and event.eta is not None
+
+
+def test_file_adapters(tmpdir):
+    jsonl_file = str(tmpdir.join("progress.jsonl"))
+    prometheus_file = str(tmpdir.join("gsd.prom"))
+    hook = progress_hook_from_spec("jsonl:%s,prometheus:%s" % (jsonl_file, prometheus_file))
+    assert isinstance(hook, CompositeProgress)
+
+    with progress_labels(metric="nlp/WMD"):
+        with Progress("Rows", 3, hook, sample_interval=0) as progress:
+            for tile in range(3):
+                progress.tile_started(tile)
+                progress.tile_finished(tile, 1)
+
+    with open(jsonl_file) as f:
+        events = [json.loads(line) for line in f]
+    assert [event['event'] for event in events] == ['phase_started'] + ['progress'] * 3 + ['phase_finished']
+    assert events[-1]['done'] == 3 and events[-1]['labels'] == {'metric': "nlp/WMD"}
+    assert [event['tile'] for event in events[1:4]] == [0, 1, 2]
+
+    with open(prometheus_file) as f:
+        lines = f.read().splitlines()
+    assert 'gsd_pairs_done{metric="nlp/WMD",phase="Rows"} 3.0' in lines
+    assert 'gsd_phase_finished{metric="nlp/WMD",phase="Rows"} 1.0' in lines
+    assert any(line.startswith('gsd_pairs_per_second{') for line in lines)
@@ -0,0 +1,44 @@
+import os
+
+import jsonpickle
+
+from gsd.distance import execute_and_persist_evaluation
+from gsd.distance.general import GENERAL_DISTS, gene_matrix
+from gsd.distance.runner import run_metrics, expand_metric_ids, schedule, create_metric, Resources
+from tests import has_equal_elements
+from tests.gsd.distance import gene_sets
+
+
+def read_result(file: str):
+    with open(file) as f:
+        return jsonpickle.decode(f.read())
+
+
+def test_expand_metric_ids():
+    metric_ids = expand_metric_ids(['general', 'benchmark/Random_0_1'])
+    assert metric_ids == ['general/%s' % key for key in GENERAL_DISTS] + ['benchmark/Random_0_1']
+
+
+def test_metrics_share_extractors():
+    metric_ids = expand_metric_ids(['general'])
+    metrics = [create_metric(metric_id, Resources()) for metric_id in metric_ids]
+    groups = schedule(metric_ids, metrics)
+
+    assert len(groups) == 3
+    assert len({id(metric.extractor) for metric_id, metric in groups[0]}) == 1
+    assert all(metric.extractor is gene_matrix for metric in GENERAL_DISTS.values()
+               if metric.display_name.endswith("over genes"))
+
+
+def test_run_metrics_writes_registry_layout(tmpdir):
+    metric_ids = expand_metric_ids(['general']) + ['benchmark/Random_0_1']
+    out_files = run_metrics(None, "fake/target", metric_ids, out_dir=str(tmpdir), gene_sets=gene_sets)
+
+    for metric_id in metric_ids:
+        assert out_files[metric_id] == os.path.join(str(tmpdir), metric_id, "fake/target.json")
+        assert len(read_result(out_files[metric_id]).results) == 3
+
+    key = 'Jaccard_distance_over_genes'
+    single_file = str(tmpdir.join("single.json"))
+    execute_and_persist_evaluation(GENERAL_DISTS[key], gene_sets, single_file)
+    assert has_equal_elements(read_result(out_files['general/' + key]).results, read_result(single_file).results)
@@ -0,0 +1,155 @@
+import http.client
+import json
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from gsd.distance import DistanceMetric
+from gsd.distance.general import GENERAL_DISTS
+from gsd.distance.service import DistanceService
+from gsd.gene_set_store import write_gene_set_store
+from tests.gsd.distance import gene_sets
+
+metric = 'general/Jaccard_distance_over_genes'
+names = [gene_set.general_info.name for gene_set in gene_sets]
+
+
+@pytest.fixture
+def service(tmpdir):
+    store_file = str(tmpdir.join("gene_sets.npz"))
+    write_gene_set_store(gene_sets, store_file)
+    service = DistanceService({'fake': store_file}, [metric, 'benchmark/Random_0_1'], max_workers=2,
+                              knn_metrics=[metric])
+    yield service
+    service.close()
+
+
+def request(connection: http.client.HTTPConnection, method: str, path: str, body=None):
+    connection.request(method, path, json.dumps(body) if body is not None else None)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read().decode())
+
+
+def test_distance_and_knn_over_http(service):
+    server = service.serve()
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        status, response = request(connection, 'GET', '/metrics')
+        assert status == 200 and metric in response['metrics'] and response['targets'] == ['fake']
+
+        status, response = request(connection, 'POST', '/distance',
+                                   {'metric': metric, 'target': 'fake', 'gene_sets': names})
+        assert status == 200
+        assert response['distances'] == GENERAL_DISTS['Jaccard_distance_over_genes'].calc(gene_sets).tolist()
+
+        status, response = request(connection, 'POST', '/knn',
+                                   {'metric': metric, 'target': 'fake', 'gene_set': names[0], 'k': 1})
+        assert status == 200 and len(response['neighbours']) == 1 and response['neighbours'][0][0] != names[0]
+
+        status, response = request(connection, 'POST', '/distance',
+                                   {'metric': metric, 'target': 'fake', 'gene_sets': [names[0], 'unknown']})
+        assert status == 404 and 'unknown' in response['error']
+
+        status, response = request(connection, 'POST', '/batch', {'requests': [
+            {'type': 'distance', 'metric': metric, 'target': 'fake', 'gene_sets': names[:2]},
+            {'type': 'knn', 'metric': metric, 'target': 'fake', 'gene_set': names[1], 'k': 2},
+            {'type': 'distance', 'metric': 'no/metric', 'target': 'fake', 'gene_sets': names[:2]}]})
+        assert status == 200
+        assert len(response['results'][0]['distances']) == 1
+        assert len(response['results'][1]['neighbours']) == 2
+        assert 'error' in response['results'][2]
+
+        status, stats = request(connection, 'GET', '/stats')
+        assert stats['endpoints']['/distance']['count'] == 2
+        assert stats['endpoints']['/distance']['errors'] == 1
+        assert stats['throughput_rps'] > 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_malformed_requests(service):
+    for body in [[], {'metric': metric, 'target': 'fake', 'gene_set': ['x']},
+                 {'metric': metric, 'target': 'fake', 'gene_set': names[0], 'k': None},
+                 {'metric': 'benchmark/Random_0_1', 'target': 'fake', 'gene_set': names[0]}]:
+        status, response = service.handle('POST', '/knn', json.dumps(body).encode())
+        assert status == 400 and 'error' in response
+    assert service.stats.summary()['endpoints']['/knn']['errors'] == 4
+
+    status, response = service.handle('POST', '/batch', json.dumps({'requests': [
+        [], {'type': 'knn', 'metric': metric, 'target': 'fake', 'gene_set': names[0], 'k': 1}]}).encode())
+    assert status == 200 and 'error' in response['results'][0] and len(response['results'][1]['neighbours']) == 1
+
+
+class UnboundedDistance(DistanceMetric):
+    @property
+    def display_name(self) -> str:
+        return "Unbounded distance"
+
+    def calc(self, gene_sets):
+        d = np.full(len(gene_sets) * (len(gene_sets) - 1) // 2, np.inf)
+        d[0] = np.nan
+        return d
+
+
+def test_non_finite_distances_are_strict_json(service):
+    service.metrics['benchmark/Random_0_1'] = UnboundedDistance()
+    server = service.serve()
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        connection.request('POST', '/distance', json.dumps({'metric': 'benchmark/Random_0_1', 'target': 'fake',
+                                                            'gene_sets': names}))
+        response = connection.getresponse()
+        assert response.status == 200
+
+        def reject(constant):
+            raise ValueError("%s is not JSON" % constant)
+
+        distances = json.loads(response.read().decode(), parse_constant=reject)['distances']
+        assert distances == [None] + ["inf"] * (len(distances) - 1)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_concurrent_requests(service):
+    server = service.serve()
+    port = server.server_address[1]
+
+    def distance(idx):
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        return request(connection, 'POST', '/distance',
+                       {'metric': metric, 'target': 'fake', 'gene_sets': names})[1]['distances']
+
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(distance, range(32)))
+        assert all(result == results[0] for result in results)
+        assert service.stats.summary()['endpoints']['/distance']['count'] == 32
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str):
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def test_unix_socket(service, tmpdir):
+    unix_socket = str(tmpdir.join("gsd.sock"))
+    server = service.serve(unix_socket=unix_socket)
+    try:
+        status, response = request(UnixHTTPConnection(unix_socket), 'POST', '/knn',
+                                   {'metric': metric, 'target': 'fake', 'gene_set': names[2], 'k': 2})
+        assert status == 200 and len(response['neighbours']) == 2
+    finally:
+        server.shutdown()
+        server.server_close()
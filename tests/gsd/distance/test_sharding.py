@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import time
+
+import jsonpickle
+import numpy as np
+
+from gsd.distance import DistanceMetric, calc_pairwise_distances, condensed_range, execute_and_persist_evaluation
+from gsd.distance import sharding
+from gsd.distance.sharding import run_shard_worker, write_plan, merge_shards, read_plan
+from gsd.gene_sets import GeneSet, GeneSetInfo
+
+
+class SlowJaccardDistance(DistanceMetric):
+    @property
+    def display_name(self) -> str:
+        return "Slow Jaccard distance"
+
+    def calc(self, gene_sets):
+        def jaccard(a: GeneSet, b: GeneSet):
+            time.sleep(0.005)
+            genes_a, genes_b = set(a.general_info.entrez_gene_ids), set(b.general_info.entrez_gene_ids)
+            return 1 - len(genes_a & genes_b) / len(genes_a | genes_b)
+
+        return calc_pairwise_distances(gene_sets, jaccard)
+
+
+def random_gene_sets(n: int):
+    random = np.random.RandomState(0)
+    return [GeneSet(GeneSetInfo("set_%d" % idx, None, None, np.nan, True, random.choice(40, 8, replace=False), []),
+                    None)
+            for idx in range(n)]
+
+
+def read_results(file: str):
+    with open(file) as f:
+        return np.array(jsonpickle.decode(f.read()).results)
+
+
+def test_condensed_range():
+    gene_sets = random_gene_sets(6)
+    d = SlowJaccardDistance().calc(gene_sets)
+    with condensed_range(4, 11):
+        partial = SlowJaccardDistance().calc(gene_sets)
+    assert np.array_equal(partial[4:11], d[4:11])
+    assert np.all(np.isnan(partial[:4])) and np.all(np.isnan(partial[11:]))
+
+
+def _worker(shard_dir: str, out_file: str, worker: int, computed):
+    gene_sets = random_gene_sets(12)
+    execute_and_persist_evaluation(SlowJaccardDistance(), gene_sets, out_file, shard_dir, shard_size=6,
+                                   worker_id="worker-%d" % worker, poll_interval=0.05)
+    computed.put(len([name for name in os.listdir(shard_dir) if name.endswith(".npz")]))
+
+
+def test_local_workers(tmpdir):
+    shard_dir, out_file = str(tmpdir.join("shards")), str(tmpdir.join("result.json"))
+    single_file = str(tmpdir.join("single.json"))
+    execute_and_persist_evaluation(SlowJaccardDistance(), random_gene_sets(12), single_file)
+
+    context = multiprocessing.get_context("fork")
+    computed = context.Queue()
+    workers = [context.Process(target=_worker, args=(shard_dir, out_file, worker, computed)) for worker in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    assert [computed.get() for _ in workers] == [11] * 3
+    assert np.allclose(read_results(out_file), read_results(single_file))
+    assert not any(name.endswith(".lock") or name.endswith(".tmp") for name in os.listdir(shard_dir))
+
+
+def test_stale_shard_is_retried(tmpdir):
+    shard_dir, out_file = str(tmpdir.join("shards")), str(tmpdir.join("result.json"))
+    gene_sets = random_gene_sets(5)
+    write_plan(shard_dir, SlowJaccardDistance(), gene_sets, 4)
+    assert read_plan(shard_dir)['shards'] == [(0, 4), (4, 8), (8, 10)]
+
+    # a worker died while computing shard 1 and one is still alive with shard 2
+    dead_lock, live_lock = os.path.join(shard_dir, "shard_000001.lock"), os.path.join(shard_dir, "shard_000002.lock")
+    for lock_file in [dead_lock, live_lock]:
+        with open(lock_file, "w") as f:
+            f.write("other-worker")
+    os.utime(dead_lock, (time.time() - 100, time.time() - 100))
+
+    assert run_shard_worker(SlowJaccardDistance(), gene_sets, shard_dir, "worker", stale_after=10, wait=False) == 2
+    assert not merge_shards(shard_dir, gene_sets, out_file)
+
+    os.utime(live_lock, (time.time() - 100, time.time() - 100))
+    assert run_shard_worker(SlowJaccardDistance(), gene_sets, shard_dir, "worker", stale_after=10) == 1
+    assert merge_shards(shard_dir, gene_sets, out_file)
+    assert np.allclose(read_results(out_file), SlowJaccardDistance().calc(gene_sets))
+
+
+def test_fresh_lock_is_not_taken_over(tmpdir, monkeypatch):
+    lock_file = str(tmpdir.join("shard_000000.lock"))
+    with open(lock_file, "w") as f:
+        f.write("dead-worker")
+    os.utime(lock_file, (time.time() - 100, time.time() - 100))
+
+    # worker B takes the stale lock over between worker C's staleness check and C's rename
+    rename = os.rename
+
+    def rename_after_takeover(src, dst):
+        monkeypatch.setattr(sharding.os, "rename", rename)
+        assert sharding._claim(lock_file, "B", stale_after=10)
+        rename(src, dst)
+
+    monkeypatch.setattr(sharding.os, "rename", rename_after_takeover)
+    assert not sharding._claim(lock_file, "C", stale_after=10)
+    with open(lock_file) as f:
+        assert f.read() == "B"
+    assert os.listdir(str(tmpdir)) == ["shard_000000.lock"]
@@ -0,0 +1,48 @@
+import shutil
+
+import pytest
+
+from gsd.distance.nlp import TEXT_FIELDS, TEXT_SOURCES, go_field
+from gsd.distance.token_cache import load_token_cache, write_token_cache
+from gsd.gene_sets import GOType
+from tests.gsd.distance import gene_sets
+
+gene_sets_file = "gsd/distance/fake_gene_sets.json"
+
+
+def test_token_cache_roundtrip(tmpdir):
+    cache_file = str(tmpdir.join("tokens.npz"))
+    token_cache = load_token_cache(cache_file, gene_sets_file, gene_sets)
+
+    for gene_set in gene_sets:
+        for field in ['gene_symbols', 'summary', 'ncbi_summary', go_field(GOType.BIOLOGICAL_PROCESS, 'names')]:
+            assert token_cache.has(gene_set, field)
+            assert token_cache.words(gene_set, field) == TEXT_FIELDS[field](gene_set)
+
+    assert load_token_cache(cache_file, gene_sets_file).checksum == token_cache.checksum
+
+
+def test_outdated_token_cache(tmpdir):
+    source_file = str(tmpdir.join("gene_sets.json"))
+    cache_file = str(tmpdir.join("tokens.npz"))
+    shutil.copy(gene_sets_file, source_file)
+    load_token_cache(cache_file, source_file, gene_sets)
+
+    with open(source_file, "a") as f:
+        f.write("\n")
+    with pytest.raises(ValueError):
+        load_token_cache(cache_file, source_file)
+    assert load_token_cache(cache_file, source_file, gene_sets[:1]).gene_set_ids == \
+           {gene_sets[0].general_info.name: 0}
+
+
+def test_shared_texts_are_tokenised_once(tmpdir, monkeypatch):
+    field = go_field(GOType.BIOLOGICAL_PROCESS, 'definitions')
+    texts, tokenize = TEXT_SOURCES[field]
+    shared = set(texts(gene_sets[0])) & set(texts(gene_sets[1]))
+    assert len(shared) > 0
+
+    calls = []
+    monkeypatch.setitem(TEXT_SOURCES, field, (texts, lambda text: calls.append(text) or tokenize(text)))
+    write_token_cache(gene_sets[:2], str(tmpdir.join("tokens.npz")))
+    assert sorted(calls) == sorted(set(texts(gene_sets[0])) | set(texts(gene_sets[1])))
@@ -0,0 +1,90 @@
+import numpy as np
+from pyemd import emd
+
+from gsd.distance.wmd import WMDEngine, WMDistance, condensed_index
+from tests import has_equal_elements
+
+
+class Vectors:
+    """Minimal word vector lookup with the interface WMDEngine uses"""
+
+    def __init__(self, words, seed=0):
+        self.vector_size = 5
+        self.vectors = dict(zip(words, np.random.RandomState(seed).randn(len(words), self.vector_size)))
+
+    def __getitem__(self, words):
+        return np.vstack([self.vectors[word] for word in words])
+
+
+words = ["word%d" % idx for idx in range(30)]
+w2v_model = Vectors(words)
+documents = [list(np.random.RandomState(seed).choice(words, 3 + seed % 5)) for seed in range(12)] + [[]]
+
+
+def reference_wmd(words_a, words_b):
+    union = sorted(set(words_a) | set(words_b))
+    histogram_a = np.array([words_a.count(word) for word in union], dtype=float) / len(words_a)
+    histogram_b = np.array([words_b.count(word) for word in union], dtype=float) / len(words_b)
+    vectors = w2v_model[union]
+    distances = np.sqrt(((vectors[:, np.newaxis] - vectors[np.newaxis, :]) ** 2).sum(axis=2))
+    return emd(histogram_a, histogram_b, distances)
+
+
+def test_exact_matches_reference():
+    engine = WMDEngine(documents, w2v_model)
+    assert abs(engine.exact(0, 1) - reference_wmd(documents[0], documents[1])) < 1e-6
+    assert np.isnan(engine.exact(0, len(documents) - 1))
+
+
+def test_lower_bounds():
+    engine = WMDEngine(documents, w2v_model)
+    exact = engine.exact_pairs([(i, j) for i in range(len(engine)) for j in range(i + 1, len(engine))])
+    wcd = engine.centroid_bounds()
+    rwmd = engine.relaxed_bounds()
+
+    defined = ~np.isnan(exact)
+    assert np.array_equal(defined, ~np.isnan(wcd))
+    assert np.all(wcd[defined] <= exact[defined] + 1e-9)
+    assert np.all(rwmd[defined] <= exact[defined] + 1e-9)
+
+
+def test_uncached_word_distances():
+    cached = WMDEngine(documents, w2v_model)
+    uncached = WMDEngine(documents, w2v_model, max_cached_words=0)
+    assert uncached.word_distances is None
+    assert has_equal_elements(cached.relaxed_bounds()[:10], uncached.relaxed_bounds()[:10], epsilon=1e-9)
+    assert abs(cached.exact(2, 3) - uncached.exact(2, 3)) < 1e-9
+
+
+def test_top_k():
+    engine = WMDEngine(documents, w2v_model)
+    n = len(engine)
+    neighbours = engine.nearest_neighbours(3)
+    for idx in range(n - 1):
+        brute_force = sorted(engine.exact(idx, other) for other in range(n - 1) if other != idx)[:3]
+        assert has_equal_elements([distance for other, distance in neighbours[idx]], brute_force, epsilon=1e-9)
+    assert neighbours[n - 1] == []
+
+    metric = WMDistance("WMD", lambda x: x, w2v_model, top_k=3, n_jobs=1)
+    d = metric.calc(documents)
+    first_neighbour, distance = neighbours[0][0]
+    assert abs(d[condensed_index(0, first_neighbour, n)] - distance) < 1e-9
+
+
+def test_parallel_calc_matches_serial():
+    serial = WMDistance("WMD", lambda x: x, w2v_model, n_jobs=1).calc(documents)
+    parallel = WMDistance("WMD", lambda x: x, w2v_model, n_jobs=2).calc(documents)
+    assert len(serial) == len(documents) * (len(documents) - 1) // 2
+    assert np.allclose(serial, parallel, equal_nan=True)
+
+
+def test_blocked_relaxed_bounds():
+    engine = WMDEngine(documents, w2v_model)
+    # one document per block
+    assert np.allclose(engine.relaxed_bounds(), engine.relaxed_bounds(max_block_elements=1), equal_nan=True)
+
+
+def test_identical_vectors_like_gensim():
+    engine = WMDEngine([["word0"], ["word0", "word0"]], w2v_model)
+    assert engine.exact(0, 1) == np.inf
+    assert WMDistance("WMD", lambda x: x, w2v_model).n_jobs == 1
@@ -1,3 +1,5 @@
+import jsonpickle
+
 import gsd.gene_sets
 
 
@@ -10,3 +12,40 @@ def test_get_go_anno():
     assert len(go_info.molecular_function.ids) >= 10
     assert len(go_info.cellular_component.ids) >= 10
     assert len(go_info.biological_process.ids) >= 10
+
+
+def test_go_anno_index():
+    go_index = gsd.gene_sets.GOAnnotationIndex(go_anno)
+    entrezgene_ids = {8192, 8200, 22, -1}
+    go_info = gsd.gene_sets.GOInfo(entrezgene_ids, go_index)
+    expected = go_anno[go_anno['entrezgene'].isin(entrezgene_ids)
+                       & (go_anno[gsd.gene_sets.BIOMART_GO_NAMESPACE] == "biological_process")]
+    assert go_info.biological_process.ids == set(expected[gsd.gene_sets.BIOMART_GO_ID])
+    assert go_info.biological_process.definitions == set(expected[gsd.gene_sets.BIOMART_GO_DEFINITION])
+    assert len(gsd.gene_sets.GOInfo(set(), go_index).molecular_function.ids) == 0
+
+
+def test_extract_gwas_traits(tmpdir):
+    gwas_file = tmpdir.join("gwas.tsv")
+    gwas_file.write("PUBMEDID\tDISEASE/TRAIT\tMAPPED_GENE\tP-VALUE\n"
+                    "1\tType 2 diabetes\tGYS2\t1E-8\n"
+                    "2\tCough\tGYS2 - GYS1\t1E-9\n"
+                    "3\tHeight\tGYG2, GYS2\t1E-6\n"
+                    "4\tHeight\t\t1E-6\n"
+                    "5\tAsthma\tIL13\t1E-7\n")
+    gene_set = gsd.gene_sets.GeneSet(gsd.gene_sets.GeneSetInfo("SetA", "SetA", "", "", False,
+                                                               {2997, 2998}, {"GYS1", "GYS2"}), None)
+
+    gwas_index = gsd.gene_sets.read_gwas_trait_index(str(gwas_file), chunksize=2)
+    assert gwas_index["GYS2"] == ["Type 2 diabetes", "Cough", "Height"]
+    assert gwas_index["GYG2"] == ["Height"]
+
+    trait_info = gsd.gene_sets.create_gwas_traits_info(gene_set, gwas_index)
+    assert trait_info.gene_set_name == "SetA"
+    assert trait_info.gene_traits == {"GYS1": ["Cough"], "GYS2": ["Type 2 diabetes", "Cough", "Height"]}
+
+    index_file = str(tmpdir.join("gwas_index.json"))
+    gsd.gene_sets.write_gwas_trait_index(str(gwas_file), index_file)
+    gsd.gene_sets.extract_gwas_traits(index_file, [gene_set], str(tmpdir.join("gwas_gene_traits.json")))
+    with open(str(tmpdir.join("gwas_gene_traits.json"))) as f:
+        assert jsonpickle.decode(f.read())[0].gene_traits == trait_info.gene_traits
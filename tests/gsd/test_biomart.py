@@ -0,0 +1,69 @@
+import urllib.parse
+
+import pytest
+from pandas import read_table
+
+from gsd.gene_sets import stream_biomart_anno, read_anno_df, read_go_anno_df
+from tests import StubHTTPServer
+
+go_rows = ["GO:0000001\tmitochondrion inheritance\tThe distribution of mitochondria\tbiological_process",
+           "GO:0000002\tmitochondrial genome maintenance\tThe maintenance of the structure\tbiological_process",
+           "GO:0000003\t\t\tbiological_process",
+           "GO:0005575\tcellular_component\tA location, relative to cellular compartments\tcellular_component"]
+go_attributes = ["go_id", "name_1006", "definition_1006", "namespace_1003"]
+
+
+def biomart_handler(body: str):
+    def handle(path):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)['query'][0]
+        assert "completionStamp=\"1\"" in query
+        return 200, body
+
+    return handle
+
+
+def test_stream_biomart_anno(tmpdir):
+    out_file = str(tmpdir.join("go.tsv"))
+    binary_out_file = str(tmpdir.join("go.npz"))
+    with StubHTTPServer(biomart_handler("\n".join(go_rows) + "\n[success]\n")) as server:
+        stream_biomart_anno(go_attributes, out_file, binary_out_file, server_url=server.url, chunk_size=16)
+
+    df = read_table(out_file)
+    assert list(df.columns) == go_attributes
+    assert list(df['go_id']) == ["GO:0000001", "GO:0000002", "GO:0005575"]
+
+    binary_df = read_anno_df(binary_out_file)
+    assert list(binary_df.columns) == go_attributes
+    assert list(binary_df['definition_1006']) == list(df['definition_1006'])
+    assert str(binary_df['namespace_1003'].dtype) == 'category'
+
+
+def test_stream_biomart_anno_with_entrezgene(tmpdir):
+    out_file = str(tmpdir.join("entrezgene2go.tsv"))
+    binary_out_file = str(tmpdir.join("entrezgene2go.npz"))
+    with StubHTTPServer(biomart_handler("22\tGO:0000001\n8192\tGO:0005575\n[success]")) as server:
+        stream_biomart_anno(["entrezgene", "go_id"], out_file, binary_out_file, server_url=server.url)
+
+    go_file = str(tmpdir.join("go.npz"))
+    with StubHTTPServer(biomart_handler("\n".join(go_rows) + "\n[success]\n")) as server:
+        stream_biomart_anno(go_attributes, str(tmpdir.join("go.tsv")), go_file, server_url=server.url)
+
+    go_anno = read_go_anno_df(binary_out_file, go_file)
+    assert list(go_anno['entrezgene']) == [22, 8192]
+    assert list(go_anno['namespace_1003']) == ["biological_process", "cellular_component"]
+
+
+def test_stream_biomart_anno_validates_columns(tmpdir):
+    out_file = str(tmpdir.join("go.tsv"))
+    with StubHTTPServer(biomart_handler("Query ERROR: caught BioMart::Exception\n[success]")) as server:
+        with pytest.raises(ValueError):
+            stream_biomart_anno(go_attributes, out_file, server_url=server.url)
+    assert tmpdir.listdir() == []
+
+
+def test_stream_biomart_anno_detects_truncation(tmpdir):
+    out_file = str(tmpdir.join("go.tsv"))
+    with StubHTTPServer(biomart_handler("\n".join(go_rows))) as server:
+        with pytest.raises(IOError):
+            stream_biomart_anno(go_attributes, out_file, server_url=server.url)
+    assert tmpdir.listdir() == []
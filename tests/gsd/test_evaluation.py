@@ -0,0 +1,130 @@
+import os
+
+import jsonpickle
+import numpy as np
+from anytree import Node, PreOrderIter
+from anytree.exporter import JsonExporter
+from scipy.spatial.distance import squareform
+from scipy.stats import pearsonr, spearmanr, kendalltau
+
+from gsd.distance import persist_evaluation, EvaluationResult
+from gsd.evaluation import permuted_condensed_indices, batched_pearson, correlations, mantel_test, evaluate, \
+    tree_bipartitions, recover_tree, linkage_bipartitions, bipartition_distance, evaluate_tree_recovery
+from tests.gsd.distance import gene_sets
+
+n = 12
+random = np.random.RandomState(42)
+x = random.rand(n * (n - 1) // 2)
+y = x + random.rand(len(x))
+
+
+def test_permuted_condensed_indices():
+    permutations = np.array([random.permutation(n) for _ in range(5)])
+    square = squareform(x)
+    for permutation, idx in zip(permutations, permuted_condensed_indices(permutations)):
+        assert np.array_equal(x[idx], squareform(square[np.ix_(permutation, permutation)], checks=False))
+    assert permuted_condensed_indices(permutations).dtype == np.int32
+
+
+def test_correlations_ignore_nan():
+    y_nan = y.copy()
+    y_nan[[3, 17]] = np.nan
+    defined = ~np.isnan(y_nan)
+    result = correlations(x, y_nan)
+    assert abs(result['pearson'] - pearsonr(x[defined], y[defined])[0]) < 1e-12
+    assert abs(result['spearman'] - spearmanr(x[defined], y[defined])[0]) < 1e-12
+    assert abs(result['kendall'] - kendalltau(x[defined], y[defined])[0]) < 1e-12
+    assert abs(batched_pearson(x, y_nan[np.newaxis, :])[0] - result['pearson']) < 1e-9
+    assert np.isnan(correlations(x, np.full(len(x), 0.5))['pearson'])
+
+
+def test_mantel_test():
+    r, p = mantel_test(x, y, permutations=199, batch_size=50)
+    assert abs(r - pearsonr(x, y)[0]) < 1e-9
+    assert p == 1 / 200
+
+    unrelated = random.rand(len(x))
+    r_serial, p_serial = mantel_test(x, unrelated, 'spearman', permutations=199, batch_size=50)
+    r_parallel, p_parallel = mantel_test(x, unrelated, 'spearman', permutations=199, batch_size=50, n_jobs=2)
+    assert abs(r_serial - spearmanr(x, unrelated)[0]) < 1e-9
+    assert (r_serial, p_serial) == (r_parallel, p_parallel)
+    assert p_serial > 0.01
+
+    # 50 permutations of the 66 distances per batch, like batch_size=50
+    assert mantel_test(x, unrelated, 'spearman', permutations=199, max_batch_elements=50 * len(x)) == \
+        (r_serial, p_serial)
+
+
+def test_evaluate(tmpdir):
+    experiment_dir = str(tmpdir)
+    d = random.rand(len(gene_sets) * (len(gene_sets) - 1) // 2)
+    persist_evaluation("Reference", 1.0, d, gene_sets, "%s/tree_path/fake/target.json" % experiment_dir)
+    persist_evaluation("Same", 2.0, d, gene_sets, "%s/general/Same/fake/target.json" % experiment_dir)
+    persist_evaluation("Reversed", 3.0, -d, gene_sets, "%s/nlp/Reversed/fake/target.json" % experiment_dir)
+
+    df = evaluate(experiment_dir, ["fake/target"], permutations=99)
+    assert list(df.index) == [("fake/target", "general", "Same"), ("fake/target", "nlp", "Reversed")]
+    assert np.allclose(df['pearson'], [1.0, -1.0])
+    assert np.allclose(df['kendall'], [1.0, -1.0])
+    assert list(df['exec_time']) == [2.0, 3.0]
+    assert df['mantel_pearson_p'].iloc[0] < df['mantel_pearson_p'].iloc[1]
+
+
+def test_bipartitions():
+    #        root
+    #      /      \
+    #     a        b
+    #    / \      / \
+    #   c   d    e   f
+    root = Node("root")
+    a, b = Node("a", parent=root), Node("b", parent=root)
+    for name, parent in [("c", a), ("d", a), ("e", b), ("f", b)]:
+        Node(name, parent=parent)
+    leaves = ["c", "d", "e", "f"]
+    # only {c, d} | {e, f} is a non-trivial split of the leaves, seen from either side
+    assert tree_bipartitions(root, leaves) == {0b1100}
+
+    d = squareform(np.array([[0, 1, 4, 4], [1, 0, 4, 4], [4, 4, 0, 1], [4, 4, 1, 0]], dtype=float))
+    z = recover_tree(d)
+    assert linkage_bipartitions(z) == {0b1100}
+    assert bipartition_distance(linkage_bipartitions(z), tree_bipartitions(root, leaves)) == 0.0
+    assert bipartition_distance(linkage_bipartitions(recover_tree(d[[1, 0, 2, 3, 4, 5]])), {0b1100}) == 1.0
+
+    # inner nodes are labelled objects as well
+    labels = ["root", "a", "b", "c", "d", "e", "f"]
+    assert tree_bipartitions(root, labels) == {0b0011010, 0b1100100}
+
+
+def test_tree_recovery(tmpdir):
+    root = Node("r")
+    a, b = Node("a", parent=root), Node("b", parent=root)
+    for name, parent in [("c", a), ("d", a), ("e", b), ("f", b), ("g", b)]:
+        Node(name, parent=parent)
+    nodes = {node.name: node for node in PreOrderIter(root)}
+    names = sorted(nodes)
+    labels = [(names[i], names[j]) for i in range(len(names) - 1) for j in range(i + 1, len(names))]
+
+    def path_length(name_a, name_b):
+        path_a, path_b = nodes[name_a].path, nodes[name_b].path
+        shared = sum(1 for node_a, node_b in zip(path_a, path_b) if node_a is node_b)
+        return len(path_a) + len(path_b) - 2 * shared
+
+    reference = np.array([path_length(name_a, name_b) for name_a, name_b in labels], dtype=float)
+    noisy = reference + random.rand(len(reference)) * 0.1
+    noisy[0] = np.nan
+    results = {"tree_path": reference, "general/Noisy": noisy, "benchmark/Random": random.rand(len(reference))}
+    for path, d in results.items():
+        os.makedirs("%s/%s/fake" % (tmpdir, path))
+        with open("%s/%s/fake/target.json" % (tmpdir, path), "w") as f:
+            f.write(jsonpickle.encode(EvaluationResult(path, 1.0, d.tolist(), labels)))
+    os.makedirs("%s/evaluation_data/fake/target" % tmpdir)
+    with open("%s/evaluation_data/fake/target/tree.json" % tmpdir, "w") as f:
+        f.write(JsonExporter().export(root))
+
+    df = evaluate_tree_recovery(str(tmpdir), ["fake/target"], "%s/evaluation_data" % tmpdir)
+    noisy_scores = df.loc[("fake/target", "general", "Noisy")]
+    random_scores = df.loc[("fake/target", "benchmark", "Random")]
+    assert noisy_scores['reference_cophenetic_correlation'] > random_scores['reference_cophenetic_correlation']
+    assert noisy_scores['bipartition_distance'] < random_scores['bipartition_distance']
+    assert noisy_scores['reference_bipartitions'] == 2
+    assert 0 < noisy_scores['cophenetic_correlation'] <= 1
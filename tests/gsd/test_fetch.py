@@ -0,0 +1,71 @@
+import json
+import time
+import urllib.parse
+
+import pytest
+
+from gsd.fetch import HTTPClient, RateLimiter, JsonFileCache, HTTPStatusError
+from gsd.gene_sets import _get_all_ncbi_gene_dscr
+from tests import StubHTTPServer
+
+
+def esummary_handler(failing_calls: int = 0):
+    calls = []
+
+    def handle(path):
+        calls.append(path)
+        if len(calls) <= failing_calls:
+            return 503, "busy"
+        ids = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)['id'][0].split(',')
+        result = {gene_id: {'uid': gene_id, 'name': "GENE%s" % gene_id} for gene_id in ids}
+        result['uids'] = ids
+        return 200, json.dumps({'result': result})
+
+    return handle
+
+
+def test_client_retries():
+    with StubHTTPServer(esummary_handler(failing_calls=2)) as server:
+        client = HTTPClient(retries=2, backoff=0.01)
+        data = client.get_json(server.url + "/esummary.fcgi?id=1,2")
+        assert data['result']['uids'] == ['1', '2']
+        assert len(server.requests) == 3
+
+
+def test_client_gives_up():
+    with StubHTTPServer(lambda path: (404, "not found")) as server:
+        with pytest.raises(HTTPStatusError):
+            HTTPClient(retries=2, backoff=0.01).get(server.url + "/missing")
+        assert len(server.requests) == 1
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(50)
+    time_begin = time.time()
+    for _ in range(11):
+        limiter.wait()
+    assert time.time() - time_begin >= 0.19
+
+
+def test_json_file_cache(tmpdir):
+    cache = JsonFileCache(str(tmpdir))
+    assert cache.get("R-HSA-1") is None
+    cache.put("R-HSA-1", {'a': [1, 2]})
+    assert "R-HSA-1" in cache
+    assert cache.get("R-HSA-1") == {'a': [1, 2]}
+
+
+def test_fetch_ncbi_gene_desc_with_cache(tmpdir):
+    gene_ids = list(range(1, 26))
+    with StubHTTPServer(esummary_handler(failing_calls=1)) as server:
+        result = _get_all_ncbi_gene_dscr(gene_ids, str(tmpdir), base_url=server.url + "/esummary.fcgi",
+                                         chunk_size=10, requests_per_second=100)
+        assert sorted(result.keys(), key=int) == [str(gene_id) for gene_id in gene_ids]
+        assert result['7']['name'] == "GENE7"
+        assert len(server.requests) == 4
+
+        result = _get_all_ncbi_gene_dscr(gene_ids + [26], str(tmpdir), base_url=server.url + "/esummary.fcgi",
+                                         chunk_size=10, requests_per_second=100)
+        assert len(result) == 26
+        assert len(server.requests) == 5
+        assert 'id=26&' in server.requests[-1]
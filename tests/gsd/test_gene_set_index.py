@@ -0,0 +1,63 @@
+import numpy as np
+
+from gsd.gene_set_index import index_gene_sets, index_gene_set_store, save_gene_set_index, load_gene_set_index
+from gsd.gene_set_store import write_gene_set_store
+from tests.gsd.distance import gene_sets
+
+random = np.random.RandomState(7)
+library = {"set%d" % idx: set(random.choice(200, random.randint(1, 40), replace=False).tolist())
+           for idx in range(50)}
+queries = [set(random.choice(250, random.randint(1, 30), replace=False).tolist()) for _ in range(20)] + \
+          [set(), {1000}]
+
+
+class FakeInfo:
+    def __init__(self, name, genes):
+        self.name = name
+        self.entrez_gene_ids = genes
+
+
+class FakeGeneSet:
+    def __init__(self, name, genes):
+        self.general_info = FakeInfo(name, genes)
+
+
+def reference_scores(query, measure):
+    scores = {}
+    for name, genes in library.items():
+        intersection = len(query & genes)
+        if intersection > 0:
+            scores[name] = {'overlap': intersection,
+                            'jaccard': intersection / len(query | genes),
+                            'overlap_coefficient': intersection / min(len(query), len(genes))}[measure]
+    return scores
+
+
+def test_queries_match_set_operations():
+    index = index_gene_sets([FakeGeneSet(name, genes) for name, genes in library.items()])
+    names = list(library)
+    for measure in ['overlap', 'jaccard', 'overlap_coefficient']:
+        batch = index.batch_query(queries, measure)
+        for row, query in enumerate(queries):
+            expected = reference_scores(query, measure)
+            assert dict(index.query(query, measure)) == expected
+            assert {names[col]: score for col, score in zip(batch[row].indices, batch[row].data)} == expected
+    assert index.intersections(queries[0]).tolist() == [len(queries[0] & genes) for genes in library.values()]
+
+    ranked = index.query(queries[0], 'jaccard', top_k=3)
+    assert len(ranked) == 3 and ranked[0][1] >= ranked[1][1] >= ranked[2][1]
+
+
+def test_store_and_persistence(tmpdir):
+    store_file = str(tmpdir.join("gene_sets.npz"))
+    write_gene_set_store(gene_sets, store_file)
+    index = index_gene_set_store(store_file)
+    assert index.names == [gene_set.general_info.name for gene_set in gene_sets]
+
+    index_file = str(tmpdir.join("index.npz"))
+    save_gene_set_index(index, index_file)
+    loaded = load_gene_set_index(index_file)
+    query = list(gene_sets[0].general_info.entrez_gene_ids)
+    assert loaded.names == index.names
+    assert loaded.query(query) == index_gene_sets(gene_sets).query(query)
+    assert loaded.query(query)[0] == (gene_sets[0].general_info.name, 1.0)
@@ -0,0 +1,56 @@
+import pickle
+
+import gsd.gene_sets
+from gsd.gene_set_store import convert_gene_sets_json, load_gene_set_store, GeneSetStore
+
+gene_sets_file = "gsd/distance/fake_gene_sets.json"
+ncbi_gene_desc_file = "gsd/distance/fake_ncbi_gene_desc.json"
+gwas_gene_traits_file = "gsd/distance/fake_gwas_traits.json"
+
+
+def test_convert_and_load(tmpdir):
+    store_file = str(tmpdir.join("gene_sets.npz"))
+    convert_gene_sets_json(gene_sets_file, store_file, ncbi_gene_desc_file, gwas_gene_traits_file)
+
+    expected = gsd.gene_sets.load_gene_sets(gene_sets_file, ncbi_gene_desc_file, gwas_gene_traits_file)
+    gene_sets = load_gene_set_store(store_file)
+
+    assert len(gene_sets) == 3
+    for stored, gene_set in zip(gene_sets, expected):
+        assert stored.general_info.name == gene_set.general_info.name
+        assert stored.general_info.summary == gene_set.general_info.summary
+        assert stored.general_info.calculated == gene_set.general_info.calculated
+        assert stored.general_info.entrez_gene_ids == gene_set.general_info.entrez_gene_ids
+        assert stored.general_info.gene_symbols == gene_set.general_info.gene_symbols
+        assert stored.go_info.biological_process.ids == gene_set.go_info.biological_process.ids
+        assert stored.go_info.cellular_component.definitions == gene_set.go_info.cellular_component.definitions
+        assert stored.ncbi_gene_desc.gene_infos == gene_set.ncbi_gene_desc.gene_infos
+        assert stored.gwas_gene_traigs.gene_traits == gene_set.gwas_gene_traigs.gene_traits
+
+
+def test_lazy_loading(tmpdir):
+    store_file = str(tmpdir.join("gene_sets.npz"))
+    convert_gene_sets_json(gene_sets_file, store_file)
+
+    store = GeneSetStore(store_file)
+    gene_sets = store.gene_sets()
+    assert gene_sets[0].ncbi_gene_desc is None
+    assert gene_sets[0].gwas_gene_traigs is None
+    assert gene_sets[1].general_info.entrez_gene_ids == {5507, 8908, 2998}
+    assert set(store.columns.keys()) == {'name', 'genes', 'genes_offsets'}
+
+
+def test_pickle_materializes_views(tmpdir):
+    store_file = str(tmpdir.join("gene_sets.npz"))
+    convert_gene_sets_json(gene_sets_file, store_file, ncbi_gene_desc_file, gwas_gene_traits_file)
+    stored = load_gene_set_store(store_file)[1]
+    assert isinstance(stored.general_info.entrez_gene_ids, gsd.gene_sets.IdSetView)
+    assert isinstance(stored.go_info.biological_process.ids, gsd.gene_sets.IdSetView)
+
+    gene_set = pickle.loads(pickle.dumps(stored))
+    assert type(gene_set.general_info) is gsd.gene_sets.GeneSetInfo
+    assert type(gene_set.go_info.biological_process) is gsd.gene_sets.GOCategory
+    assert gene_set.general_info.entrez_gene_ids == stored.general_info.entrez_gene_ids
+    assert gene_set.go_info.biological_process.ids == stored.go_info.biological_process.ids
+    assert gene_set.ncbi_gene_desc.gene_infos == stored.ncbi_gene_desc.gene_infos
+    assert type(stored.go_info.materialize()) is gsd.gene_sets.GOInfo
@@ -1,6 +1,7 @@
-from pandas import read_table
+from anytree import Node
+from pandas import read_table, DataFrame
 
-from gsd.immune_cells import extract_from_raw_data
+from gsd.immune_cells import extract_from_raw_data, extract_genes_from, to_gene_sets
 from tests.gsd.distance import go_anno
 
 the_immune_cell_data_dir = "../raw_data/immune_cells"
@@ -11,3 +12,23 @@ def test_load_cell_tree():
     node, gene_sets = extract_from_raw_data(the_immune_cell_data_dir, gene_sym_hsapiens, go_anno)
     assert node is not None
     assert list is not None
+
+
+def test_parent_gene_sets_are_sub_tree_unions():
+    root = Node('cell')
+    t_cell = Node('T cell', parent=root)
+    cd4 = Node('CD4+ T cell', parent=t_cell)
+    Node('Treg', parent=cd4)
+    Node('B cell', parent=root)
+    markers = DataFrame({'cell_type': ['T cell', 'CD4+ T cell', 'Treg', 'B cell'],
+                         'entrezgene': [1, 2, 3, 4],
+                         'gene_symbol': ['A', 'B', 'C', 'D']})
+    cell_types_with_genes = set(markers['cell_type'])
+
+    gene_sets = extract_genes_from(root, to_gene_sets(markers), cell_types_with_genes)
+
+    assert [gene_set.name for gene_set in gene_sets] == ['cell', 'T cell', 'CD4+ T cell', 'Treg', 'B cell']
+    assert gene_sets[0].calculated
+    assert gene_sets[0].entrez_gene_ids == {1, 2, 3, 4}
+    assert gene_sets[0].gene_symbols == {'A', 'B', 'C', 'D'}
+    assert gene_sets[1].entrez_gene_ids == {1}
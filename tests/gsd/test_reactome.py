@@ -1,12 +1,42 @@
+import json
+
 import pytest
 from anytree import RenderTree
+from pandas import DataFrame
 
 import gsd.reactome
+from tests import StubHTTPServer
 from tests.gsd.distance import go_anno
 
 human_tax_id = 9606
 reactome_id = "R-HSA-416550"
 
+recorded_hierarchy = [{'stId': "R-HSA-1", 'name': "Top", 'children': [
+    {'stId': "R-HSA-2", 'name': "Child A"},
+    {'stId': "R-HSA-3", 'name': "Child B", 'children': [
+        {'stId': "R-HSA-4", 'name': "Grandchild"}]}]}]
+recorded_genes = {"R-HSA-1": [22, 8192, 8200], "R-HSA-2": [22], "R-HSA-3": [8192, 8200], "R-HSA-4": [8200]}
+
+
+def replay_reactome(path):
+    parts = path.split('/')
+    if path.startswith('/data/eventsHierarchy/'):
+        return 200, json.dumps(recorded_hierarchy)
+    if path.startswith('/data/query/'):
+        return 200, json.dumps({'stId': parts[3], 'displayName': "Pathway %s" % parts[3],
+                                'summation': [{'text': "Summary of %s" % parts[3]}]})
+    if path.endswith('/referenceEntities'):
+        return 200, json.dumps([{'className': "ReferenceGeneProduct", 'name': ["GENE%d" % gene],
+                                 'otherIdentifier': ["EntrezGene:%d" % gene]} for gene in recorded_genes[parts[3]]])
+    return 404, "not found"
+
+
+tiny_go_anno = DataFrame({'entrezgene': [22, 8200],
+                          'go_id': ["GO:0000001", "GO:0005575"],
+                          'name_1006': ["mitochondrion inheritance", "cellular_component"],
+                          'definition_1006': ["The distribution of mitochondria", "A location"],
+                          'namespace_1003': ["biological_process", "cellular_component"]})
+
 
 @pytest.mark.skip(reason="just takes long")
 def test_download_reactome():
@@ -14,3 +44,47 @@ def test_download_reactome():
     print(RenderTree(node))
     assert node is not None
     assert list is not None
+
+
+def test_download_reactome_with_cache(tmpdir):
+    with StubHTTPServer(replay_reactome) as server:
+        node, gene_sets = gsd.reactome.download(human_tax_id, "R-HSA-3", tiny_go_anno, cache_dir=str(tmpdir),
+                                                base_url=server.url)
+        assert len(server.requests) == 5
+
+    assert [gene_set.general_info.external_id for gene_set in gene_sets] == ["R-HSA-3", "R-HSA-4"]
+    assert gene_sets[0].general_info.entrez_gene_ids == {8192, 8200}
+    assert gene_sets[0].general_info.summary == "Summary of R-HSA-3"
+    assert gene_sets[1].go_info.cellular_component.ids == {"GO:0005575"}
+    assert [child.name for child in node.children] == ["Grandchild (R-HSA-4)"]
+
+    offline_node, offline_gene_sets = gsd.reactome.download(human_tax_id, "R-HSA-3", tiny_go_anno,
+                                                            cache_dir=str(tmpdir), offline=True)
+    assert [gene_set.general_info.name for gene_set in offline_gene_sets] == \
+           [gene_set.general_info.name for gene_set in gene_sets]
+
+    with pytest.raises(KeyError):
+        gsd.reactome.download(human_tax_id, "R-HSA-2", tiny_go_anno, cache_dir=str(tmpdir), offline=True)
+
+
+def test_hierarchy_snapshot(tmpdir):
+    snapshot_file = str(tmpdir.join("events_hierarchy.json"))
+    with StubHTTPServer(replay_reactome) as server:
+        client = gsd.reactome.ReactomeClient(base_url=server.url)
+        gsd.reactome.download_reactome_hierarchy(human_tax_id, snapshot_file, client)
+
+        hierarchy = gsd.reactome.load_reactome_hierarchy(snapshot_file)
+        assert hierarchy.sub_tree("R-HSA-3")['name'] == "Child B"
+        assert hierarchy.ancestors("R-HSA-4") == ["R-HSA-3", "R-HSA-1"]
+        assert "R-HSA-5" not in hierarchy
+
+        sub_trees = gsd.reactome.download_sub_trees(human_tax_id, ["R-HSA-1", "R-HSA-3"], tiny_go_anno,
+                                                    base_url=server.url, hierarchy=hierarchy)
+        # every pathway is fetched once (query + participants), overlapping sub-trees are reused
+        assert len(server.requests) == 1 + 2 * len(recorded_genes)
+
+    assert [gene_set.general_info.external_id for gene_set in sub_trees["R-HSA-3"][1]] == ["R-HSA-3", "R-HSA-4"]
+    assert len(sub_trees["R-HSA-1"][1]) == 4
+
+    with pytest.raises(KeyError):
+        hierarchy.sub_tree("R-HSA-5")
@@ -0,0 +1,46 @@
+import importlib
+import subprocess
+import sys
+
+import pytest
+
+from gsd.registry import METRICS, metric_keys, metric_spec, W2V_MODEL, THREADS
+
+
+@pytest.mark.parametrize("category,module_name", [('general', 'gsd.distance.general'),
+                                                  ('benchmark', 'gsd.distance.benchmark'),
+                                                  ('ppi', 'gsd.distance.ppi'),
+                                                  ('nlp', 'gensim'),
+                                                  ('go', 'rpy2')])
+def test_keys_match_implementation(category, module_name):
+    pytest.importorskip(module_name)
+    spec = next(iter(METRICS[category].values()))
+    module = importlib.import_module(spec.module)
+    assert metric_keys(category) == list(getattr(module, spec.attribute))
+
+
+def test_metric_spec():
+    spec = metric_spec('nlp/WM_dist_over_summary')
+    assert spec.module == 'gsd.distance.nlp' and W2V_MODEL in spec.requires
+    with pytest.raises(KeyError):
+        metric_spec('nlp/unknown')
+    with pytest.raises(KeyError):
+        metric_keys('unknown')
+
+
+def test_threads_reach_wmd():
+    pytest.importorskip('gensim')
+    from gsd.distance.runner import Resources
+
+    assert THREADS not in metric_spec('nlp/Cosine_dist_over_summary').requires
+    resources = Resources(threads=3)
+    resources.w2v_model = lambda: None
+    assert metric_spec('nlp/WM_dist_over_summary').create(resources).n_jobs == 3
+
+
+def test_enumeration_does_not_import_implementations():
+    code = "import sys; loaded = set(sys.modules); " \
+           "from gsd.registry import METRICS, metric_keys; [metric_keys(category) for category in METRICS]; " \
+           "print(','.join(sorted(name for name in set(sys.modules) - loaded if name.split('.')[0] in " \
+           "('numpy', 'scipy', 'pandas', 'gensim', 'nltk', 'rpy2', 'sklearn') or name.startswith('gsd.distance'))))"
+    assert subprocess.check_output([sys.executable, "-c", code], cwd="..").decode().strip() == ""